@@ -0,0 +1,91 @@
+import argparse
+import logging
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fuzzywuzzy import fuzz
+
+from fdaMatch import TermMatcher, stripNegation
+from fdaSearch import searchTermGroups, PDF_FOLDER
+
+
+LOGGER = logging.getLogger('fda_search')
+
+
+def loadTexts(folder, limit):
+    texts = []
+    for root, dirs, files in os.walk(folder):
+        if re.match(r"K\d{6}", os.path.basename(root)) and 'out_text.txt' in files:
+            with open(os.path.join(root, 'out_text.txt')) as fh:
+                texts.append((os.path.basename(root), fh.read()))
+            if len(texts) >= limit:
+                break
+    return texts
+
+
+def scoreFuzzywuzzy(texts, terms, cutoff):
+    # the loop fdaSearch used to run, lowercasing the document for every term
+    hits = {}
+    for k_number, lines in texts:
+        for item in terms:
+            ratio = fuzz.partial_ratio(stripNegation(item).lower(), lines.lower())
+            if ratio > cutoff:
+                hits[(k_number, item)] = ratio
+    return hits
+
+
+def scoreMatcher(texts, terms, cutoff, workers):
+    matcher = TermMatcher(terms, cutoff=cutoff, workers=workers)
+    hits = {}
+    for k_number, lines in texts:
+        for item, ratio in matcher.hits(lines):
+            hits[(k_number, item)] = ratio
+    return hits
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="bench-match",
+        description='Time the fuzzywuzzy term loop against the batched rapidfuzz matcher on OCR text'
+    )
+    parser.add_argument('folder', nargs='?', default=PDF_FOLDER, help='folder of K-number folders with out_text.txt')
+    parser.add_argument('-s', '--search', action='store', default='AM', help='key for search term groups')
+    parser.add_argument('-c', '--cutoff', action='store', type=int, default=80, help='cutoff value')
+    parser.add_argument('-n', '--limit', action='store', type=int, default=200, help='documents to score')
+    parser.add_argument('--match-threads', action='store', type=int, default=1, help='rapidfuzz threads')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    terms = searchTermGroups[args.search]
+    texts = loadTexts(args.folder, args.limit)
+    if len(texts) == 0:
+        LOGGER.error(f"No out_text.txt files under {args.folder}")
+        sys.exit(1)
+    chars = sum(len(text) for _, text in texts)
+    LOGGER.info(f'{len(texts)} documents, {chars} characters, {len(terms)} terms')
+
+    old, oldSeconds = timed(scoreFuzzywuzzy, texts, terms, args.cutoff)
+    new, newSeconds = timed(scoreMatcher, texts, terms, args.cutoff, args.match_threads)
+    LOGGER.info(f'fuzzywuzzy  {oldSeconds:8.2f}s  {len(texts) / oldSeconds:8.1f} docs/s  {len(old)} hits')
+    LOGGER.info(f'TermMatcher {newSeconds:8.2f}s  {len(texts) / newSeconds:8.1f} docs/s  {len(new)} hits')
+    LOGGER.info(f'Speedup {oldSeconds / newSeconds:.1f}x')
+
+    # rapidfuzz finds the optimal alignment, fuzzywuzzy only tries the
+    # windows its matching blocks suggest, so scores can differ a little
+    for key in sorted(set(old) | set(new)):
+        if old.get(key) != new.get(key):
+            LOGGER.info(f'{key[0]} {key[1]}: fuzzywuzzy {old.get(key)} rapidfuzz {new.get(key)}')
+
+
+if __name__ == '__main__':
+    main()
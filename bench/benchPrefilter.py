@@ -0,0 +1,87 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchMatch import loadTexts
+from fdaMatch import Prefilter, TermMatcher, normalize, min_word_share
+from fdaSearch import searchTermGroups, PDF_FOLDER
+
+
+LOGGER = logging.getLogger('fda_search')
+
+
+def outcome(scores, terms, cutoff):
+    # what fdaSearch makes of a document's scores: negated, or its hit terms
+    hits = []
+    for item in terms:
+        if scores.get(item, 0) > cutoff:
+            if item.startswith('!'):
+                return 'negated'
+            hits.append(item)
+    return tuple(hits)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="bench-prefilter",
+        description='Recall and speed of the Aho-Corasick prefilter against fuzzy scoring every term'
+    )
+    parser.add_argument('folder', nargs='?', default=PDF_FOLDER, help='folder of K-number folders with out_text.txt')
+    parser.add_argument('-s', '--search', action='store', default='AM', help='key for search term groups')
+    parser.add_argument('-c', '--cutoff', action='store', type=int, default=80, help='cutoff value')
+    parser.add_argument('-n', '--limit', action='store', type=int, default=200, help='documents to score')
+    parser.add_argument('--quality', action='store', type=float, default=min_word_share, help='word share under which every term is scored')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    terms = searchTermGroups[args.search]
+    texts = [(k_number, normalize(text)) for k_number, text in loadTexts(args.folder, args.limit)]
+    if len(texts) == 0:
+        LOGGER.error(f"No out_text.txt files under {args.folder}")
+        sys.exit(1)
+    matcher = TermMatcher(terms, cutoff=args.cutoff)
+    prefilter = Prefilter(terms, args.quality)
+
+    start = time.perf_counter()
+    full = {k_number: matcher.scores(text, normalized=True) for k_number, text in texts}
+    fullSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    filtered = {}
+    scored = 0
+    for k_number, text in texts:
+        flagged = prefilter.flagged(text, normalized=True)
+        scored += len(flagged)
+        filtered[k_number] = matcher.scores(text, flagged, normalized=True)
+    filteredSeconds = time.perf_counter() - start
+
+    LOGGER.info(f'{len(texts)} documents, {len(terms)} terms, cutoff {args.cutoff}')
+    LOGGER.info(f'Scoring every term  {fullSeconds:8.2f}s')
+    LOGGER.info(f'Prefiltered         {filteredSeconds:8.2f}s  {scored} of {len(texts) * len(terms)} term scores, '
+                f'speedup {fullSeconds / filteredSeconds:.1f}x')
+    LOGGER.info('Recall of term hits (found by prefilter / above cutoff scoring everything)')
+    missedAll = 0
+    totalAll = 0
+    for item in terms:
+        total = sum(1 for k_number in full if full[k_number][item] > args.cutoff)
+        found = sum(1 for k_number in full if full[k_number][item] > args.cutoff
+                    and filtered[k_number].get(item, 0) > args.cutoff)
+        totalAll += total
+        missedAll += total - found
+        LOGGER.info(f'    {item:24} {found:6}/{total:<6} {found / total if total else 1.0:7.1%}')
+    LOGGER.info(f'    {"all terms":24} {totalAll - missedAll:6}/{totalAll:<6} '
+                f'{(totalAll - missedAll) / totalAll if totalAll else 1.0:7.1%}')
+    changed = [k_number for k_number in full
+               if outcome(full[k_number], terms, args.cutoff) != outcome(filtered[k_number], terms, args.cutoff)]
+    LOGGER.info(f'{len(changed)} documents would get a different result')
+    for k_number in changed:
+        LOGGER.info(f'    {k_number}: {outcome(full[k_number], terms, args.cutoff)} became '
+                    f'{outcome(filtered[k_number], terms, args.cutoff)}')
+
+
+if __name__ == '__main__':
+    main()
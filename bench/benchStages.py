@@ -0,0 +1,302 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytesseract
+import requests
+
+import fdaMain
+from fdaCrawl import SummaryCrawler
+from fdaHttp import HttpClient
+from fdaMatch import TermMatcher, stripNegation
+from fdaOcr import OcrEngine, iterPages, default_dpi
+from fdaSearch import initScanWorker, scanChunk, searchTermGroups
+from fixtureCorpus import FIXTURE_FOLDER, default_documents, default_scanned_share, default_seed, generate, loadFixtures
+from stubServer import startStub
+
+
+LOGGER = logging.getLogger('fda')
+
+RESULTS_FILE = 'bench/results.jsonl'
+STAGES = ('openfda', 'scrape', 'scrape_async', 'download', 'render', 'ocr', 'match', 'search')
+SEARCH_GROUPS = ('AM', 'BE')
+default_page_size = 25
+# requests per second allowed to the stub, high enough never to wait
+stub_rate = 100000.0
+
+
+def percentile(values, share):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def summarize(times, items=None, seconds=None, **extra):
+    # one stage's result: items, total seconds, items/s and the p50/p95 of
+    # the per item times when there are any
+    items = len(times) if items is None else items
+    seconds = sum(times) if seconds is None else seconds
+    result = {'items': items, 'seconds': round(seconds, 4), 'per_second': round(items / seconds, 3) if seconds > 0 else None}
+    if len(times) != 0:
+        result['p50'] = round(percentile(times, 0.5), 4)
+        result['p95'] = round(percentile(times, 0.95), 4)
+    result.update(extra)
+    return result
+
+
+def recall(found, truth):
+    # share of the seeded (k_number, term) pairs found
+    seeded = set((k_number, term) for k_number, entry in truth.items() for term in entry['terms'])
+    if len(seeded) == 0:
+        return None
+    return round(len(seeded & found) / len(seeded), 3)
+
+
+def benchOpenfda(http, limit):
+    times = []
+    hits = []
+    skip = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            page, total = fdaMain.fetchHits(http, skip, limit)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                break
+            raise
+        times.append(time.perf_counter() - start)
+        hits += page
+        skip += limit
+    return hits, summarize(times, hits=len(hits))
+
+
+def benchScrape(http, hits, truth):
+    times = []
+    urls = {}
+    for hit in hits:
+        start = time.perf_counter()
+        urls[hit['k_number']] = fdaMain.findSummaryUrl(http, hit['k_number'])
+        times.append(time.perf_counter() - start)
+    expected = sum(1 for entry in truth.values() if entry['summary'])
+    return urls, summarize(times, found=sum(1 for url in urls.values() if url is not None), expected=expected)
+
+
+def benchScrapeAsync(baseUrl, hits, concurrency):
+    crawler = SummaryCrawler(f'{baseUrl}/pmn.cfm?ID=', concurrency, rates={'127.0.0.1': stub_rate})
+    start = time.perf_counter()
+    urls = crawler.resolve([hit['k_number'] for hit in hits])
+    seconds = time.perf_counter() - start
+    return summarize([], len(urls), seconds, concurrency=concurrency,
+                     found=sum(1 for url in urls.values() if url is not None))
+
+
+def benchDownload(http, hits, urls):
+    times = []
+    size = 0
+    for hit in hits:
+        url = urls.get(hit['k_number'])
+        if url is None:
+            continue
+        start = time.perf_counter()
+        size += len(fdaMain.fetchPdf(http, url, hit))
+        times.append(time.perf_counter() - start)
+    return summarize(times, bytes=size)
+
+
+def benchRender(folder, truth):
+    # per document, born digital ones mostly come out of the text layer
+    times = {True: [], False: []}
+    pages = {'text': 0, 'ocr': 0}
+    for k_number, entry in sorted(truth.items()):
+        start = time.perf_counter()
+        for kind, page in iterPages(os.path.join(folder, 'pdf', f'{k_number}.pdf'), default_dpi):
+            pages[kind] = pages.get(kind, 0) + 1
+        times[entry['scanned']].append(time.perf_counter() - start)
+    return summarize(times[True] + times[False], pages=pages,
+                     scanned=summarize(times[True]), born_digital=summarize(times[False]))
+
+
+def benchOcr(folder, truth, workers):
+    try:
+        engine = OcrEngine(workers)
+    except pytesseract.TesseractNotFoundError:
+        return {'skipped': 'tesseract not found'}
+    times = []
+    pages = 0
+    found = set()
+    matcher = TermMatcher(sorted(set(term for entry in truth.values() for term in entry['terms'])), cutoff=80)
+    with engine:
+        for k_number, entry in sorted(truth.items()):
+            rendered = engine.render(os.path.join(folder, 'pdf', f'{k_number}.pdf'))
+            start = time.perf_counter()
+            texts, stats = engine.ocrPages(rendered, k_number)
+            times.append(time.perf_counter() - start)
+            pages += stats['ocr']
+            found.update((k_number, term) for term, score in matcher.hits(''.join(texts)))
+    return summarize(times, ocr_pages=pages, workers=engine.workers, version=engine.version, recall=recall(found, truth))
+
+
+def searchFolders(folder):
+    folders = []
+    for root, dirs, files in os.walk(os.path.join(folder, 'search', 'pdf')):
+        if re.match(r"K\d{6}", os.path.basename(root)):
+            folders.append(root)
+    return sorted(folders)
+
+
+def benchMatch(folder, truth):
+    matchers = [TermMatcher(searchTermGroups[name], cutoff=80) for name in SEARCH_GROUPS]
+    times = []
+    found = set()
+    for root in searchFolders(folder):
+        with open(os.path.join(root, 'out_text.txt')) as fh:
+            text = fh.read()
+        start = time.perf_counter()
+        for matcher in matchers:
+            found.update((os.path.basename(root), stripNegation(term)) for term, score in matcher.hits(text))
+        times.append(time.perf_counter() - start)
+    return summarize(times, recall=recall(found, truth))
+
+
+def benchSearch(folder, jobs, chunkSize=8):
+    # the fdaSearch scan of the fixture tree, every group in one pass
+    groups = [(name, searchTermGroups[name]) for name in SEARCH_GROUPS]
+    folders = [(root, None, None) for root in searchFolders(folder)]
+    start = time.perf_counter()
+    if jobs > 1:
+        chunks = [folders[i:i + chunkSize] for i in range(0, len(folders), chunkSize)]
+        with ProcessPoolExecutor(max_workers=jobs, initializer=initScanWorker, initargs=(groups, 80, {}, 1)) as executor:
+            results = [result for chunk, scored, metrics, profile in executor.map(scanChunk, chunks) for result in chunk]
+    else:
+        initScanWorker(groups, 80, {}, 1)
+        results, scored, metrics, profile = scanChunk(folders)
+    seconds = time.perf_counter() - start
+    hits = {name: sum(1 for result in results if result[i][0] == 'hit') for i, (name, _) in enumerate(groups)}
+    return summarize([], len(folders), seconds, jobs=jobs, hits=hits)
+
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def showHistory(path, count):
+    if not os.path.exists(path):
+        LOGGER.error(f'No results in {path} yet')
+        return
+    with open(path) as fh:
+        runs = [json.loads(line) for line in fh if line.strip()][-count:]
+    print('time                 commit   ' + ' '.join(f'{stage:>12}' for stage in STAGES) + '  label')
+    for run in runs:
+        rates = [run['stages'].get(stage, {}).get('per_second') for stage in STAGES]
+        print(f"{run['time']:<20} {run.get('commit') or '-':<8} "
+              + ' '.join(f'{rate:12.2f}' if rate is not None else f'{"-":>12}' for rate in rates)
+              + f"  {run.get('label') or ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="bench-stages",
+        description='Time every stage of the miner and the search against synthetic summaries served from a local stub, '
+                    'appending the results to a json lines file'
+    )
+    parser.add_argument('folder', nargs='?', default=FIXTURE_FOLDER, help='fixtures folder, generated when missing')
+    parser.add_argument('--generate', action='store_true', help='generate the fixtures again')
+    parser.add_argument('-n', '--documents', action='store', type=int, default=default_documents, help='summaries to generate')
+    parser.add_argument('--scanned', action='store', type=float, default=default_scanned_share, help='share of generated summaries that are scans')
+    parser.add_argument('--seed', action='store', type=int, default=default_seed, help='fixture random seed')
+    parser.add_argument('--stages', action='store', default=','.join(STAGES), help=f'comma separated stages to run, of {",".join(STAGES)}')
+    parser.add_argument('--latency', action='store', type=float, default=0.0, help='seconds the stub adds to every response')
+    parser.add_argument('--page-size', action='store', type=int, default=default_page_size, help='hits per openFDA page')
+    parser.add_argument('--concurrency', action='store', type=int, default=16, help='summary pages the async crawler fetches at once')
+    parser.add_argument('--ocr-workers', action='store', type=int, default=os.cpu_count(), help='OCR processes')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1, help='fdaSearch scan processes')
+    parser.add_argument('--label', action='store', help='note stored with the results of this run')
+    parser.add_argument('--results', action='store', default=RESULTS_FILE, help='json lines file every run is appended to')
+    parser.add_argument('--history', action='store', type=int, nargs='?', const=20, metavar='RUNS', help='only show the items/s of the last runs')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    # the per hit lines of the search would drown the results
+    logging.getLogger('fda_search').setLevel(logging.WARNING)
+
+    if args.history is not None:
+        showHistory(args.results, args.history)
+        return
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        LOGGER.error(f'Unknown stages {", ".join(sorted(unknown))}')
+        sys.exit(1)
+
+    if args.generate or not os.path.exists(os.path.join(args.folder, 'truth.json')):
+        LOGGER.info(f'Generating {args.documents} summaries in {args.folder}')
+        generate(args.folder, args.documents, args.scanned, args.seed)
+    hits, truth = loadFixtures(args.folder)
+
+    server, baseUrl = startStub(args.folder, latency=args.latency)
+    fdaMain.OFDA_DEVICE = f'{baseUrl}/device'
+    fdaMain.BASE_510K_URL = f'{baseUrl}/pmn.cfm?ID='
+    http = HttpClient(rates={'127.0.0.1': stub_rate})
+    results = {}
+    urls = None
+    try:
+        for stage in stages:
+            LOGGER.info(f'Stage {stage}')
+            if stage == 'openfda':
+                hits, results[stage] = benchOpenfda(http, args.page_size)
+            elif stage == 'scrape':
+                urls, results[stage] = benchScrape(http, hits, truth)
+            elif stage == 'scrape_async':
+                results[stage] = benchScrapeAsync(baseUrl, hits, args.concurrency)
+            elif stage == 'download':
+                if urls is None:
+                    urls = {hit['k_number']: f'{baseUrl}/pdf/{hit["k_number"]}.pdf' for hit in hits
+                            if truth[hit['k_number']]['summary']}
+                results[stage] = benchDownload(http, hits, urls)
+            elif stage == 'render':
+                results[stage] = benchRender(args.folder, truth)
+            elif stage == 'ocr':
+                results[stage] = benchOcr(args.folder, truth, args.ocr_workers)
+            elif stage == 'match':
+                results[stage] = benchMatch(args.folder, truth)
+            elif stage == 'search':
+                results[stage] = benchSearch(args.folder, args.jobs)
+            LOGGER.info(f'    {json.dumps(results[stage])}')
+    finally:
+        http.close()
+        server.shutdown()
+
+    run = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'label': args.label,
+        'commit': gitCommit(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'documents': len(truth),
+        'scanned': sum(1 for entry in truth.values() if entry['scanned']),
+        'pages': sum(entry['pages'] for entry in truth.values()),
+        'settings': {'seed': args.seed, 'latency': args.latency, 'page_size': args.page_size,
+                     'concurrency': args.concurrency, 'ocr_workers': args.ocr_workers, 'jobs': args.jobs},
+        'stages': results,
+    }
+    with open(args.results, 'a') as fh:
+        fh.write(json.dumps(run) + '\n')
+    LOGGER.info(f'Results appended to {args.results}')
+
+
+if __name__ == '__main__':
+    main()
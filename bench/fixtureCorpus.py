@@ -0,0 +1,223 @@
+import argparse
+import copy
+import io
+import json
+import logging
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz
+from PIL import Image, ImageFilter
+
+from fdaMain import getYear, writeResults
+from fdaSearch import searchTermGroups
+
+
+LOGGER = logging.getLogger('fda')
+
+FIXTURE_FOLDER = 'bench/fixtures/'
+default_documents = 60
+default_scanned_share = 0.5
+default_seed = 510
+# share of hits whose pmn.cfm page has no summary link
+no_summary_share = 0.1
+# dpi the scanned summaries are rasterized at, tesseract's lower comfort zone
+scan_dpi = 150
+
+APPLICANTS = ['Stryker Corporation', 'Zimmer Biomet', 'Medtronic, Inc.', 'Smith & Nephew, Inc.', 'Arthrex, Inc.',
+              'DePuy Synthes', 'Globus Medical Inc.', 'Restor3D, Inc.', 'Oxford Performance Materials', 'Conformis, Inc.']
+DEVICES = [
+    ('HWC', 'OR', 'Orthopedic', 'Screw, Fixation, Bone'),
+    ('MAX', 'OR', 'Orthopedic', 'Intervertebral Fusion Device With Bone Graft, Lumbar'),
+    ('JDI', 'OR', 'Orthopedic', 'Prosthesis, Hip, Semi-Constrained'),
+    ('GAM', 'SU', 'General, Plastic Surgery', 'Suture, Absorbable, Synthetic, Polyglycolic Acid'),
+    ('FTM', 'SU', 'General, Plastic Surgery', 'Mesh, Surgical, Polymeric'),
+    ('DZE', 'DE', 'Dental', 'Implant, Endosseous, Root-Form'),
+    ('KWQ', 'OR', 'Orthopedic', 'Appliance, Fixation, Spinal Interlaminal'),
+    ('NKB', 'OR', 'Orthopedic', 'Orthosis, Spinal Pedicle Fixation'),
+]
+FILLER = [
+    'The subject device is substantially equivalent to the predicate devices in intended use, design and performance.',
+    'Non-clinical testing included static and dynamic compression, torsion and expulsion testing per ASTM F2077.',
+    'The device is provided sterile and is intended for single use only.',
+    'Biocompatibility was evaluated according to ISO 10993-1 and the FDA guidance on its use.',
+    'The implant is manufactured from titanium alloy (Ti-6Al-4V ELI) conforming to ASTM F3001.',
+    'Sterilization validation was performed to a sterility assurance level of 10-6.',
+    'Differences in technological characteristics do not raise different questions of safety and effectiveness.',
+    'Mechanical performance was compared with the predicate devices and found to be equivalent or better.',
+    'Packaging validation demonstrated that the sterile barrier is maintained over the labeled shelf life.',
+    'Bacterial endotoxin testing was performed per USP <85> with results below the 20 EU/device limit.',
+    'The instruments used to implant the device are reusable and are provided non-sterile.',
+    'No clinical data were necessary to demonstrate substantial equivalence.',
+]
+# what tesseract commonly makes of a clean scan, applied to the text the
+# search fixtures are built from so the scan sees realistic OCR errors
+OCR_NOISE = [('m', 'rn'), ('d', 'cl'), ('l', '1'), ('o', '0'), ('e', 'c')]
+
+
+def seededTerms():
+    # the terms fixtures are seeded with, from the AM and BE groups
+    return {group: [term for term in searchTermGroups[group] if not term.startswith('!')] for group in ('AM', 'BE')}
+
+
+def makeKNumber(rng, used):
+    while True:
+        year = rng.randint(2005, 2022)
+        k_number = f'K{year % 100:02d}{rng.randint(0, 9999):04d}'
+        if k_number not in used:
+            used.add(k_number)
+            return k_number
+
+
+def makeHit(rng, k_number):
+    product_code, committee, committee_desc, device_name = rng.choice(DEVICES)
+    year = getYear(k_number)
+    return {
+        'k_number': k_number,
+        'applicant': rng.choice(APPLICANTS),
+        'device_name': f'{device_name} {rng.choice(["System", "Device", "Implant", "Kit"])}',
+        'product_code': product_code,
+        'decision_date': f'{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+        'advisory_committee': committee,
+        'advisory_committee_description': committee_desc,
+        'statement_or_summary': 'Summary',
+        'clearance_type': 'Traditional',
+        'decision_code': 'SESE',
+        'openfda': {
+            'device_name': device_name,
+            'fei_number': [str(rng.randint(1000000, 9999999))],
+            'registration_number': [str(rng.randint(1000000, 9999999))],
+            'device_class': '2',
+        },
+    }
+
+
+def summaryPages(rng, hit, predicates, terms):
+    # the text of each page of a 510(k) summary mentioning predicates and
+    # terms somewhere in its body
+    body = list(rng.sample(FILLER, rng.randint(4, len(FILLER))))
+    for term in terms:
+        body.insert(rng.randint(0, len(body)), f'The device is {term} and was evaluated for its {term} properties.')
+    body.insert(rng.randint(0, len(body)), 'Predicate devices: ' + ', '.join(predicates) + '.')
+    header = [
+        f"510(k) Summary - {hit['k_number']}",
+        f"Submitter: {hit['applicant']}",
+        f"Device trade name: {hit['device_name']}",
+        f"Product code: {hit['product_code']}",
+        f"Date prepared: {hit['decision_date']}",
+    ]
+    pages = []
+    lines = header + [''] + body
+    per_page = rng.randint(5, 9)
+    for start in range(0, len(lines), per_page):
+        pages.append('\n\n'.join(lines[start:start + per_page]))
+    return pages
+
+
+def bornDigitalPdf(pages):
+    doc = fitz.open()
+    for text in pages:
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(72, 72, page.rect.width - 72, page.rect.height - 72), text, fontsize=11)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def scannedPdf(pages, rng):
+    # every page rasterized, slightly rotated and blurred, then put back
+    # as an image only page so it needs OCR
+    source = fitz.open(stream=bornDigitalPdf(pages), filetype='pdf')
+    doc = fitz.open()
+    for page in source:
+        pix = page.get_pixmap(dpi=scan_dpi, colorspace=fitz.csGRAY)
+        image = Image.frombytes('L', (pix.width, pix.height), pix.samples)
+        image = image.rotate(rng.uniform(-1.0, 1.0), fillcolor=255).filter(ImageFilter.GaussianBlur(0.6))
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG')
+        target = doc.new_page(width=page.rect.width, height=page.rect.height)
+        target.insert_image(target.rect, stream=buffer.getvalue())
+    data = doc.tobytes(deflate=True)
+    doc.close()
+    source.close()
+    return data
+
+
+def ocrNoise(text, rng, rate=0.01):
+    for wrong, right in OCR_NOISE:
+        parts = text.split(wrong)
+        text = parts[0] + ''.join((right if rng.random() < rate else wrong) + part for part in parts[1:])
+    return text
+
+
+def generate(folder=FIXTURE_FOLDER, count=default_documents, scannedShare=default_scanned_share, seed=default_seed):
+    # writes under folder:
+    #   hits.json          the openFDA records, as the stub serves them
+    #   truth.json         per K-number the seeded terms and predicates, if
+    #                      it is scanned and if it has a summary link
+    #   pdf/<K>.pdf        the summaries
+    #   search/pdf/...     the Submit_Year folders fdaMain would have left,
+    #                      out_text.txt and data.txt, for fdaSearch
+    rng = random.Random(seed)
+    terms = seededTerms()
+    used = set()
+    k_numbers = [makeKNumber(rng, used) for _ in range(count)]
+    os.makedirs(os.path.join(folder, 'pdf'), exist_ok=True)
+    hits = []
+    truth = {}
+    for k_number in k_numbers:
+        hit = makeHit(rng, k_number)
+        predicates = rng.sample([k for k in k_numbers if k != k_number], rng.randint(1, 3))
+        seeded = []
+        for group, group_terms in terms.items():
+            if rng.random() < 0.4:
+                seeded += rng.sample(group_terms, rng.randint(1, 2))
+        pages = summaryPages(rng, hit, predicates, seeded)
+        scanned = rng.random() < scannedShare
+        with open(os.path.join(folder, 'pdf', f'{k_number}.pdf'), 'wb') as fh:
+            fh.write(scannedPdf(pages, rng) if scanned else bornDigitalPdf(pages))
+        text = '\n'.join(pages)
+        dataPath = os.path.join(folder, 'search', 'pdf', f'Submit_Year_{getYear(k_number)}', k_number)
+        os.makedirs(dataPath, exist_ok=True)
+        writeResults(copy.deepcopy(hit), dataPath, ocrNoise(text, rng) if scanned else text, len(pages), io.StringIO())
+        hits.append(hit)
+        truth[k_number] = {'terms': seeded, 'predicates': predicates, 'scanned': scanned, 'pages': len(pages),
+                           'summary': rng.random() >= no_summary_share}
+    with open(os.path.join(folder, 'hits.json'), 'w') as fh:
+        json.dump(hits, fh, indent=1)
+    with open(os.path.join(folder, 'truth.json'), 'w') as fh:
+        json.dump(truth, fh, indent=1)
+    return hits, truth
+
+
+def loadFixtures(folder=FIXTURE_FOLDER):
+    with open(os.path.join(folder, 'hits.json')) as fh:
+        hits = json.load(fh)
+    with open(os.path.join(folder, 'truth.json')) as fh:
+        truth = json.load(fh)
+    return hits, truth
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="bench-fixtures",
+        description='Generate synthetic 510(k) summaries, born digital and scanned, for the offline benchmarks'
+    )
+    parser.add_argument('folder', nargs='?', default=FIXTURE_FOLDER, help='folder to write the fixtures to')
+    parser.add_argument('-n', '--documents', action='store', type=int, default=default_documents, help='summaries to generate')
+    parser.add_argument('--scanned', action='store', type=float, default=default_scanned_share, help='share of the summaries that are image only scans')
+    parser.add_argument('--seed', action='store', type=int, default=default_seed, help='random seed, the same seed gives the same corpus')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    hits, truth = generate(args.folder, args.documents, args.scanned, args.seed)
+    scanned = sum(1 for entry in truth.values() if entry['scanned'])
+    LOGGER.info(f'{len(hits)} summaries written to {args.folder}, {scanned} scanned, '
+                f'{sum(entry["pages"] for entry in truth.values())} pages')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import html
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtureCorpus import FIXTURE_FOLDER, loadFixtures
+
+
+LOGGER = logging.getLogger('fda')
+
+default_port = 8510
+
+PMN_PAGE = '''<html><head><title>510(k) Premarket Notification</title></head><body>
+<table><tr><th>510(k) Number</th><td>{k_number}</td></tr>
+<tr><th>Device Name</th><td>{device_name}</td></tr>
+<tr><th>Applicant</th><td>{applicant}</td></tr>
+<tr><th>Decision Date</th><td>{decision_date}</td></tr>
+<tr><th>Summary/Statement</th><td>{link}</td></tr></table>
+</body></html>'''
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # answers the three kinds of request fdaMain makes, from the fixtures:
+    #   /device/510k.json?search=...&limit=&skip=   an openFDA page
+    #   /pmn.cfm?ID=K...                            a CDRH summary page
+    #   /pdf/K....pdf                               a summary pdf
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path.endswith('/510k.json'):
+            self.openfda(int(query.get('skip', ['0'])[0]), int(query.get('limit', ['1'])[0]))
+        elif url.path.endswith('/pmn.cfm'):
+            self.pmn(query.get('ID', [''])[0])
+        elif url.path.startswith('/pdf/'):
+            self.pdf(os.path.basename(url.path))
+        else:
+            self.reply(404, b'not found', 'text/plain')
+
+    def reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def openfda(self, skip, limit):
+        hits = self.server.hits
+        if skip >= len(hits):
+            # what openFDA answers past the last hit
+            self.reply(404, json.dumps({'error': {'code': 'NOT_FOUND', 'message': 'No matches found!'}}).encode(),
+                       'application/json')
+            return
+        page = {'meta': {'results': {'skip': skip, 'limit': limit, 'total': len(hits)}},
+                'results': hits[skip:skip + limit]}
+        self.reply(200, json.dumps(page).encode(), 'application/json')
+
+    def pmn(self, k_number):
+        hit = self.server.byKNumber.get(k_number)
+        if hit is None:
+            self.reply(404, b'not found', 'text/html')
+            return
+        link = ''
+        if self.server.truth[k_number]['summary']:
+            link = f'<a href="{self.server.baseUrl}/pdf/{k_number}.pdf">Summary</a>'
+        page = PMN_PAGE.format(k_number=k_number, link=link,
+                               **{key: html.escape(str(hit.get(key, ''))) for key in ('device_name', 'applicant', 'decision_date')})
+        self.reply(200, page.encode(), 'text/html')
+
+    def pdf(self, name):
+        path = os.path.join(self.server.folder, 'pdf', name)
+        if not os.path.exists(path):
+            self.reply(404, b'not found', 'text/plain')
+            return
+        with open(path, 'rb') as fh:
+            self.reply(200, fh.read(), 'application/pdf')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startStub(folder=FIXTURE_FOLDER, port=0, latency=0.0):
+    # serves the fixtures of folder from a thread, returns the server and
+    # its base url.  Port 0 picks a free one
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.folder = folder
+    server.hits, server.truth = loadFixtures(folder)
+    server.byKNumber = {hit['k_number']: hit for hit in server.hits}
+    server.latency = latency
+    server.baseUrl = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, name='stub', daemon=True).start()
+    return server, server.baseUrl
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="bench-stub",
+        description='Serve the benchmark fixtures as a local openFDA and CDRH pmn.cfm'
+    )
+    parser.add_argument('folder', nargs='?', default=FIXTURE_FOLDER, help='fixtures written by fixtureCorpus.py')
+    parser.add_argument('-p', '--port', action='store', type=int, default=default_port, help='port to listen on')
+    parser.add_argument('--latency', action='store', type=float, default=0.0, help='seconds added to every response')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    server, baseUrl = startStub(args.folder, args.port, args.latency)
+    LOGGER.info(f'Serving {len(server.hits)} hits, run fdaMain.py --openfda-url {baseUrl}/device '
+                f'--cdrh-url "{baseUrl}/pmn.cfm?ID=" --rate 127.0.0.1=1000')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
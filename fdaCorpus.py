@@ -0,0 +1,275 @@
+import argparse
+import codecs
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+
+LOGGER = logging.getLogger('fda')
+
+CORPUS_FOLDER = 'corpus/'
+PDF_FOLDER = 'pdf/'
+default_segment_size = 256  # MB
+
+insert_batch = 1000
+
+
+class TextView:
+    # A document's memoryview read like a text file, decoded a read at a
+    # time so the document is never copied whole.  read() sizes are in
+    # bytes, so it may return fewer characters.  The view is released on
+    # close
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def read(self, size=-1):
+        text = ''
+        # a read ending inside a character may decode to nothing yet
+        while text == '' and self.position < len(self.view):
+            end = len(self.view) if size is None or size < 0 else min(len(self.view), self.position + max(size, 4))
+            text = self.decoder.decode(self.view[self.position:end], final=end == len(self.view))
+            self.position = end
+        return text
+
+    def tell(self):
+        # the bytes of a character cut by the last read are not read yet
+        return self.position - len(self.decoder.getstate()[0])
+
+    def seek(self, position):
+        self.position = position
+        self.decoder.reset()
+        return position
+
+    def close(self):
+        self.view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Corpus:
+    # The OCR text of every K-number packed into a few large segment files,
+    # one series per year, with a K-number -> (segment, offset, length) index
+    # in sqlite.  Text is only ever appended to the newest segment of its
+    # year; a document OCRed again is appended once more and its old bytes
+    # stay dead until the year is compacted.  Reads go through mmap, so a
+    # document is a slice of the mapping and nothing is opened per K-number.
+    # Safe to share between threads, each process needs its own instance
+    def __init__(self, folder=CORPUS_FOLDER, segmentBytes=default_segment_size * 1024 * 1024):
+        self.folder = folder
+        self.segmentBytes = segmentBytes
+        self.lock = threading.Lock()
+        self.maps = {}
+        os.makedirs(folder, exist_ok=True)
+        self.cnx = sqlite3.connect(os.path.join(folder, 'index.db'), check_same_thread=False)
+        self.cnx.execute('''CREATE TABLE IF NOT EXISTS documents (
+            k_number TEXT PRIMARY KEY,
+            segment TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            source_mtime REAL,
+            source_size INTEGER)''')
+        self.cnx.execute('CREATE INDEX IF NOT EXISTS documents_segment ON documents(segment)')
+        self.cnx.execute('''CREATE TABLE IF NOT EXISTS segments (
+            name TEXT PRIMARY KEY,
+            year TEXT NOT NULL,
+            bytes INTEGER NOT NULL)''')
+        self.cnx.commit()
+
+    def _path(self, segment):
+        return os.path.join(self.folder, segment)
+
+    def _newestSegment(self, year, adding):
+        # the segment of year to append adding bytes to, a new one when the
+        # newest is full
+        row = self.cnx.execute('SELECT name, bytes FROM segments WHERE year = ? ORDER BY name DESC LIMIT 1',
+                               (year,)).fetchone()
+        if row is not None and (row[1] == 0 or row[1] + adding <= self.segmentBytes):
+            return row[0]
+        number = int(row[0][len(year) + 1:-len('.seg')]) + 1 if row is not None else 0
+        name = f'{year}-{number:04d}.seg'
+        while os.path.exists(self._path(name)):
+            number += 1
+            name = f'{year}-{number:04d}.seg'
+        self.cnx.execute('INSERT INTO segments VALUES (?, ?, 0)', (name, year))
+        return name
+
+    def add(self, k_number, year, text, source_mtime=None, source_size=None, commit=True):
+        data = text.encode('utf-8')
+        with self.lock:
+            segment = self._newestSegment(year, len(data))
+            with open(self._path(segment), 'ab') as fh:
+                offset = fh.tell()
+                fh.write(data)
+            self.cnx.execute('UPDATE segments SET bytes = ? WHERE name = ?', (offset + len(data), segment))
+            self.cnx.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)',
+                             (k_number, segment, offset, len(data), source_mtime, source_size))
+            if commit:
+                self.cnx.commit()
+
+    def commit(self):
+        with self.lock:
+            self.cnx.commit()
+
+    def locate(self, k_number):
+        # (segment, offset, length) of k_number, None if it isn't packed
+        with self.lock:
+            return self.cnx.execute('SELECT segment, offset, length FROM documents WHERE k_number = ?',
+                                    (k_number,)).fetchone()
+
+    def entries(self):
+        # {k_number: (segment, offset, length)}, read once so scans do no
+        # per document queries
+        with self.lock:
+            rows = self.cnx.execute('SELECT k_number, segment, offset, length FROM documents').fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def _map(self, segment, end):
+        mapped = self.maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            # new segment, or one that has grown since it was mapped
+            if mapped is not None:
+                mapped.close()
+            with open(self._path(segment), 'rb') as fh:
+                mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = mapped
+        return mapped
+
+    def view(self, k_number, location=None):
+        # the utf-8 bytes of k_number as a memoryview into the segment
+        # mapping, None if it isn't packed
+        if location is None:
+            location = self.locate(k_number)
+            if location is None:
+                return None
+        segment, offset, length = location
+        if length == 0:
+            # an empty out_text.txt, its segment may be empty too and an
+            # empty file cannot be mapped
+            return memoryview(b'')
+        return memoryview(self._map(segment, offset + length))[offset:offset + length]
+
+    def text(self, k_number, location=None):
+        view = self.view(k_number, location)
+        if view is None:
+            return None
+        text = str(view, 'utf-8')
+        view.release()
+        return text
+
+    def stream(self, k_number, location=None):
+        # k_number as a TextView, None if it isn't packed
+        view = self.view(k_number, location)
+        if view is None:
+            return None
+        return TextView(view)
+
+    def isCurrent(self, k_number, mtime, size):
+        with self.lock:
+            row = self.cnx.execute('SELECT source_mtime, source_size FROM documents WHERE k_number = ?',
+                                   (k_number,)).fetchone()
+        return row is not None and row[0] == mtime and row[1] == size
+
+    def pack(self, folder=PDF_FOLDER):
+        # append every out_text.txt under folder that is new or changed
+        # since it was packed, returns how many were
+        count = 0
+        for root, dirs, files in os.walk(folder):
+            k_number = os.path.basename(root)
+            if not re.match(r"K\d{6}", k_number) or 'out_text.txt' not in files:
+                continue
+            path = os.path.join(root, 'out_text.txt')
+            st = os.stat(path)
+            if self.isCurrent(k_number, st.st_mtime, st.st_size):
+                continue
+            with open(path) as fh:
+                self.add(k_number, os.path.basename(os.path.dirname(root)), fh.read(),
+                         st.st_mtime, st.st_size, commit=False)
+            count += 1
+            if count % insert_batch == 0:
+                self.commit()
+        self.commit()
+        return count
+
+    def deadBytes(self):
+        # {year: bytes in its segments no document points at any more}
+        with self.lock:
+            rows = self.cnx.execute('''SELECT segments.year, sum(segments.bytes) - coalesce(sum(live.bytes), 0)
+                FROM segments LEFT JOIN (SELECT segment, sum(length) AS bytes FROM documents GROUP BY segment) live
+                ON segments.name = live.segment GROUP BY segments.year''').fetchall()
+        return dict(rows)
+
+    def compact(self, year):
+        # rewrite the segments of year with only their live documents, in
+        # K-number order, then drop the old segment files.  The old files
+        # are still there while the new ones are named, so names never clash
+        with self.lock:
+            old = [row[0] for row in self.cnx.execute('SELECT name FROM segments WHERE year = ?', (year,))]
+            documents = self.cnx.execute(f'''SELECT k_number, segment, offset, length, source_mtime, source_size
+                FROM documents WHERE segment IN ({','.join('?' * len(old))}) ORDER BY k_number''', old).fetchall()
+            for segment in old:
+                mapped = self.maps.pop(segment, None)
+                if mapped is not None:
+                    mapped.close()
+            self.cnx.execute('DELETE FROM segments WHERE year = ?', (year,))
+            for k_number, segment, offset, length, source_mtime, source_size in documents:
+                with open(self._path(segment), 'rb') as fh:
+                    fh.seek(offset)
+                    data = fh.read(length)
+                target = self._newestSegment(year, length)
+                with open(self._path(target), 'ab') as fh:
+                    newOffset = fh.tell()
+                    fh.write(data)
+                self.cnx.execute('UPDATE segments SET bytes = ? WHERE name = ?', (newOffset + length, target))
+                self.cnx.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)',
+                                 (k_number, target, newOffset, length, source_mtime, source_size))
+            self.cnx.commit()
+            for segment in old:
+                os.remove(self._path(segment))
+
+    def close(self):
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps = {}
+        self.cnx.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="fda-corpus",
+        description='Pack the out_text.txt files of every K-number folder into per year segment files'
+    )
+    parser.add_argument('folder', nargs='?', default=PDF_FOLDER, help='folder of K-number folders')
+    parser.add_argument('--corpus', action='store', default=CORPUS_FOLDER, help='folder holding the segments and their index')
+    parser.add_argument('--segment-size', action='store', type=int, default=default_segment_size, help='MB a segment may grow to')
+    parser.add_argument('--compact', action='store', type=float, nargs='?', const=0.2, metavar='SHARE',
+                        help='rewrite the segments of every year more than this share dead')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if not os.path.exists(args.folder):
+        LOGGER.error(f"Cant find the folder {args.folder}")
+        sys.exit(1)
+    corpus = Corpus(args.corpus, args.segment_size * 1024 * 1024)
+    LOGGER.info(f'{corpus.pack(args.folder)} documents packed')
+    if args.compact is not None:
+        with corpus.lock:
+            sizes = dict(corpus.cnx.execute('SELECT year, sum(bytes) FROM segments GROUP BY year').fetchall())
+        for year, dead in sorted(corpus.deadBytes().items()):
+            if dead > 0 and dead >= args.compact * sizes[year]:
+                LOGGER.info(f'Compacting {year}, {dead} dead bytes')
+                corpus.compact(year)
+    corpus.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import html
+import logging
+import re
+import sys
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from fdaHttp import AsyncTokenBucket, DEFAULT_RATES, RETRY_STATUS, default_backoff, default_rate, default_retries, default_timeout, parseRates
+
+
+LOGGER = logging.getLogger('fda')
+
+BASE_510K_URL = 'https://www.accessdata.fda.gov/scripts/cdrh/cfdocs/cfPMN/pmn.cfm?ID='
+
+default_concurrency = 32
+
+# the first <a href=...> whose text contains Summary, the same anchor
+# soup("a", text=re.compile(r'Summary')) finds, without building the tree
+SUMMARY_ANCHOR = re.compile(
+    r'<a\b[^>]*?\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))[^>]*>([^<]*Summary[^<]*)</a\s*>',
+    re.IGNORECASE | re.DOTALL
+)
+
+
+def parseSummaryUrl(page):
+    # the summary pdf link in a pmn.cfm page, None if there isn't one
+    for match in SUMMARY_ANCHOR.finditer(page):
+        if 'Summary' not in match.group(4):
+            continue  # the pattern is case insensitive for the tags only
+        href = match.group(1) or match.group(2) or match.group(3) or ''
+        href = html.unescape(href).strip()
+        return href if href != '' else None
+    return None
+
+
+class SummaryCrawler:
+    # resolves the summary pdf links of many K-numbers concurrently, at most
+    # concurrency requests in flight and the per-host rate limits of fdaHttp
+    def __init__(self, baseUrl=BASE_510K_URL, concurrency=default_concurrency, timeout=default_timeout,
+                 retries=default_retries, backoff=default_backoff, rates=None):
+        self.baseUrl = baseUrl
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.retries = retries
+        self.backoff = backoff
+        self.rates = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+
+    async def _get(self, session, bucket, url):
+        for attempt in range(self.retries + 1):
+            await bucket.acquire()
+            try:
+                async with session.get(url) as response:
+                    if response.status not in RETRY_STATUS:
+                        response.raise_for_status()
+                        return await response.text(errors='replace')
+                    retry_after = response.headers.get('Retry-After', '')
+                    delay = float(retry_after) if retry_after.isdigit() else self.backoff * (2 ** attempt)
+                    error = f'status {response.status}'
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                delay = self.backoff * (2 ** attempt)
+                error = repr(e)
+            if attempt < self.retries:
+                await asyncio.sleep(delay)
+        raise aiohttp.ClientError(f'{url} failed after {self.retries} retries, {error}')
+
+    async def _resolve(self, session, semaphore, bucket, k_number):
+        async with semaphore:
+            try:
+                page = await self._get(session, bucket, f'{self.baseUrl}{k_number}')
+            except aiohttp.ClientError as e:
+                LOGGER.error(f'{k_number} summary page not fetched, {e}')
+                return None
+        return k_number, parseSummaryUrl(page)
+
+    async def resolveAll(self, k_numbers):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        host = urlsplit(self.baseUrl).hostname
+        bucket = AsyncTokenBucket(self.rates.get(host, default_rate))
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=self.timeout) as session:
+            results = await asyncio.gather(*[self._resolve(session, semaphore, bucket, k) for k in k_numbers])
+        return dict(result for result in results if result is not None)
+
+    def resolve(self, k_numbers):
+        # {k_number: pdf url or None} for a whole openFDA page at once.  A
+        # K-number whose page could not be fetched is left out, None means
+        # the page has no summary link, so callers fetch it again themselves
+        return asyncio.run(self.resolveAll(k_numbers))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="fda-crawl",
+        description='Resolve the summary pdf links of 510(k) numbers'
+    )
+    parser.add_argument('k_numbers', nargs='+', help='K-numbers to resolve')
+    parser.add_argument('--base-url', action='store', default=BASE_510K_URL, help='summary page url the K-number is appended to')
+    parser.add_argument('--concurrency', action='store', type=int, default=default_concurrency, help='requests in flight')
+    parser.add_argument('--rate', action='append', metavar='HOST=RPS', help='requests per second allowed to a host, may be repeated')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    crawler = SummaryCrawler(args.base_url, args.concurrency, rates=parseRates(args.rate))
+    resolved = crawler.resolve(args.k_numbers)
+    for k_number in args.k_numbers:
+        url = resolved[k_number] if k_number in resolved else 'failed'
+        sys.stdout.write(f'{k_number} {url or "-"}\n')
+
+
+if __name__ == '__main__':
+    main()
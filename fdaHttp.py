@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+LOGGER = logging.getLogger('fda')
+
+# requests per second allowed to each host.  openFDA allows 240 requests a
+# minute per key, the CDRH pages have no published limit so stay polite
+DEFAULT_RATES = {
+    'api.fda.gov': 4.0,
+    'www.accessdata.fda.gov': 5.0,
+}
+default_rate = 5.0
+
+default_timeout = (10, 60)  # connect, read
+default_retries = 5
+default_backoff = 1.0
+default_pool_size = 16
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    # allows rate requests a second on average with bursts of up to burst
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AsyncTokenBucket(TokenBucket):
+    # the same bucket for coroutines, waits without blocking the event loop
+    def __init__(self, rate, burst=None):
+        super().__init__(rate, burst)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        while True:
+            async with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+class RateLimitedRetry(Retry):
+    # a Retry that takes a token from the host's bucket after each backoff,
+    # so retries count against the rate limit like first attempts.  bucket
+    # is a function of the host
+    def __init__(self, *args, bucket=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket = bucket
+        self.host = None
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.bucket = self.bucket
+        retry.host = self.host
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        if _pool is not None:
+            retry.host = _pool.host
+        return retry
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.bucket is not None and self.host is not None:
+            self.bucket(self.host).acquire()
+
+
+class HttpClient:
+    # one keep-alive connection pool per host shared by all threads, with
+    # timeouts, retry with exponential backoff on 429/5xx (honouring
+    # Retry-After) and a token bucket rate limit per host, retries included
+    def __init__(self, timeout=default_timeout, retries=default_retries, backoff=default_backoff,
+                 pool_size=default_pool_size, rates=None):
+        self.timeout = timeout
+        self.rates = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.buckets = {}
+        self.lock = threading.Lock()
+        retry = RateLimitedRetry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUS,
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+            bucket=self.bucket,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def bucket(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rates.get(host, default_rate))
+            return self.buckets[host]
+
+    def get(self, url, **kwargs):
+        # raises requests.RequestException once the retries are used up
+        self.bucket(urlsplit(url).hostname).acquire()
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.get(url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+def parseRates(values):
+    # ['api.fda.gov=4', ...] from the command line into {host: rate}
+    rates = {}
+    for value in values or []:
+        host, _, rate = value.partition('=')
+        rates[host.strip()] = float(rate)
+    return rates
@@ -0,0 +1,146 @@
+import logging
+import os
+import pickle
+import re
+from array import array
+from collections import defaultdict
+
+
+LOGGER = logging.getLogger('fda_search')
+
+INDEX_FILE = 'fda_index.pickle'
+
+# every whitespace character becomes one space, so positions do not move
+WHITESPACE = str.maketrans('\t\n\r\x0b\x0c', '     ')
+
+
+def normalize(text):
+    return text.lower().translate(WHITESPACE)
+
+
+def trigrams(text):
+    return [text[i:i + 3] for i in range(len(text) - 2)]
+
+
+def requiredTrigrams(term, cutoff):
+    # fewest trigrams of term a document must contain for
+    # fuzz.partial_ratio(term, document) > cutoff to be possible.
+    # partial_ratio scores the best len(term) window of the document as
+    # 2*M/(2*len(term)) where M characters are matched in order.  Each of the
+    # len(term) - M unmatched term characters breaks at most 3 of the term's
+    # trigrams and each of the as many inserted characters at most 2.  Scores
+    # are rounded before the comparison.  Windows cut short by the end
+    # of the document, a term split by its last few characters, are not
+    # covered
+    m = len(term)
+    need = m - 2
+    for matched in range(m + 1):
+        if 100 * matched / m >= cutoff + 0.5:
+            need = min(need, (m - 2) - 5 * (m - matched))
+    return need
+
+
+class TrigramIndex:
+    # A character trigram index over the OCR text of every K-number folder.
+    # Built once and then updated with only the folders that are new or whose
+    # out_text.txt changed; a changed document gets a new id and the old one
+    # is dropped the next time the index is compacted
+    def __init__(self):
+        self.docs = {}         # k_number -> (doc id, path, mtime, size)
+        self.names = []        # doc id -> k_number, None once superseded
+        self.postings = defaultdict(lambda: array('I'))
+        self.dead = 0
+
+    @staticmethod
+    def load(path=INDEX_FILE):
+        if not os.path.exists(path):
+            return TrigramIndex()
+        with open(path, 'rb') as fh:
+            docs, names, postings, dead = pickle.load(fh)
+        index = TrigramIndex()
+        index.docs = docs
+        index.names = names
+        index.postings.update(postings)
+        index.dead = dead
+        return index
+
+    def save(self, path=INDEX_FILE):
+        temp = path + '.tmp'
+        with open(temp, 'wb') as fh:
+            pickle.dump((self.docs, self.names, dict(self.postings), self.dead), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)
+
+    def add(self, k_number, path, text):
+        st = os.stat(path)
+        if k_number in self.docs:
+            self.names[self.docs[k_number][0]] = None
+            self.dead += 1
+        doc_id = len(self.names)
+        self.names.append(k_number)
+        self.docs[k_number] = (doc_id, path, st.st_mtime, st.st_size)
+        for gram in set(trigrams(normalize(text))):
+            self.postings[gram].append(doc_id)
+
+    def isCurrent(self, k_number, path):
+        entry = self.docs.get(k_number)
+        if entry is None:
+            return False
+        st = os.stat(path)
+        return entry[1] == path and entry[2] == st.st_mtime and entry[3] == st.st_size
+
+    def update(self, folder):
+        # index every new or changed out_text.txt under folder, returns how
+        # many documents were (re)indexed
+        count = 0
+        for root, dirs, files in os.walk(folder):
+            k_number = os.path.basename(root)
+            if not re.match(r"K\d{6}", k_number) or 'out_text.txt' not in files:
+                continue
+            path = os.path.join(root, 'out_text.txt')
+            if self.isCurrent(k_number, path):
+                continue
+            with open(path) as fh:
+                self.add(k_number, path, fh.read())
+            count += 1
+        if self.dead > len(self.docs) // 5:
+            self.compact()
+        return count
+
+    def compact(self):
+        # renumber the live documents and rebuild the postings without the
+        # superseded ones
+        renumber = {}
+        names = []
+        for old_id, k_number in enumerate(self.names):
+            if k_number is not None:
+                renumber[old_id] = len(names)
+                names.append(k_number)
+        postings = defaultdict(lambda: array('I'))
+        for gram, ids in self.postings.items():
+            live = array('I', (renumber[i] for i in ids if i in renumber))
+            if len(live) > 0:
+                postings[gram] = live
+        self.docs = {k: (renumber[v[0]],) + v[1:] for k, v in self.docs.items()}
+        self.names = names
+        self.postings = postings
+        self.dead = 0
+
+    def candidates(self, term, cutoff):
+        # the K-numbers that can score above cutoff against term, or None
+        # when the term is too short or the cutoff too low to rule any out
+        term = normalize(term)
+        need = requiredTrigrams(term, cutoff)
+        if need <= 0:
+            return None
+        weights = defaultdict(int)
+        for gram in trigrams(term):
+            weights[gram] += 1
+        counts = defaultdict(int)
+        for gram, weight in weights.items():
+            for doc_id in self.postings.get(gram, ()):
+                counts[doc_id] += weight
+        found = {self.names[doc_id] for doc_id, count in counts.items()
+                 if count >= need and self.names[doc_id] is not None}
+        # partial_ratio turns around for a document shorter than the term
+        found.update(k for k, entry in self.docs.items() if entry[3] < len(term))
+        return found
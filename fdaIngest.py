@@ -0,0 +1,156 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import zipfile
+
+import ijson
+
+from fdaHttp import HttpClient
+
+
+LOGGER = logging.getLogger('fda')
+
+# the full 510(k) dataset from https://open.fda.gov/apis/downloads/
+BULK_510K_URL = 'https://download.open.fda.gov/device/510k/device-510k-0001-of-0001.json.zip'
+BULK_510K_FILE = 'data/device-510k-0001-of-0001.json.zip'
+WORK_DB = 'data/work.db'
+
+insert_batch = 1000
+
+
+class WorkQueue:
+    # the local list of 510(k) hits still to be crawled.  Each row keeps the
+    # openFDA record as json, so the crawler never needs the API to page
+    # through them.  status is pending, done, skipped (no summary pdf) or
+    # failed.  Safe to share between the threads of the pipeline
+    def __init__(self, path=WORK_DB):
+        self.lock = threading.Lock()
+        self.cnx = sqlite3.connect(path, check_same_thread=False)
+        self.cnx.execute('''CREATE TABLE IF NOT EXISTS work_queue (
+            k_number TEXT PRIMARY KEY,
+            decision_date TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            hit TEXT NOT NULL)''')
+        self.cnx.execute('CREATE INDEX IF NOT EXISTS work_queue_status ON work_queue(status)')
+        self.cnx.execute('CREATE INDEX IF NOT EXISTS work_queue_decision_date ON work_queue(decision_date)')
+        self.cnx.commit()
+
+    def add(self, hits):
+        # hits already queued are left alone, returns how many were new
+        rows = [(hit['k_number'], hit.get('decision_date'), json.dumps(hit)) for hit in hits]
+        with self.lock:
+            before = self.cnx.total_changes
+            self.cnx.executemany('INSERT OR IGNORE INTO work_queue (k_number, decision_date, hit) VALUES (?, ?, ?)', rows)
+            self.cnx.commit()
+            return self.cnx.total_changes - before
+
+    def pending(self, limit, after=0, since=None):
+        # the next limit pending hits past rowid after, as (rowid, hit).
+        # since limits them to clearances decided on or after that date
+        query = "SELECT rowid, hit FROM work_queue WHERE status = 'pending' AND rowid > ?"
+        params = [after]
+        if since is not None:
+            query += ' AND decision_date >= ?'
+            params.append(since)
+        with self.lock:
+            rows = self.cnx.execute(query + ' ORDER BY rowid LIMIT ?', params + [limit]).fetchall()
+        return [(rowid, json.loads(hit)) for rowid, hit in rows]
+
+    def markDone(self, k_number, status='done'):
+        with self.lock:
+            self.cnx.execute('UPDATE work_queue SET status = ? WHERE k_number = ?', (status, k_number))
+            self.cnx.commit()
+
+    def retryFailed(self):
+        # failed hits go back to pending for the next crawl, returns how
+        # many did
+        with self.lock:
+            before = self.cnx.total_changes
+            self.cnx.execute("UPDATE work_queue SET status = 'pending' WHERE status = 'failed'")
+            self.cnx.commit()
+            return self.cnx.total_changes - before
+
+    def counts(self):
+        with self.lock:
+            return dict(self.cnx.execute('SELECT status, count(*) FROM work_queue GROUP BY status').fetchall())
+
+    def close(self):
+        self.cnx.close()
+
+
+def iterSummaries(zipPath):
+    # streams the records of the dump, never holding more than one in memory
+    with zipfile.ZipFile(zipPath) as zf:
+        for member in zf.namelist():
+            if not member.endswith('.json'):
+                continue
+            with zf.open(member) as stream:
+                for hit in ijson.items(stream, 'results.item', use_float=True):
+                    if hit.get('statement_or_summary') == 'Summary':
+                        yield hit
+
+
+def ingest(zipPath, workQueue):
+    total = 0
+    added = 0
+    batch = []
+    for hit in iterSummaries(zipPath):
+        batch.append(hit)
+        if len(batch) >= insert_batch:
+            added += workQueue.add(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        added += workQueue.add(batch)
+        total += len(batch)
+    return total, added
+
+
+def download(url, path):
+    http = HttpClient()
+    response = http.get(url, stream=True)
+    with open(path, 'wb') as fh:
+        for chunk in response.iter_content(chunk_size=1 << 20):
+            fh.write(chunk)
+    http.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="fda-ingest",
+        description='Load the openFDA 510(k) bulk download into the local work queue'
+    )
+    parser.add_argument('file', nargs='?', default=BULK_510K_FILE, help='the device-510k json zip file')
+    parser.add_argument('-d', '--download', action='store_true', help=f'fetch the file from {BULK_510K_URL} first')
+    parser.add_argument('--work-db', action='store', default=WORK_DB, help='work queue database')
+    parser.add_argument('--retry-failed', action='store_true', help='only queue the hits that failed again, no file is read')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.retry_failed:
+        workQueue = WorkQueue(args.work_db)
+        LOGGER.info(f'{workQueue.retryFailed()} failed hits pending again')
+        LOGGER.info(f'Work queue {workQueue.counts()}')
+        workQueue.close()
+        return
+
+    if args.download:
+        LOGGER.info(f'Downloading {BULK_510K_URL}')
+        download(BULK_510K_URL, args.file)
+    if not os.path.exists(args.file):
+        LOGGER.error(f"Cant find the file {args.file}")
+        sys.exit(1)
+
+    workQueue = WorkQueue(args.work_db)
+    total, added = ingest(args.file, workQueue)
+    LOGGER.info(f'{total} 510(k)s with a summary, {added} new in the work queue')
+    LOGGER.info(f'Work queue {workQueue.counts()}')
+    workQueue.close()
+
+
+if __name__ == '__main__':
+    main()
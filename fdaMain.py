@@ -1,22 +1,34 @@
 import argparse
+import hashlib
 import logging
 import os
 import re
+import shutil
+import signal
 import sys
 import time
+from contextlib import nullcontext
 from pathlib import Path
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkdtemp
 import json
 
-import fitz
-import pytesseract
 import requests
-from bs4 import BeautifulSoup, NavigableString
-from fuzzywuzzy import fuzz, process
-from PIL import Image
 import redis
 
+from fdaCrawl import SummaryCrawler, parseSummaryUrl, default_concurrency
+from fdaHttp import HttpClient, parseRates, default_pool_size, default_retries, default_timeout
+from fdaIngest import WorkQueue, WORK_DB
+from fdaManifest import Manifest, MANIFEST_DB
+from fdaMatch import TermMatcher
+from fdaMetrics import Metrics
+from fdaMetadata import MetadataStore, METADATA_DB
+from fdaOcr import OcrEngine, RENDER_MODES, default_low_dpi, default_min_confidence
+from fdaPdfCache import PdfCache, PDF_CACHE_FOLDER, default_cache_size
+from fdaProfile import Profiler, PROFILE_FOLDER, default_report_interval, default_sample_interval, default_slowest
+from fdaPipeline import Pipeline, WorkItem, default_queue_size
+from fdaRedisQueue import LeasedQueue, LeaseKeeper, REDIS_URL, QUEUE_NAME, default_lease, default_max_attempts, workerName
 from smart_open import smart_open
+from stopFDA import Controller, Progress, RUN, catchSIGINT, stop_state_key
 
 
 
@@ -45,6 +57,7 @@ BE_Words = [
     'biodegradable',
     'absorbable'
 ]
+BE_MATCHER = TermMatcher(BE_Words, cutoff=80)
 
 
 OFDA_DEVICE = 'https://api.fda.gov/device'
@@ -59,12 +72,16 @@ PDF_FOLDER = 'pdf/'
 
 BASE_510K_URL = 'https://www.accessdata.fda.gov/scripts/cdrh/cfdocs/cfPMN/pmn.cfm?ID='
 
-stop_state_key = "STOPSTATE"
 skip_count_key = "SKIPCOUNT"
 
 default_limit=500
+default_claim = 4
+# seconds between looks at a redis queue whose hits are all leased
+claim_poll = 5
 
-killed = False
+LOGGER = logging.getLogger('fda')
+METRICS = Metrics('fda')
+PROFILER = Profiler('fda')
 
 
     
@@ -72,9 +89,464 @@ def getYear(k):
     match = re.search('K(\d\d)\d{4}',k)
     twoDigits = match.groups()[0]
     return ('19' if int(twoDigits) > 75 else '20') + twoDigits
-    
+
+
+def fetchHits(http, skip_count, limit, since=None):
+    # (hits, total number of hits of the search)
+    search = HAS_SUMMARY
+    if since is not None:
+        search += f'+AND+decision_date:[{since}+TO+{time.strftime("%Y-%m-%d")}]'
+    with METRICS.timed('openfda_query'):
+        response = http.get(f'{OFDA_DEVICE + OFDA_510K + SEARCH  + search}&limit={limit}&skip={skip_count}')
+    METRICS.inc('bytes_total', len(response.content), stage='openfda_query')
+    page = response.json()
+    return page['results'], page.get('meta', {}).get('results', {}).get('total')
+
+
+def findSummaryUrl(http, k_number):
+    # scrape the CDRH page for the link to the summary pdf, None if there isn't one
+    with METRICS.timed('summary_page'):
+        r_510K = http.get(f'{BASE_510K_URL}{k_number}')
+    METRICS.inc('bytes_total', len(r_510K.content), stage='summary_page')
+    return parseSummaryUrl(r_510K.text)
+
+
+def makeDataPath(k_number):
+    yearPath = os.path.join(PDF_FOLDER, f'Submit_Year_{getYear(k_number)}')
+    os.makedirs(yearPath, exist_ok=True)
+    dataPath = os.path.join(yearPath, k_number)
+    os.makedirs(dataPath, exist_ok=True)
+    return dataPath
+
+
+def fetchPdf(http, pdf_url, hit, pdfCache=None):
+    # the summary pdf bytes, from the cache when it has them.  A downloaded
+    # pdf is added to the cache
+    k_number = hit['k_number']
+    content = pdfCache.get(k_number) if pdfCache is not None else None
+    if content is None:
+        if pdf_url is None:
+            raise FileNotFoundError(f'{k_number} is no longer in the pdf cache')
+        with METRICS.timed('download'):
+            content = http.get(pdf_url).content
+        METRICS.inc('bytes_total', len(content), stage='download')
+        if pdfCache is not None:
+            pdfCache.put(k_number, content, hit)
+    return content
+
+
+def downloadPdf(http, pdf_url, dataPath, hit, pdfCache=None):
+    #get the summary pdf and save it, returns its path and sha256
+    content = fetchPdf(http, pdf_url, hit, pdfCache)
+    pdfPath = os.path.join(dataPath,f"{hit['k_number']}.pdf")
+    with open(pdfPath, 'wb') as pdf:
+        pdf.write(content)
+    return pdfPath, hashlib.sha256(content).hexdigest()
+
+
+def writeResults(hit, dataPath, text, page_count, hitTextOutput, metadata=None):
+    k_number = hit['k_number']
+    ocrTextFilename = os.path.join(dataPath,'out_text.txt')
+    with open(ocrTextFilename, "w") as ocrOutput:
+        ocrOutput.write(text)
+
+    # use fuzz package to search for terms in the list and deal with incorrect OCR
+    isFileHeaderOutput = False
+    with open(ocrTextFilename) as ocrInput:
+        lines = ocrInput.read()
+    # look for predicate information'
+    results = re.findall(r'K\d{6}',lines)
+    if results and len(results) != 0:
+        all = set([x.strip() for x in results])
+        all.discard(k_number)
+        predicates = list(all)
+        if predicates and len(predicates) != 0:
+            hit['predicates'] = predicates
+
+    with METRICS.timed('match'):
+        hits = BE_MATCHER.hits(lines)
+    for item, ratio in hits:
+        if not isFileHeaderOutput:
+            hitTextOutput.write(f'File {k_number} {page_count} pages\n')
+            hitTextOutput.write(f"    Product Code = {hit['product_code']}\n")
+            hitTextOutput.write(f"    Device name = {hit['device_name']}\n")
+            isFileHeaderOutput = True
+        hitTextOutput.write(    f"        Has {item} with ratio {ratio}\n")
+        hitTextOutput.flush()
+
+    # metadata file
+    product_code = hit.get('product_code','???')
+    device_name = hit.get('device_name','no name')
+    advisory_committee = hit.get('advisory_committee', 'XX')
+    advisory_committee_desc = hit.get('advisory_committee_description', 'no description')
+    applicant = hit.get('applicant', 'no applicant')
+    all510Kfilaname = os.path.join(dataPath, 'data.txt')
+    hit['openfda']['fei_number'] = 'see openFDA'
+    hit['openfda']['registration_number'] = 'see openFDA'
+    with open(all510Kfilaname,'w') as all510KsFH:
+        all510KsFH.write(f'Product Code: {product_code}\n')
+        all510KsFH.write(f'Applicant:    {applicant}\n')
+        all510KsFH.write(f'Device Name:  {device_name}\n')
+        all510KsFH.write(f'Advisory Committee ({advisory_committee}): {advisory_committee_desc}')
+        all510KsFH.write(json.dumps(hit,indent=4))
+    if metadata is not None:
+        with METRICS.timed('metadata_write'):
+            metadata.put(hit, dataPath)
+
+
+def countPages(stats, text):
+    for kind, count in stats.items():
+        METRICS.inc('pages_total', count, kind=kind)
+    METRICS.inc('bytes_total', len(text.encode('utf-8')), stage='ocr')
+
+
+def logProcessed(k_number, page_count, seconds, stats):
+    LOGGER.info(f'File {k_number} {page_count} pages, processing time is {seconds:.0f} seconds, '
+                f'{stats["text"]} from text layer, {stats["ocr"]} OCRed, {stats["rerender"]} re-rendered, '
+                f'{stats["skip"]} skipped')
+
+
+def profiled(stage):
+    # a pipeline stage whose time goes to its item's K-number with --profile
+    def run(item):
+        with PROFILER.document(item.k_number):
+            return stage(item)
+    return run
+
+
+def isWanted(hit, manifest, ocr_version):
+    # False for hits without a summary and ones the manifest already has
+    if hit.get('statement_or_summary', 'missing') == 'missing':
+        return False
+    return not manifest.isComplete(hit['k_number'], ocr_version)
+
+
+def isCached(pdfCache, k_number):
+    return pdfCache is not None and pdfCache.lookup(k_number) is not None
+
+
+def processHit(hit, hitTextOutput, ocrEngine, http, manifest, ocr_version=None, pdf_urls=None,
+               pdfCache=None, downloadOnly=False, metadata=None):
+    # pdf_urls holds the summary links already resolved by the async crawler.
+    # Returns 'done', or 'skipped' when there is no summary pdf.  ocr_version
+    # is given when documents read by another engine version are redone.
+    # downloadOnly just puts the pdf in the cache and returns 'downloaded'
+    k_number = hit['k_number']
+    if hit.get('statement_or_summary', 'missing') == 'missing':
+        return 'skipped'
+    if manifest.isComplete(k_number, ocr_version):
+        LOGGER.debug(f'{k_number} already in the manifest')
+        return 'done'
+    if isCached(pdfCache, k_number):
+        pdf_url = None  # no need to look for it
+    elif pdf_urls is not None and k_number in pdf_urls:
+        pdf_url = pdf_urls[k_number]
+    else:
+        pdf_url = findSummaryUrl(http, k_number)
+    if pdf_url is None and not isCached(pdfCache, k_number):
+        return 'skipped'
+    if downloadOnly:
+        fetchPdf(http, pdf_url, hit, pdfCache)
+        return 'downloaded'
+    dataPath = makeDataPath(k_number)
+    pdfPath, pdf_sha256 = downloadPdf(http, pdf_url, dataPath, hit, pdfCache)
+
+    with TemporaryDirectory() as tempdir:
+        # Create a temporary directory to hold our temporary images.
+        # with --stream-pages pages are rendered as they are OCRed, and the
+        # rendering is timed as OCR
+        start = time.time()
+        with METRICS.timed('render'):
+            pages = ocrEngine.render(pdfPath, tempdir)
+        with METRICS.timed('ocr'):
+            texts, stats = ocrEngine.ocrPages(pages, k_number)
+        end = time.time()
+    os.remove(pdfPath)  # erase the pdf file for space saving
+    logProcessed(k_number, len(texts), end - start, stats)
+    countPages(stats, ''.join(texts))
+    writeResults(hit, dataPath, ''.join(texts), len(texts), hitTextOutput, metadata)
+    manifest.record(k_number, hit.get('decision_date'), pdf_sha256, ocrEngine.version)
+    return 'done'
+
+
+class ApiSource:
+    # pages of hits from the openFDA API, checkpointed as SKIPCOUNT in redis.
+    # The offset is kept here too since the pipeline reads ahead of the
+    # checkpoint.  A --since crawl is a different query, so it starts from
+    # the first hit and leaves SKIPCOUNT alone
+    def __init__(self, http, redisHandle, limit, since=None):
+        self.http = http
+        self.redisHandle = redisHandle
+        self.limit = limit
+        self.since = since
+        self.skip_count = 0 if since is not None else int(redisHandle.get(skip_count_key))
+        self.first = self.skip_count
+        self.total = None
+        self.finishedCount = 0
+
+    def nextPage(self):
+        try:
+            hits, self.total = fetchHits(self.http, self.skip_count, self.limit, self.since)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return []  # openFDA answers 404 past the last hit
+            raise
+        self.skip_count += self.limit
+        return hits
+
+    def checkpoint(self):
+        if self.since is None:
+            self.redisHandle.incrby(skip_count_key, self.limit)
+
+    def started(self, hit):
+        pass
+
+    def finished(self, hit, status):
+        self.finishedCount += 1
+
+    def remaining(self):
+        if self.total is None:
+            return None
+        return max(self.total - self.first - self.finishedCount, 0)
+
+    def close(self):
+        pass
+
+
+class QueueSource:
+    # pages of pending hits from the local work queue filled by fdaIngest,
+    # each hit is marked off as it is written
+    def __init__(self, workQueue, limit, since=None):
+        self.workQueue = workQueue
+        self.limit = limit
+        self.since = since
+        self.after = 0
+
+    def nextPage(self):
+        rows = self.workQueue.pending(self.limit, self.after, self.since)
+        if rows:
+            self.after = rows[-1][0]
+        return [hit for rowid, hit in rows]
+
+    def checkpoint(self):
+        pass
+
+    def finished(self, hit, status):
+        # an abandoned hit stays pending for the next run
+        if status != 'abandoned':
+            self.workQueue.markDone(hit['k_number'], status)
+
+    def started(self, hit):
+        pass
+
+    def remaining(self):
+        return self.workQueue.counts().get('pending', 0)
+
+    def close(self):
+        pass
+
+
+class RedisSource:
+    # hits leased from the redis queue fdaRedisQueue fills, claim at a time,
+    # so any number of workers can share one crawl.  The leases are renewed
+    # until each hit is written.  A failed hit is retried by whichever worker
+    # claims it next.  When every hit left is leased to other workers it
+    # waits, in case one of them dies and its hits come back
+    def __init__(self, queue, controller, claim=default_claim, worker=None):
+        self.queue = queue
+        self.controller = controller
+        self.claim = claim
+        self.worker = worker or workerName()
+        self.keeper = LeaseKeeper(queue, self.worker)
+
+    def nextPage(self):
+        while self.controller.startItem():
+            hits = self.queue.claim(self.worker, self.claim)
+            if len(hits) != 0:
+                self.keeper.hold(hit['k_number'] for hit in hits)
+                return hits
+            if self.queue.outstanding() == 0:
+                break
+            time.sleep(claim_poll)
+        return []
+
+    def checkpoint(self):
+        pass
+
+    def started(self, hit):
+        self.keeper.start(hit['k_number'])
+
+    def finished(self, hit, status):
+        k_number = hit['k_number']
+        self.keeper.drop(k_number)
+        if status == 'abandoned':
+            self.queue.release(self.worker, [k_number])
+        elif status == 'failed':
+            if self.queue.fail(self.worker, k_number) == 'dead':
+                LOGGER.error(f'{k_number} moved to the dead letter list')
+        elif not self.queue.ack(self.worker, k_number, status):
+            LOGGER.warning(f'{k_number} lease was lost, another worker may redo it')
+
+    def remaining(self):
+        return self.queue.outstanding()
+
+    def close(self):
+        released, failed = self.keeper.stop()
+        if released:
+            LOGGER.info(f'{released} unstarted hits given back to the queue')
+        if failed:
+            LOGGER.warning(f'{failed} hits in progress counted as failed')
+
+
+def resolvePage(crawler, hits, manifest, ocr_version=None, pdfCache=None):
+    # with the async crawler the summary links of a whole page are looked up
+    # at once, None without it so each hit fetches its own
+    if crawler is None:
+        return None
+    k_numbers = [hit['k_number'] for hit in hits if isWanted(hit, manifest, ocr_version)]
+    k_numbers = [k_number for k_number in k_numbers if not isCached(pdfCache, k_number)]
+    with METRICS.timed('summary_pages'):
+        return crawler.resolve(k_numbers)
+
+
+def runPipeline(args, source, controller, progress, out_file, ocrEngine, http, crawler, manifest, ocr_version, pdfCache,
+                metadata):
+    # same work as processHit, split into stages connected by bounded queues
+    # so network waits, rendering and OCR of different hits overlap.  In
+    # download mode only the first two stages run, filling the pdf cache.
+    # The controller is asked before each hit is submitted and before each
+    # of its stages
+    def scrape(item):
+        source.started(item.hit)
+        if item.hit.get('statement_or_summary', 'missing') == 'missing':
+            return False
+        if manifest.isComplete(item.k_number, ocr_version):
+            item.complete = True
+            return False
+        if isCached(pdfCache, item.k_number):
+            return True
+        if item.k_number in resolved:
+            item.pdf_url = resolved.pop(item.k_number)
+        else:
+            item.pdf_url = findSummaryUrl(http, item.k_number)
+        return item.pdf_url is not None
+
+    def download(item):
+        if downloadOnly:
+            fetchPdf(http, item.pdf_url, item.hit, pdfCache)
+            return
+        item.dataPath = makeDataPath(item.k_number)
+        item.pdfPath, item.pdf_sha256 = downloadPdf(http, item.pdf_url, item.dataPath, item.hit, pdfCache)
+
+    def render(item):
+        item.start = time.time()
+        if ocrEngine.render_mode == 'jpeg':
+            item.tempdir = mkdtemp()
+        with METRICS.timed('render'):
+            item.pages = ocrEngine.render(item.pdfPath, item.tempdir)
+
+    def ocr(item):
+        with METRICS.timed('ocr'):
+            texts, item.stats = ocrEngine.ocrPages(item.pages, item.k_number)
+        item.pages = []
+        item.text = ''.join(texts)
+        item.page_count = len(texts)
+        os.remove(item.pdfPath)  # erase the pdf file for space saving
+        if item.tempdir is not None:
+            shutil.rmtree(item.tempdir, ignore_errors=True)
+            item.tempdir = None
+        logProcessed(item.k_number, item.page_count, time.time() - item.start, item.stats)
+        countPages(item.stats, item.text)
+
+    def write(item):
+        if downloadOnly:
+            return
+        with smart_open(out_file, append=args.append, buffering=1) as hitTextOutput:
+            writeResults(item.hit, item.dataPath, item.text, item.page_count, hitTextOutput, metadata)
+        manifest.record(item.k_number, item.hit.get('decision_date'), item.pdf_sha256, ocrEngine.version)
+
+    def checkpoint(item):
+        source.checkpoint()
+
+    def done(item):
+        if item.abandoned:
+            status = 'abandoned'
+        elif item.failed:
+            status = 'failed'
+        elif item.dropped and not item.complete:
+            status = 'skipped'
+        elif downloadOnly and not item.complete:
+            status = 'downloaded'
+        else:
+            status = 'done'
+        source.finished(item.hit, status)
+        progress.item(status)
+        METRICS.inc('hits_total', status=status)
+
+    downloadOnly = args.mode == 'download'
+    stages = [
+        ('scrape', profiled(scrape), args.scrape_workers),
+        ('download', profiled(download), args.download_workers),
+    ]
+    if not downloadOnly:
+        stages += [
+            ('render', profiled(render), args.render_workers),
+            ('ocr', profiled(ocr), args.ocr_documents),
+        ]
+    pipeline = Pipeline(
+        stages,
+        profiled(write), checkpoint, queue_size=args.queue_size, done=done, gate=controller.continueItem
+    )
+    pipeline.start()
+    progress.depths = pipeline.depths
+
+    seq = 0
+    resolved = {}
+    try:
+        while True:
+            if not controller.startItem():
+                print("Exiting. Run stopFDA.py resume, then restart with --append to continue")
+                return
+            hits = source.nextPage()
+            if len(hits) == 0:
+                break
+            progress.page()
+            resolved.update(resolvePage(crawler, hits, manifest, ocr_version, pdfCache) or {})
+            for n, hit in enumerate(hits):
+                if not controller.startItem():
+                    print("Exiting. Run stopFDA.py resume, then restart with --append to continue")
+                    return
+                pipeline.submit(WorkItem(seq, hit, n == len(hits) - 1))
+                seq += 1
+    finally:
+        pipeline.close()
+        progress.depths = None
+
+
+def runCachedOcr(out_file, append, ocrEngine, manifest, pdfCache, controller, progress, metadata):
+    # OCR again every cached pdf the manifest has not seen read by this
+    # engine version, without touching the network
+    for k_number, hit in pdfCache.entries():
+        if not controller.startItem():
+            print("Exiting. Run stopFDA.py resume, then restart with --append to continue")
+            break
+        if hit is None or manifest.isComplete(k_number, ocrEngine.version):
+            continue
+        with smart_open(out_file, append=append, buffering=1) as hitTextOutput:
+            try:
+                with PROFILER.document(k_number):
+                    result = processHit(hit, hitTextOutput, ocrEngine, None, manifest, ocrEngine.version,
+                                        pdfCache=pdfCache, metadata=metadata)
+            except FileNotFoundError as e:
+                LOGGER.error(str(e))
+                result = 'failed'
+        progress.item(result)
+        METRICS.inc('hits_total', status=result)
+
 
 def main(): 
+    # the servers can be pointed elsewhere, at bench/stubServer.py for one
+    global OFDA_DEVICE, BASE_510K_URL
 
     # check to see if this is a restart
     parser = argparse.ArgumentParser(
@@ -87,11 +559,53 @@ def main():
     parser.add_argument('-o', '--output', action='store', default='stdout', help='file to output to')
     parser.add_argument('-a', '--append', action='store_true', help='if output file not stdout, append to the file rather tan a new one')
     parser.add_argument('--log', action='store', default='fda_mine.log', help='logfile')
+    parser.add_argument('--source', action='store', choices=('api', 'queue', 'redis'), default='api', help='page through the openFDA API, the local work queue loaded by fdaIngest, or the shared redis queue loaded by fdaRedisQueue')
+    parser.add_argument('--work-db', action='store', default=WORK_DB, help='work queue database for --source queue')
+    parser.add_argument('--redis-url', action='store', default=REDIS_URL, help='redis server holding the stop state and the shared queue')
+    parser.add_argument('--queue', action='store', default=QUEUE_NAME, help='prefix of the shared queue keys for --source redis')
+    parser.add_argument('--claim', action='store', type=int, default=default_claim, help='hits a --source redis worker leases at a time')
+    parser.add_argument('--lease', action='store', type=int, default=default_lease, help='seconds a lease lasts without being renewed')
+    parser.add_argument('--max-attempts', action='store', type=int, default=default_max_attempts, help='claims before a hit goes to the dead letter list')
+    parser.add_argument('--metrics-port', action='store', type=int, help='serve per stage timings in the Prometheus text format on this port')
+    parser.add_argument('--metrics-file', action='store', help='keep rewriting the Prometheus metrics to this file, for the node_exporter textfile collector')
+    parser.add_argument('--profile', action='store', nargs='?', const=PROFILE_FOLDER, metavar='FOLDER', help='sample the stack of every stage, rewriting pstats files and the slowest K-numbers with their stage breakdown to this folder')
+    parser.add_argument('--profile-interval', action='store', type=float, default=default_sample_interval, help='seconds between stack samples with --profile')
+    parser.add_argument('--profile-top', action='store', type=int, default=default_slowest, help='K-numbers in the --profile slowest documents report')
+    parser.add_argument('--manifest', action='store', default=MANIFEST_DB, help='database of the K-numbers already crawled')
+    parser.add_argument('--since', action='store', nargs='?', const='last', metavar='YYYY-MM-DD', help='only clearances decided on or after this date, the newest one in the manifest if no date is given')
+    parser.add_argument('--metadata-db', action='store', default=METADATA_DB, help='database the openFDA record of every OCRed K-number is written to')
+    parser.add_argument('--reocr-outdated', action='store_true', help='redo K-numbers the manifest says were read by another OCR engine version')
+    parser.add_argument('--pdf-cache', action='store', nargs='?', const=PDF_CACHE_FOLDER, help='keep the summary pdfs in this content addressed cache instead of deleting them')
+    parser.add_argument('--pdf-cache-size', action='store', type=int, default=default_cache_size, help='MB the pdf cache may hold before the least recently used pdfs are evicted')
+    parser.add_argument('--mode', action='store', choices=('all', 'download', 'ocr'), default='all', help='download and OCR, only fill the pdf cache, or only OCR the pdfs in the cache')
+    parser.add_argument('--pipeline', action='store_true', help='run scrape, download, render, OCR and write as concurrent stages')
+    parser.add_argument('--scrape-workers', action='store', type=int, default=4, help='pipeline threads resolving summary links')
+    parser.add_argument('--download-workers', action='store', type=int, default=4, help='pipeline threads downloading pdfs')
+    parser.add_argument('--render-workers', action='store', type=int, default=2, help='pipeline threads rendering pdf pages')
+    parser.add_argument('--ocr-documents', action='store', type=int, default=2, help='pipeline threads feeding documents to the OCR engine')
+    parser.add_argument('--ocr-workers', action='store', type=int, default=os.cpu_count(), help='processes OCRing the pages of a document in parallel')
+    parser.add_argument('--render', action='store', choices=RENDER_MODES, default='memory', help='hand pages to tesseract in memory, or through jpeg files for debugging')
+    parser.add_argument('--stream-pages', action='store_true', help='render each page only when the previous one is OCRed, peak memory of one page')
+    parser.add_argument('--no-text-layer', action='store_true', help='OCR every page even when the pdf has a usable text layer')
+    parser.add_argument('--adaptive', action='store_true', help='skip blank and figure pages, OCR at --low-dpi first and re-render only pages tesseract is unsure of')
+    parser.add_argument('--low-dpi', action='store', type=int, default=default_low_dpi, help='first pass dpi in adaptive mode')
+    parser.add_argument('--min-confidence', action='store', type=float, default=default_min_confidence, help='mean word confidence below which an adaptive page is re-rendered at full dpi')
+    parser.add_argument('--openfda-url', action='store', default=OFDA_DEVICE, help='openFDA device api the hits are paged from')
+    parser.add_argument('--cdrh-url', action='store', default=BASE_510K_URL, help='summary page url the K-number is appended to')
+    parser.add_argument('--connect-timeout', action='store', type=float, default=default_timeout[0], help='seconds to wait for an http connection')
+    parser.add_argument('--read-timeout', action='store', type=float, default=default_timeout[1], help='seconds to wait for http data')
+    parser.add_argument('--retries', action='store', type=int, default=default_retries, help='http retries with backoff on 429 and 5xx')
+    parser.add_argument('--pool-size', action='store', type=int, default=default_pool_size, help='keep-alive connections per host')
+    parser.add_argument('--rate', action='append', metavar='HOST=RPS', help='requests per second allowed to a host, may be repeated')
+    parser.add_argument('--crawler', action='store', choices=('sync', 'async'), default='sync', help='resolve summary links one by one, or a whole openFDA page at once with asyncio')
+    parser.add_argument('--crawl-concurrency', action='store', type=int, default=default_concurrency, help='summary pages fetched at once by the async crawler')
+    parser.add_argument('--queue-size', action='store', type=int, default=default_queue_size, help='pipeline items allowed between two stages')
     args = parser.parse_args()
+    OFDA_DEVICE = args.openfda_url
+    BASE_510K_URL = args.cdrh_url
     
    
     
-    LOGGER = logging.getLogger('fda')
     LOGGER.addHandler(logging.FileHandler(args.log, 'a'))
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
@@ -102,138 +616,124 @@ def main():
         LOGGER.debug('Creating main folder')
         os.mkdir(PDF_FOLDER)
         
-    link = None    
-    redisHandle = redis.Redis()
-    redisHandle.set(stop_state_key ,'run')
+    redisHandle = redis.Redis.from_url(args.redis_url)
+    # shared by every worker, so a worker (re)starting never overrides a
+    # pause, drain or stop sent with stopFDA.py, only resume does
+    redisHandle.setnx(stop_state_key, RUN)
     if redisHandle.get(skip_count_key) is None:
         redisHandle.set(skip_count_key, 0)
+    controller = Controller(redisHandle)
+    if controller.state() != RUN:
+        LOGGER.warning(f'{stop_state_key} is {controller.state()}, run stopFDA.py resume to let the workers go on')
+    signal.signal(signal.SIGINT, catchSIGINT)
     limit = int(args.limit)
-        
-    # initial search 
-    while True:
-        status = redisHandle.get(stop_state_key).decode()
-        if status != 'run':
-            print("Exiting. Use restart and append to continue")
-            sys.exit(0)
-        skip_count = int(redisHandle.get(skip_count_key))   
-        response = requests.get(f'{OFDA_DEVICE + OFDA_510K + SEARCH  + HAS_SUMMARY}&limit={limit}&skip={skip_count}')
-  
-    
-        hits = response.json()['results']
-            
-        out_file = (args.output if args.output != 'stdout' else '-').strip()
-        
-        for hit in hits:   
-            with smart_open(out_file, append=args.append, buffering=1) as hitTextOutput:
-                k_number = hit['k_number']
-                yearFolder = f'Submit_Year_{getYear(k_number)}'
-                pdf_type = hit.get('statement_or_summary', 'missing')
-                if pdf_type !='missing':
-                    r_510K = requests.get(f'{BASE_510K_URL}{k_number}')
-                    soup = BeautifulSoup(r_510K.text, 'lxml')
-                    summary_button = soup("a", text=re.compile(r'Summary'))
-                    if len(summary_button) == 0:
-                        continue
-                    elem = summary_button[0]
-                    pdf_url = elem.get('href', "")
-                    if pdf_url == "":
-                        continue
-                    else:    
-                        yearPath = os.path.join(PDF_FOLDER, yearFolder)
-                        if not os.path.exists(yearPath):
-                            os.mkdir(yearPath)
-                        dataPath = os.path.join(yearPath,k_number)
-                        if not os.path.exists(dataPath):        
-                            os.mkdir(dataPath)
-                        # metadata file
-                        product_code = hit.get('product_code','???')
-                        device_name = hit.get('device_name','no name')
-                        advisory_committee = hit.get('advisory_committee', 'XX')
-                        advisory_committee_desc = hit.get('advisory_committee_description', 'no description')
-                        applicant = hit.get('applicant', 'no applicant')
-                        all510Kfilaname = os.path.join(dataPath, 'data.txt')
-                   
-                        #get the summary pdf and save it
-                        response = requests.get(pdf_url)
-                        pdfPath = os.path.join(dataPath,f"{k_number}.pdf")
-                        pdf = open(pdfPath, 'wb') 
-                        pdf.write(response.content)
-                        pdf.close()
-                        
-            # Store all the pages of the PDF in a variable
-                    image_file_list = []
-
-                    ocrTextFilename = os.path.join(dataPath,'out_text.txt')
-
-                
-                    with TemporaryDirectory() as tempdir:
-                # Create a temporary directory to hold our temporary images.
-
-                        """
-                        Part #1 : Converting PDF to images
-                        """
-
-                        pdf_pages = fitz.open(pdfPath)
-                    # Read in the PDF file at 500 DPI
-
-                    # Iterate through all the pages stored above
-                        start = time.time()
-                        for page_enumeration, page in enumerate(pdf_pages, start=1):
-                            filename = os.path.join(tempdir,f'page_{page_enumeration:03}.jpg')
-                            pix = page.get_pixmap(dpi=300)
-                            pix.save(filename)
-                            image_file_list.append(filename)
-                        os.remove(pdfPath)  # erase the pdf file for space saving
-            
-                        
-                        with open(ocrTextFilename, "a") as ocrOutput:
-                            for image_file in image_file_list:
-                                    text = str(((pytesseract.image_to_string(Image.open(image_file)))))
-                                    text = text.replace("-\n", "")
-                                    ocrOutput.write(text)
-                                    
-                        end = time.time()
-                        LOGGER.info(f'File {k_number} {len(pdf_pages)} pages, processing time is {(end - start):.0f} seconds')
-                        
-                        # use fuzz package to search for terms in the list and deal with incorrect OCR
-                        isFileHeaderOutput = False
-                        with open(ocrTextFilename) as ocrInput:
-                            lines = ocrInput.read()
-                            # look for predicate information'
-                            results = re.findall(r'K\d{6}',lines)
-                            predicates = None
-                            if results and len(results) != 0:
-                                all = set([x.strip() for x in results])
-                                all.discard(k_number)
-                                predicates = list(all)
-                                if predicates and len(predicates) != 0:
-                                   hit['predicates'] = predicates
-                            
-                            for item in BE_Words:
-                                ratio = fuzz.partial_ratio(item.lower(), lines.lower())              
-                                if ratio > 80:  
-                                    if not isFileHeaderOutput:
-                                        hitTextOutput.write(f'File {k_number} {len(pdf_pages)} pages\n')        
-                                        hitTextOutput.write(f"    Product Code = {hit['product_code']}\n")
-                                        hitTextOutput.write(f"    Device name = {hit['device_name']}\n")       
-                                        isFileHeaderOutput = True
-                                    hitTextOutput.write(    f"        Has {item} with ratio {ratio}\n") 
-                                    hitTextOutput.flush()
-                                    
-                            hit['openfda']['fei_number'] = 'see openFDA'
-                            hit['openfda']['registration_number'] = 'see openFDA'   
-                            with open(all510Kfilaname,'w') as all510KsFH:
-                                all510KsFH.write(f'Product Code: {product_code}\n')
-                                all510KsFH.write(f'Applicant:    {applicant}\n')
-                                all510KsFH.write(f'Device Name:  {device_name}\n')
-                                all510KsFH.write(f'Advisory Committee ({advisory_committee}): {advisory_committee_desc}')
-                                all510KsFH.write(json.dumps(hit,indent=4))
-        redisHandle.incrby(skip_count_key, limit)
-                    
 
-if __name__ == '__main__':
-    main()
+    out_file = (args.output if args.output != 'stdout' else '-').strip()
 
+    http = HttpClient(timeout=(args.connect_timeout, args.read_timeout), retries=args.retries,
+                      pool_size=args.pool_size, rates=parseRates(args.rate))
+    crawler = None
+    if args.crawler == 'async':
+        crawler = SummaryCrawler(BASE_510K_URL, args.crawl_concurrency, timeout=(args.connect_timeout, args.read_timeout),
+                                 retries=args.retries, rates=parseRates(args.rate))
+    pdfCache = None
+    if args.pdf_cache is not None:
+        pdfCache = PdfCache(args.pdf_cache, args.pdf_cache_size * 1024 * 1024)
+    elif args.mode != 'all':
+        LOGGER.error(f'--mode {args.mode} needs --pdf-cache')
+        sys.exit(1)
+    if args.mode == 'ocr' and args.pipeline:
+        LOGGER.error('--mode ocr reads the pdf cache on its own, it cannot be used with --pipeline')
+        sys.exit(1)
+    if args.mode == 'download' and args.reocr_outdated:
+        LOGGER.error('--reocr-outdated needs the OCR engine version, it cannot be used with --mode download')
+        sys.exit(1)
+    manifest = Manifest(args.manifest)
+    metadata = MetadataStore(args.metadata_db)
+    since = args.since
+    if since == 'last':
+        since = manifest.lastDecisionDate()
+        LOGGER.info(f'Crawling clearances decided since {since}')
+    if args.source == 'queue':
+        source = QueueSource(WorkQueue(args.work_db), limit, since)
+    elif args.source == 'redis':
+        source = RedisSource(LeasedQueue(redisHandle, args.queue, args.lease, args.max_attempts), controller, args.claim)
+    else:
+        source = ApiSource(http, redisHandle, limit, since)
+    # only downloading needs neither tesseract nor the OCR pool
+    ocrEngine = None
+    ocr_version = None
+    if args.mode != 'download':
+        ocrEngine = OcrEngine(args.ocr_workers, render=args.render, stream=args.stream_pages,
+                              textLayer=not args.no_text_layer, adaptive=args.adaptive, lowDpi=args.low_dpi,
+                              minConfidence=args.min_confidence)
+        if args.reocr_outdated:
+            ocr_version = ocrEngine.version
+    progress = Progress(redisHandle, workerName(), controller)
+    progress.start(source.remaining if args.mode != 'ocr' else None)
+    METRICS.export(args.metrics_port, args.metrics_file)
+    if args.profile is not None:
+        METRICS.profiler = PROFILER
+        PROFILER.start(args.profile_interval)
+        PROFILER.export(args.profile, args.profile_top, default_report_interval)
+    try:
+        with ocrEngine or nullcontext():
+            if args.mode == 'ocr':
+                runCachedOcr(out_file, args.append, ocrEngine, manifest, pdfCache, controller, progress, metadata)
+                return
+
+            if args.pipeline:
+                runPipeline(args, source, controller, progress, out_file, ocrEngine, http, crawler, manifest, ocr_version,
+                            pdfCache, metadata)
+                return
+
+            # initial search, the controller is asked before every hit.  Once
+            # a hit has failed the checkpoint stays before its page, as in the
+            # pipeline, so an api crawl picks it up again on the next run
+            stalled = False
+            while True:
+                if not controller.startItem():
+                    print("Exiting. Run stopFDA.py resume, then restart with --append to continue")
+                    sys.exit(0)
+                hits = source.nextPage()
+                if len(hits) == 0:
+                    break
+                progress.page()
+                pdf_urls = resolvePage(crawler, hits, manifest, ocr_version, pdfCache)
 
+                for hit in hits:
+                    if not controller.startItem():
+                        print("Exiting. Run stopFDA.py resume, then restart with --append to continue")
+                        sys.exit(0)
+                    source.started(hit)
+                    with smart_open(out_file, append=args.append, buffering=1) as hitTextOutput:
+                        try:
+                            with PROFILER.document(hit['k_number']):
+                                result = processHit(hit, hitTextOutput, ocrEngine, http, manifest, ocr_version, pdf_urls,
+                                                    pdfCache, args.mode == 'download', metadata)
+                        except requests.RequestException as e:
+                            LOGGER.error(f"{hit['k_number']} skipped, {e}")
+                            result = 'failed'
+                        except Exception as e:
+                            # anything else a bad pdf can raise, so it fails
+                            # here rather than taking the worker down
+                            LOGGER.exception(f"{hit['k_number']} failed, {e!r}")
+                            result = 'failed'
+                    source.finished(hit, result)
+                    progress.item(result)
+                    METRICS.inc('hits_total', status=result)
+                    if result == 'failed' and not stalled:
+                        LOGGER.warning(f"{hit['k_number']} failed, the checkpoint stays before it for the next run")
+                        stalled = True
+                if not stalled:
+                    source.checkpoint()
+    finally:
+        progress.stop()
+        source.close()
+        http.close()
+        METRICS.close()
+        PROFILER.close()
 
 
+if __name__ == '__main__':
+    main()
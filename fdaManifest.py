@@ -0,0 +1,47 @@
+import sqlite3
+import threading
+import time
+
+
+MANIFEST_DB = 'data/manifest.db'
+
+
+class Manifest:
+    # every K-number whose out_text.txt and data.txt have been written, with
+    # its decision date, the sha256 of its summary pdf and the OCR engine
+    # version that read it.  The crawler checks it before fetching anything.
+    # Safe to share between the threads of the pipeline
+    def __init__(self, path=MANIFEST_DB):
+        self.lock = threading.Lock()
+        self.cnx = sqlite3.connect(path, check_same_thread=False)
+        self.cnx.execute('''CREATE TABLE IF NOT EXISTS completed (
+            k_number TEXT PRIMARY KEY,
+            decision_date TEXT,
+            pdf_sha256 TEXT,
+            ocr_version TEXT,
+            finished_at REAL)''')
+        self.cnx.execute('CREATE INDEX IF NOT EXISTS completed_decision_date ON completed(decision_date)')
+        self.cnx.commit()
+
+    def isComplete(self, k_number, ocr_version=None):
+        # with ocr_version, documents read by another engine version count
+        # as not done so they get OCRed again
+        with self.lock:
+            row = self.cnx.execute('SELECT ocr_version FROM completed WHERE k_number = ?', (k_number,)).fetchone()
+        if row is None:
+            return False
+        return ocr_version is None or row[0] == ocr_version
+
+    def record(self, k_number, decision_date, pdf_sha256, ocr_version):
+        with self.lock:
+            self.cnx.execute('INSERT OR REPLACE INTO completed VALUES (?, ?, ?, ?, ?)',
+                             (k_number, decision_date, pdf_sha256, ocr_version, time.time()))
+            self.cnx.commit()
+
+    def lastDecisionDate(self):
+        # the newest clearance crawled so far, None for an empty manifest
+        with self.lock:
+            return self.cnx.execute('SELECT max(decision_date) FROM completed').fetchone()[0]
+
+    def close(self):
+        self.cnx.close()
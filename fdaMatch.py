@@ -0,0 +1,254 @@
+import logging
+import re
+
+import ahocorasick
+from rapidfuzz import fuzz, process
+
+
+LOGGER = logging.getLogger('fda_search')
+
+# character sequences tesseract commonly reads as one another, each term is
+# looked for with every combination of them up to max_variants spellings
+OCR_CONFUSIONS = [
+    ('rn', 'm'), ('m', 'rn'),
+    ('cl', 'd'), ('d', 'cl'),
+    ('vv', 'w'), ('w', 'vv'),
+    ('l', '1'), ('1', 'l'),
+    ('i', 'l'), ('l', 'i'),
+    ('i', '1'),
+    ('0', 'o'), ('o', '0'),
+    ('5', 's'), ('s', '5'),
+]
+max_variants = 256
+# terms at least this long are also looked for by their two halves, one of
+# them is still intact when OCR garbles a single character of the term
+min_split_length = 10
+
+# documents with a smaller share of word like tokens than this are badly
+# OCRed, the prefilter can't be trusted on them and they are always scored.
+# Same word test fdaOcr uses on pdf text layers
+min_word_share = 0.6
+VALID_WORD = re.compile(r'[a-z]*[aeiouy][a-z]*|[0-9]+([.,/-][0-9]+)*|k[0-9]{6}', re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+
+# characters a StreamMatcher reads at a time, windows overlap by the longest
+# term so every alignment of a term lies whole inside one of them
+default_chunk_size = 16384
+min_overlap = 16
+# stands in for the text beyond the interior edges of a window, it matches
+# nothing so a term cut off by the edge scores no better than whole
+PADDING = '\0'
+
+
+def stripNegation(term):
+    return term[1:] if term.startswith('!') else term
+
+
+def normalize(text):
+    return text.lower()
+
+
+class TermMatcher:
+    # Scores a whole term list against a document in one rapidfuzz cdist
+    # call, lowercasing the document only once.  Scores are rounded to ints
+    # the way fuzzywuzzy's partial_ratio rounds them, so callers keep
+    # comparing ratio > cutoff.  Terms keep their leading ! in the results
+    def __init__(self, terms, cutoff=None, workers=1):
+        self.terms = list(terms)
+        self.queries = {term: normalize(stripNegation(term)) for term in self.terms}
+        self.cutoff = cutoff
+        self.workers = workers
+
+    def scores(self, text, terms=None, normalized=False):
+        # {term: score} for terms (all of them by default).  With a cutoff,
+        # scores that cannot pass it come back as 0
+        terms = self.terms if terms is None else list(terms)
+        if len(terms) == 0:
+            return {}
+        document = text if normalized else normalize(text)
+        matrix = process.cdist([self.queries[term] for term in terms], [document],
+                               scorer=fuzz.partial_ratio, processor=None,
+                               score_cutoff=self.cutoff, workers=self.workers)
+        return {term: int(round(matrix[i][0])) for i, term in enumerate(terms)}
+
+    def hits(self, text, terms=None, normalized=False):
+        # [(term, score)] in term order for every score above the cutoff
+        cutoff = 0 if self.cutoff is None else self.cutoff
+        scores = self.scores(text, terms, normalized)
+        return [(term, score) for term, score in scores.items() if score > cutoff]
+
+
+def ocrVariants(term):
+    # term and its spellings under OCR_CONFUSIONS, at most max_variants
+    variants = {term}
+    frontier = [term]
+    while frontier and len(variants) < max_variants:
+        found = []
+        for variant in frontier:
+            for wrong, right in OCR_CONFUSIONS:
+                start = variant.find(wrong)
+                while start != -1 and len(variants) < max_variants:
+                    spelling = variant[:start] + right + variant[start + len(wrong):]
+                    if spelling not in variants:
+                        variants.add(spelling)
+                        found.append(spelling)
+                    start = variant.find(wrong, start + 1)
+        frontier = found
+    return variants
+
+
+def countWords(tokens):
+    # (tokens that look like words or numbers, tokens) once punctuation is
+    # stripped
+    tokens = [t.strip('.,;:()[]{}"\'') for t in tokens]
+    tokens = [t for t in tokens if t]
+    return sum(1 for t in tokens if VALID_WORD.fullmatch(t)), len(tokens)
+
+
+def textQuality(text):
+    # share of the tokens of text that look like words or numbers
+    valid, total = countWords(text.split())
+    if total == 0:
+        return 0.0
+    return valid / total
+
+
+def streamQuality(stream, chunkSize=default_chunk_size):
+    # textQuality of what is left in stream, read a chunk at a time.  A
+    # token cut by the end of a chunk is carried over to the next one
+    valid = total = 0
+    carry = ''
+    while True:
+        chunk = stream.read(chunkSize)
+        text = carry + normalize(chunk)
+        tokens = text.split()
+        carry = tokens.pop() if chunk and tokens and not text[-1].isspace() else ''
+        counts = countWords(tokens)
+        valid += counts[0]
+        total += counts[1]
+        if not chunk:
+            break
+    if total == 0:
+        return 0.0
+    return valid / total
+
+
+class Prefilter:
+    # One Aho-Corasick automaton over every OCR spelling of every term,
+    # run once over the document with its whitespace collapsed.  Only the
+    # terms it finds go on to fuzzy scoring, except in badly OCRed documents
+    # where every term is scored.  Exact spellings and halves are all it
+    # knows, so a term garbled some other way is missed; bench/benchPrefilter.py
+    # measures that recall against scoring everything
+    def __init__(self, terms, minQuality=min_word_share):
+        self.terms = list(terms)
+        self.minQuality = minQuality
+        self.automaton = ahocorasick.Automaton()
+        spellings = {}
+        for term in self.terms:
+            query = WHITESPACE.sub(' ', normalize(stripNegation(term)))
+            pieces = [query]
+            if len(query) >= min_split_length:
+                pieces.extend([query[:len(query) // 2], query[len(query) // 2:]])
+            for piece in pieces:
+                for spelling in ocrVariants(piece):
+                    spellings.setdefault(spelling, set()).add(term)
+        for spelling, owners in spellings.items():
+            self.automaton.add_word(spelling, frozenset(owners))
+        self.automaton.make_automaton()
+
+    def flagged(self, text, normalized=False, quality=None):
+        # the terms, in term order, worth fuzzy scoring against text.
+        # quality is the textQuality of the whole document when text is
+        # only a part of it
+        document = text if normalized else normalize(text)
+        if self.minQuality > 0:
+            if quality is None:
+                quality = textQuality(document)
+            if quality < self.minQuality:
+                return list(self.terms)
+        found = set()
+        for _, owners in self.automaton.iter(WHITESPACE.sub(' ', document)):
+            found.update(owners)
+            if len(found) == len(self.terms):
+                break
+        return [term for term in self.terms if term in found]
+
+
+class StreamMatcher:
+    # Fuzzy scores terms against a text stream one overlapping window at a
+    # time, so memory stays at one window however long the summary is.
+    # Keeps the best score and document offset of every term.  A term stops
+    # being scored once it reaches 100, and the whole scan stops as soon as
+    # a ! term passes the cutoff since the document is discarded anyway.
+    # The scores are the ones partial_ratio gives on the whole text
+    def __init__(self, terms, cutoff=None, chunkSize=default_chunk_size):
+        self.terms = list(terms)
+        self.queries = {term: normalize(stripNegation(term)) for term in self.terms}
+        self.cutoff = cutoff
+        self.chunkSize = chunkSize
+        self.overlap = max([min_overlap] + [len(query) - 1 for query in self.queries.values()])
+
+    def windows(self, stream):
+        # (offset, window, first, last) with each window starting with the
+        # last overlap characters of the one before
+        tail = ''
+        offset = 0
+        chunk = stream.read(self.chunkSize)
+        while True:
+            following = stream.read(self.chunkSize) if chunk else ''
+            window = tail + chunk
+            last = following == ''
+            yield offset - len(tail), window, offset == len(tail), last
+            if last:
+                return
+            offset += len(chunk)
+            tail = window[-self.overlap:]
+            chunk = following
+
+    def scan(self, stream, terms=None, prefilter=None, onWindow=None, groups=None):
+        # {term: (score, offset)} for terms, offset -1 when a term never
+        # scored.  A prefilter limits each window to the terms it finds
+        # there.  Whether the document is too badly OCRed for a prefilter
+        # is judged on all of it, as for a whole document, in a first pass
+        # over stream that is then rewound.  onWindow gets every raw window, even after scoring stops,
+        # unless a ! term fired.  groups are term lists each negated on its
+        # own, the scan stops once all of them are
+        terms = self.terms if terms is None else list(terms)
+        groups = [terms] if groups is None else [list(group) for group in groups]
+        negated = [False] * len(groups)
+        best = {term: (0.0, -1) for term in terms}
+        live = list(terms)
+        pad = PADDING * self.overlap
+        quality = None
+        if prefilter is not None and prefilter.minQuality > 0:
+            start = stream.tell()
+            quality = streamQuality(stream, self.chunkSize)
+            stream.seek(start)
+        for offset, window, first, last in self.windows(stream):
+            if onWindow is not None:
+                onWindow(window)
+            if len(live) == 0:
+                continue
+            document = normalize(window)
+            padded = ('' if first else pad) + document + ('' if last else pad)
+            shift = offset - (0 if first else len(pad))
+            flagged = live if prefilter is None else set(prefilter.flagged(document, normalized=True, quality=quality))
+            for term in list(live):
+                if term not in live or (prefilter is not None and term not in flagged):
+                    continue
+                floor = max(best[term][0], self.cutoff or 0)
+                alignment = fuzz.partial_ratio_alignment(self.queries[term], padded, processor=None, score_cutoff=floor)
+                if alignment is None or alignment.score <= best[term][0]:
+                    continue
+                best[term] = (alignment.score, shift + alignment.dest_start)
+                if term.startswith('!') and int(round(alignment.score)) > (self.cutoff or 0):
+                    negated = [done or term in group for done, group in zip(negated, groups)]
+                    if all(negated):
+                        return {term: (int(round(score)), position) for term, (score, position) in best.items()}
+                    needed = set(item for done, group in zip(negated, groups) if not done for item in group)
+                    live = [item for item in live if item in needed]
+                    continue
+                if alignment.score >= 100:
+                    live.remove(term)
+        return {term: (int(round(score)), position) for term, (score, position) in best.items()}
@@ -0,0 +1,183 @@
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+
+
+LOGGER = logging.getLogger('fda')
+
+METADATA_DB = 'data/metadata.db'
+PDF_FOLDER = 'pdf/'
+
+# openFDA fields fdaMain overwrites with a placeholder, never searched on
+IGNORE_TAGS = {"registration_number", "fei_number"}
+
+insert_batch = 1000
+
+
+def cleanHit(hit):
+    hit = dict(hit)
+    for tag in IGNORE_TAGS:
+        hit.pop(tag, None)
+    if isinstance(hit.get('openfda'), dict):
+        hit['openfda'] = {key: value for key, value in hit['openfda'].items() if key not in IGNORE_TAGS}
+    return hit
+
+
+class MetadataStore:
+    # the openFDA record of every K-number that has been OCRed, one row per
+    # K-number with the fields searches filter and sort on as indexed columns
+    # and the whole record as json.  Predicates found in the OCR text get a
+    # table of their own so they can be looked up both ways.  Safe to share
+    # between the threads of the pipeline
+    def __init__(self, path=METADATA_DB):
+        self.lock = threading.Lock()
+        self.cnx = sqlite3.connect(path, check_same_thread=False)
+        self.cnx.execute('''CREATE TABLE IF NOT EXISTS devices (
+            k_number TEXT PRIMARY KEY,
+            product_code TEXT,
+            applicant TEXT,
+            device_name TEXT,
+            decision_date TEXT,
+            advisory_committee TEXT,
+            advisory_committee_description TEXT,
+            folder TEXT,
+            hit TEXT NOT NULL)''')
+        for column in ('product_code', 'applicant', 'decision_date', 'advisory_committee'):
+            self.cnx.execute(f'CREATE INDEX IF NOT EXISTS devices_{column} ON devices({column})')
+        self.cnx.execute('''CREATE TABLE IF NOT EXISTS predicates (
+            k_number TEXT NOT NULL,
+            predicate TEXT NOT NULL,
+            PRIMARY KEY (k_number, predicate))''')
+        self.cnx.execute('CREATE INDEX IF NOT EXISTS predicates_predicate ON predicates(predicate)')
+        self.cnx.commit()
+
+    def put(self, hit, folder=None, commit=True):
+        hit = cleanHit(hit)
+        k_number = hit['k_number']
+        with self.lock:
+            self.cnx.execute('INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (k_number, hit.get('product_code'), hit.get('applicant'), hit.get('device_name'),
+                              hit.get('decision_date'), hit.get('advisory_committee'),
+                              hit.get('advisory_committee_description'), folder, json.dumps(hit)))
+            self.cnx.execute('DELETE FROM predicates WHERE k_number = ?', (k_number,))
+            self.cnx.executemany('INSERT OR IGNORE INTO predicates VALUES (?, ?)',
+                                 [(k_number, predicate) for predicate in hit.get('predicates') or []])
+            if commit:
+                self.cnx.commit()
+
+    def commit(self):
+        with self.lock:
+            self.cnx.commit()
+
+    def get(self, k_number):
+        # the record of k_number, None if it isn't stored
+        with self.lock:
+            row = self.cnx.execute('SELECT hit FROM devices WHERE k_number = ?', (k_number,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def select(self, product_codes=None, applicant=None, committee=None, since=None, until=None,
+               predicate=None, order_by='k_number'):
+        # {k_number: (folder, hit)} for every stored K-number passing all
+        # the filters given, in order_by order
+        query = 'SELECT k_number, folder, hit FROM devices WHERE 1 = 1'
+        params = []
+        if product_codes:
+            query += f" AND product_code IN ({','.join('?' * len(product_codes))})"
+            params.extend(product_codes)
+        if applicant is not None:
+            query += ' AND applicant LIKE ?'
+            params.append(f'%{applicant}%')
+        if committee is not None:
+            query += ' AND advisory_committee = ?'
+            params.append(committee)
+        if since is not None:
+            query += ' AND decision_date >= ?'
+            params.append(since)
+        if until is not None:
+            query += ' AND decision_date <= ?'
+            params.append(until)
+        if predicate is not None:
+            query += ' AND k_number IN (SELECT k_number FROM predicates WHERE predicate = ?)'
+            params.append(predicate)
+        if order_by not in ('k_number', 'product_code', 'applicant', 'device_name', 'decision_date', 'advisory_committee'):
+            order_by = 'k_number'
+        with self.lock:
+            rows = self.cnx.execute(f'{query} ORDER BY {order_by}, k_number', params).fetchall()
+        return {k_number: (folder, json.loads(hit)) for k_number, folder, hit in rows}
+
+    def count(self):
+        with self.lock:
+            return self.cnx.execute('SELECT count(*) FROM devices').fetchone()[0]
+
+    def close(self):
+        self.cnx.close()
+
+
+def readDataFile(path):
+    # the openFDA record in a data.txt written by fdaMain: four header lines,
+    # the last one running straight into the indented json.  None if no json
+    # object can be found in it
+    with open(path) as fh:
+        content = fh.read()
+    header = content.split('\n', 3)
+    rest = header[3] if len(header) == 4 else content
+    decoder = json.JSONDecoder()
+    start = rest.find('{')
+    while start != -1:
+        try:
+            hit, _ = decoder.raw_decode(rest, start)
+            if isinstance(hit, dict) and 'k_number' in hit:
+                return hit
+        except json.JSONDecodeError:
+            pass
+        start = rest.find('{', start + 1)
+    return None
+
+
+def migrate(folder, store):
+    # import every data.txt under folder, returns (imported, unreadable)
+    imported = 0
+    unreadable = 0
+    for root, dirs, files in os.walk(folder):
+        if not re.match(r"K\d{6}", os.path.basename(root)) or 'data.txt' not in files:
+            continue
+        hit = readDataFile(os.path.join(root, 'data.txt'))
+        if hit is None:
+            LOGGER.error(f'Cannot parse {os.path.join(root, "data.txt")}')
+            unreadable += 1
+            continue
+        store.put(hit, root, commit=False)
+        imported += 1
+        if imported % insert_batch == 0:
+            store.commit()
+            LOGGER.info(f'{imported} imported')
+    store.commit()
+    return imported, unreadable
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="fda-metadata",
+        description='Import the data.txt file of every K-number folder into the metadata database'
+    )
+    parser.add_argument('folder', nargs='?', default=PDF_FOLDER, help='folder of K-number folders')
+    parser.add_argument('--metadata-db', action='store', default=METADATA_DB, help='metadata database')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if not os.path.exists(args.folder):
+        LOGGER.error(f"Cant find the folder {args.folder}")
+        sys.exit(1)
+    store = MetadataStore(args.metadata_db)
+    imported, unreadable = migrate(args.folder, store)
+    LOGGER.info(f'{imported} data.txt files imported, {unreadable} unreadable, {store.count()} K-numbers in {args.metadata_db}')
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LOGGER = logging.getLogger('fda')
+
+# seconds, from a CDRH page fetch to the OCR of a long summary
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# seconds between rewrites of the textfile
+default_write_interval = 15
+
+HELP = {
+    'stage_seconds': 'Seconds spent in each stage',
+    'bytes_total': 'Bytes handled by each stage',
+    'pages_total': 'Summary pages by how their text was read',
+    'hits_total': 'openFDA hits finished by status',
+    'documents_total': 'Documents scanned by outcome and search group',
+}
+
+
+def formatLabels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class Metrics:
+    # Counters and latency histograms by label, kept in memory and written
+    # in the Prometheus text format, served over http for scraping and/or
+    # rewritten as a file for node_exporter's textfile collector.  Safe to
+    # share between threads.  Every process of a pool keeps its own, the
+    # parent merge()s what each one drain()s
+    def __init__(self, prefix='fda', buckets=LATENCY_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        # an fdaProfile.Profiler, told where every timed stage starts and ends
+        self.profiler = None
+        self.server = None
+        self.path = None
+        self.stopping = threading.Event()
+        self.writer = None
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        # a forked process gets a copy of the lock, held if the http or
+        # file thread had it at the fork, and of counts its parent reports
+        # itself.  Neither thread survives the fork
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.server = None
+        self.path = None
+        self.stopping = threading.Event()
+        self.writer = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # a count per bucket, then the sum and the count
+                histogram = self.histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def timed(self, stage, **labels):
+        # with a profiler attached the stage is also sampled, and its time
+        # added to the document being worked on
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe('stage_seconds', seconds, stage=stage, **labels)
+            if profiler is not None:
+                profiler.exit(seconds)
+
+    def drain(self):
+        # everything gathered since the last drain, for merge()
+        with self.lock:
+            drained = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        return drained
+
+    def merge(self, drained):
+        counters, histograms = drained
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, values in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = list(values)
+                else:
+                    self.histograms[key] = [mine + theirs for mine, theirs in zip(histogram, values)]
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        lines = []
+        described = set()
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {self.prefix}_{name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {self.prefix}_{name} {kind}')
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append(f'{self.prefix}_{name}{formatLabels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram):
+                cumulative += count
+                lines.append(f'{self.prefix}_{name}_bucket{formatLabels(labels, [("le", f"{bound:g}")])} {cumulative}')
+            lines.append(f'{self.prefix}_{name}_bucket{formatLabels(labels, [("le", "+Inf")])} {histogram[-1]}')
+            lines.append(f'{self.prefix}_{name}_sum{formatLabels(labels)} {histogram[-2]:.6f}')
+            lines.append(f'{self.prefix}_{name}_count{formatLabels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def writeTextfile(self, path):
+        # replaced in one rename so the collector never reads half a file
+        temp = f'{path}.{os.getpid()}.tmp'
+        with open(temp, 'w') as fh:
+            fh.write(self.render())
+        os.replace(temp, path)
+
+    def export(self, port=None, path=None, interval=default_write_interval):
+        # serve /metrics on port and/or rewrite path every interval seconds
+        # until close()
+        if port is not None:
+            metrics = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.render().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(('', port), Handler)
+            threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+            LOGGER.info(f'Serving metrics on port {port}')
+        if path is not None:
+            self.path = path
+            self.writer = threading.Thread(target=self._write, args=(interval,), name='metrics-file', daemon=True)
+            self.writer.start()
+
+    def _write(self, interval):
+        while not self.stopping.wait(interval):
+            try:
+                self.writeTextfile(self.path)
+            except OSError as e:
+                LOGGER.error(f'Cannot write the metrics to {self.path}, {e}')
+
+    def close(self):
+        # the textfile is written a last time with the final counts
+        self.stopping.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.writeTextfile(self.path)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
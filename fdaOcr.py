@@ -0,0 +1,299 @@
+import logging
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+import pytesseract
+from PIL import Image, ImageChops
+
+
+LOGGER = logging.getLogger('fda')
+
+RENDER_MODES = ('memory', 'jpeg')
+default_dpi = 300
+
+# a page's own text layer is used instead of OCR when it has at least this
+# many non blank characters and this share of its tokens look like words
+min_text_chars = 100
+min_word_share = 0.6
+VALID_WORD = re.compile(r'[a-z]*[aeiouy][a-z]*|[0-9]+([.,/-][0-9]+)*|k[0-9]{6}', re.IGNORECASE)
+
+# adaptive policy: OCR at low_dpi first and only re-render at the full dpi
+# when the mean word confidence is below min_confidence
+default_low_dpi = 200
+default_min_confidence = 75
+
+# pages are classified on a thumbnail before anything is rendered for OCR.
+# Less than blank_ink_share dark pixels is a blank page.  More than
+# figure_midtone_share grey pixels is a photo or figure with no text to read,
+# unless it has text_rows rows of pixels in which ink and paper alternate
+# more than text_row_edges of the width, the way they do across a line of
+# text: grey, yellowed or low contrast scans of text pages are midtones too
+thumbnail_dpi = 50
+blank_ink_share = 0.002
+figure_midtone_share = 0.5
+text_row_edges = 0.1
+text_rows = 3
+
+
+def initWorker():
+    # every pool process runs its own tesseract, so keep tesseract itself
+    # single threaded or N processes x M OpenMP threads fight over the cores
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+
+
+def pixmapToImage(pix):
+    return Image.frombytes('L' if pix.n == 1 else 'RGB', (pix.width, pix.height), pix.samples)
+
+
+def renderPage(page, dpi=default_dpi):
+    # grayscale is all tesseract needs and a third of the bytes of RGB
+    return pixmapToImage(page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY))
+
+
+def isUsableText(text):
+    # born-digital pages have a clean text layer, scanned ones have none or
+    # a garbled one from some earlier OCR pass or a broken font encoding
+    if sum(1 for c in text if not c.isspace()) < min_text_chars:
+        return False
+    tokens = [t.strip('.,;:()[]{}"\'') for t in text.split()]
+    tokens = [t for t in tokens if t]
+    if len(tokens) == 0 or '\ufffd' in text:
+        return False
+    valid = sum(1 for t in tokens if VALID_WORD.fullmatch(t))
+    return valid / len(tokens) >= min_word_share
+
+
+def otsuThreshold(histogram):
+    # the grey level best splitting the page into ink and paper
+    total = sum(histogram)
+    weighted = sum(level * count for level, count in enumerate(histogram))
+    below = 0
+    belowWeighted = 0
+    best = 0
+    threshold = 128
+    for level, count in enumerate(histogram):
+        below += count
+        belowWeighted += level * count
+        above = total - below
+        if below == 0 or above == 0:
+            continue
+        spread = below * above * (belowWeighted / below - (weighted - belowWeighted) / above) ** 2
+        if spread > best:
+            best = spread
+            threshold = level
+    return threshold
+
+
+def textRows(image, threshold):
+    # rows of pixels crossing ink edges as often as a line of text does
+    ink = image.point(lambda level: 255 if level > threshold else 0)
+    edges = ImageChops.difference(ink, ImageChops.offset(ink, 1, 0))
+    # each row averaged down to one pixel, its share of edge pixels
+    shares = edges.resize((1, edges.height), Image.BOX).getdata()
+    return sum(1 for share in shares if share > text_row_edges * 255)
+
+
+def classifyPage(page):
+    # 'blank', 'figure' or None for a page that may have text on it
+    image = renderPage(page, thumbnail_dpi)
+    histogram = image.histogram()
+    total = sum(histogram)
+    if total == 0 or sum(histogram[:128]) / total < blank_ink_share:
+        return 'blank'
+    if sum(histogram[64:192]) / total > figure_midtone_share and textRows(image, otsuThreshold(histogram)) < text_rows:
+        return 'figure'
+    return None
+
+
+def iterPages(pdfPath, dpi=default_dpi, tempdir=None, textLayer=True, adaptive=False):
+    # yields one (kind, page) per page:
+    #   ('text', text)     the text layer can be used as is
+    #   ('skip', reason)   blank or figure page, adaptive mode only
+    #   ('ocr', image)     needs tesseract.  With a tempdir the image is the
+    #                      name of a jpeg in it, the original path kept for
+    #                      debugging: the images can be inspected there
+    #   ('adaptive', (pdfPath, index))  rendered by the OCR worker itself
+    #                      since it may need to be rendered twice
+    with fitz.open(pdfPath) as pdf_pages:
+        for page_enumeration, page in enumerate(pdf_pages, start=1):
+            if textLayer:
+                text = page.get_text()
+                if isUsableText(text):
+                    yield 'text', text.replace("-\n", "")
+                    continue
+            if adaptive:
+                reason = classifyPage(page)
+                if reason is not None:
+                    yield 'skip', reason
+                else:
+                    yield 'adaptive', (pdfPath, page_enumeration - 1)
+            elif tempdir is None:
+                yield 'ocr', renderPage(page, dpi)
+            else:
+                filename = os.path.join(tempdir,f'page_{page_enumeration:03}.jpg')
+                page.get_pixmap(dpi=dpi).save(filename)
+                yield 'ocr', filename
+
+
+def ocrPage(image):
+    # image is a PIL image or the name of an image file
+    start = time.time()
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    text = str(pytesseract.image_to_string(image))
+    return text.replace("-\n", ""), {'seconds': time.time() - start}
+
+
+def dataToText(data):
+    # rebuild image_to_string style text from image_to_data output, so a page
+    # is only OCRed once to get both its text and its confidence
+    lines = []
+    current = None
+    for n, word in enumerate(data['text']):
+        if not word.strip():
+            continue
+        key = (data['block_num'][n], data['par_num'][n], data['line_num'][n])
+        if key != current:
+            if current is not None and key[:2] != current[:2]:
+                lines.append('')
+            lines.append(word)
+            current = key
+        else:
+            lines[-1] += ' ' + word
+    return '\n'.join(lines) + '\n'
+
+
+def meanConfidence(data):
+    confs = [float(c) for c, word in zip(data['conf'], data['text']) if float(c) >= 0 and word.strip()]
+    return sum(confs) / len(confs) if confs else 0.0
+
+
+def ocrWithConfidence(image):
+    data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT)
+    return dataToText(data), meanConfidence(data)
+
+
+def ocrPageAdaptive(pageRef, lowDpi, highDpi, minConfidence):
+    pdfPath, index = pageRef
+    start = time.time()
+    with fitz.open(pdfPath) as pdf_pages:
+        page = pdf_pages[index]
+        text, conf = ocrWithConfidence(renderPage(page, lowDpi))
+        info = {'dpi': lowDpi, 'conf': conf, 'rerender': False}
+        if conf < minConfidence and highDpi > lowDpi:
+            highText, highConf = ocrWithConfidence(renderPage(page, highDpi))
+            info['rerender'] = True
+            info['low_conf'] = conf
+            if highConf >= conf:
+                text, conf = highText, highConf
+                info['dpi'] = highDpi
+                info['conf'] = highConf
+    info['seconds'] = time.time() - start
+    return text.replace("-\n", ""), info
+
+
+class OcrEngine:
+    # Renders a pdf and OCRs its pages in parallel on a process pool, putting
+    # the text back together in page order.  One engine can be shared by
+    # several threads, their pages simply queue up on the same pool.
+    #
+    # render='memory' hands the raw pixmap samples to tesseract, 'jpeg' goes
+    # through a temporary directory.  stream=True renders a page only when
+    # the previous one has been OCRed so peak memory stays at one page.
+    # textLayer=True skips OCR for pages with a usable text layer.
+    # adaptive=True skips blank and figure pages and OCRs the rest at lowDpi,
+    # going up to dpi only when tesseract is not confident
+    def __init__(self, workers=None, render='memory', stream=False, dpi=default_dpi, textLayer=True,
+                 adaptive=False, lowDpi=default_low_dpi, minConfidence=default_min_confidence):
+        if render not in RENDER_MODES:
+            raise ValueError(f'render mode must be one of {RENDER_MODES}, not {render}')
+        self.workers = max(1, int(workers or os.cpu_count()))
+        self.render_mode = render
+        self.stream = stream and render == 'memory'
+        self.dpi = dpi
+        self.textLayer = textLayer
+        self.adaptive = adaptive
+        self.lowDpi = min(lowDpi, dpi)
+        self.minConfidence = minConfidence
+        self.version = self._version()
+        self.pool = None
+        if self.workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=initWorker)
+
+    def _version(self):
+        # recorded in the manifest next to every document this engine reads
+        version = f'tesseract-{pytesseract.get_tesseract_version()} dpi-{self.dpi}'
+        if self.textLayer:
+            version += ' text-layer'
+        if self.adaptive:
+            version += f' adaptive-{self.lowDpi}-{self.minConfidence:g}'
+        return version
+
+    def render(self, pdfPath, tempdir=None):
+        # returns the pages to give to ocrPages, lazily in stream mode
+        pages = iterPages(pdfPath, self.dpi, tempdir if self.render_mode == 'jpeg' else None,
+                          self.textLayer, self.adaptive)
+        return pages if self.stream else list(pages)
+
+    def _submit(self, func, *args):
+        if self.pool is None:
+            return func(*args)
+        return self.pool.submit(func, *args)
+
+    def ocrPages(self, pages, name=''):
+        # returns the page texts in page order and a count of the pages that
+        # took each path
+        stats = {'text': 0, 'ocr': 0, 'skip': 0, 'rerender': 0}
+        window = 1 if self.stream else None
+        texts = []
+        pending = deque()
+
+        def collect():
+            page_number, kind, result = pending.popleft()
+            if not isinstance(result, tuple):
+                result = result.result()
+            text, info = result
+            if info.get('rerender'):
+                stats['rerender'] += 1
+            if kind in ('ocr', 'adaptive'):
+                LOGGER.debug(f'{name} page {page_number}: OCR {info}')
+            texts.append(text)
+
+        for page_number, (kind, page) in enumerate(pages, start=1):
+            if kind == 'text':
+                stats['text'] += 1
+                pending.append((page_number, kind, (page, {})))
+            elif kind == 'skip':
+                stats['skip'] += 1
+                LOGGER.info(f'{name} page {page_number}: skipped, {page}')
+                pending.append((page_number, kind, ('', {})))
+            elif kind == 'adaptive':
+                stats['ocr'] += 1
+                pending.append((page_number, kind, self._submit(ocrPageAdaptive, page, self.lowDpi, self.dpi, self.minConfidence)))
+            else:
+                stats['ocr'] += 1
+                pending.append((page_number, kind, self._submit(ocrPage, page)))
+            while len(pending) > 0 and (isinstance(pending[0][2], tuple) or (window is not None and len(pending) >= window)):
+                collect()
+        while len(pending) > 0:
+            collect()
+        return texts, stats
+
+    def ocrDocument(self, pages):
+        texts, stats = self.ocrPages(pages)
+        return ''.join(texts)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
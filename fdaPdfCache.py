@@ -0,0 +1,122 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+LOGGER = logging.getLogger('fda')
+
+PDF_CACHE_FOLDER = 'pdf_cache/'
+default_cache_size = 20000  # MB
+
+
+class PdfCache:
+    # Summary pdfs stored gzipped under their sha256, so the same pdf is only
+    # kept once and a re-OCR never has to go back to the FDA site.  Each
+    # K-number points at its pdf and keeps its openFDA record so the cache
+    # alone is enough to OCR again.  Once the stored bytes pass maxBytes the
+    # least recently used pdfs are evicted.  Safe to share between threads
+    def __init__(self, folder=PDF_CACHE_FOLDER, maxBytes=default_cache_size * 1024 * 1024):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.cnx = sqlite3.connect(os.path.join(folder, 'index.db'), check_same_thread=False)
+        self.cnx.execute('''CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL)''')
+        self.cnx.execute('CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs(last_used)')
+        self.cnx.execute('''CREATE TABLE IF NOT EXISTS refs (
+            k_number TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            hit TEXT)''')
+        self.cnx.commit()
+
+    def _path(self, sha256):
+        return os.path.join(self.folder, sha256[:2], f'{sha256}.pdf.gz')
+
+    def put(self, k_number, content, hit=None):
+        # store the pdf of k_number, returns its sha256
+        sha256 = hashlib.sha256(content).hexdigest()
+        path = self._path(sha256)
+        with self.lock:
+            known = self.cnx.execute('SELECT 1 FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+        if known is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = f'{path}.{threading.get_ident()}.tmp'
+            with gzip.open(temp, 'wb', compresslevel=6) as fh:
+                fh.write(content)
+            os.replace(temp, path)
+        with self.lock:
+            self.cnx.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)', (sha256, os.path.getsize(path), time.time()))
+            self.cnx.execute('INSERT OR REPLACE INTO refs VALUES (?, ?, ?)',
+                             (k_number, sha256, json.dumps(hit) if hit is not None else None))
+            self.cnx.commit()
+        self.evict()
+        return sha256
+
+    def lookup(self, k_number):
+        # the sha256 of the cached pdf of k_number, None if it isn't cached
+        with self.lock:
+            row = self.cnx.execute('SELECT refs.sha256 FROM refs JOIN blobs ON refs.sha256 = blobs.sha256 '
+                                   'WHERE k_number = ?', (k_number,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, k_number):
+        # the pdf bytes of k_number, None if it isn't cached
+        sha256 = self.lookup(k_number)
+        if sha256 is None:
+            return None
+        try:
+            with gzip.open(self._path(sha256), 'rb') as fh:
+                content = fh.read()
+        except FileNotFoundError:
+            LOGGER.warning(f'{k_number} cached pdf {sha256} is missing')
+            self._forget(sha256)
+            return None
+        with self.lock:
+            self.cnx.execute('UPDATE blobs SET last_used = ? WHERE sha256 = ?', (time.time(), sha256))
+            self.cnx.commit()
+        return content
+
+    def entries(self):
+        # (k_number, hit) for every cached K-number, in K-number order
+        with self.lock:
+            rows = self.cnx.execute('SELECT k_number, hit FROM refs JOIN blobs ON refs.sha256 = blobs.sha256 '
+                                    'ORDER BY k_number').fetchall()
+        return [(k_number, json.loads(hit) if hit else None) for k_number, hit in rows]
+
+    def totalBytes(self):
+        with self.lock:
+            return self.cnx.execute('SELECT coalesce(sum(size), 0) FROM blobs').fetchone()[0]
+
+    def evict(self):
+        # drop least recently used pdfs until the cache fits in maxBytes
+        total = self.totalBytes()
+        while total > self.maxBytes:
+            with self.lock:
+                row = self.cnx.execute('SELECT sha256, size FROM blobs ORDER BY last_used LIMIT 1').fetchone()
+            if row is None:
+                break
+            sha256, size = row
+            LOGGER.debug(f'Evicting cached pdf {sha256}')
+            self._forget(sha256)
+            total -= size
+
+    def _forget(self, sha256):
+        try:
+            os.remove(self._path(sha256))
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.cnx.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+            self.cnx.execute('DELETE FROM refs WHERE sha256 = ?', (sha256,))
+            self.cnx.commit()
+
+    def close(self):
+        self.cnx.close()
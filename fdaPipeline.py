@@ -0,0 +1,164 @@
+import logging
+import queue
+import shutil
+import threading
+
+
+LOGGER = logging.getLogger('fda')
+
+default_queue_size = 8
+
+
+class WorkItem:
+    # one openFDA hit travelling through the pipeline.  seq is the position
+    # of the hit in the crawl so the writer can put results back in order
+    def __init__(self, seq, hit, last_in_page):
+        self.seq = seq
+        self.hit = hit
+        self.k_number = hit['k_number']
+        self.last_in_page = last_in_page
+        self.dropped = False
+        self.failed = False
+        self.abandoned = False
+        self.complete = False
+        self.pdf_url = None
+        self.dataPath = None
+        self.pdfPath = None
+        self.pdf_sha256 = None
+        self.tempdir = None
+        self.pages = []
+        self.page_count = 0
+        self.stats = None
+        self.text = ''
+        self.start = None
+
+
+class Stage:
+    # a pool of threads pulling WorkItems from inbox, calling func on them
+    # and pushing them to outbox.  func returns False to drop the item; a
+    # dropped item is still passed on so the writer can account for it.
+    # gate(), if given, is asked before func and returning False abandons
+    # the item
+    def __init__(self, name, func, workers, inbox, outbox, gate=None):
+        self.name = name
+        self.func = func
+        self.gate = gate
+        self.workers = max(1, int(workers))
+        self.inbox = inbox
+        self.outbox = outbox
+        self.running = self.workers
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'{self.name}-{n}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self.inbox.get()
+            if item is None:
+                # hand the sentinel to the sibling workers, the last one out
+                # passes it down the line
+                self.inbox.put(None)
+                with self.lock:
+                    self.running -= 1
+                    if self.running == 0:
+                        self.outbox.put(None)
+                return
+            if not item.dropped and self.gate is not None and not self.gate():
+                item.dropped = True
+                item.abandoned = True
+            if not item.dropped:
+                try:
+                    if self.func(item) is False:
+                        item.dropped = True
+                except Exception:
+                    LOGGER.exception(f'{self.name} failed for {item.k_number}')
+                    item.dropped = True
+                    item.failed = True
+            self.outbox.put(item)
+
+
+class Pipeline:
+    # stages is a list of (name, func, workers).  Items leave the last stage
+    # in any order; the single writer thread re-sequences them so that
+    # writer(item) is called in crawl order and checkpoint(item) is only
+    # called once every hit of a page has been written.  done(item), if
+    # given, is called in order for every item, dropped ones included.
+    # gate() is asked before every stage of every item, see Stage.  Once an
+    # item has been abandoned or has failed the checkpoint never moves again
+    def __init__(self, stages, writer, checkpoint, queue_size=default_queue_size, done=None, gate=None):
+        self.writer = writer
+        self.checkpoint = checkpoint
+        self.done = done
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self.stages = [
+            Stage(name, func, workers, self.queues[i], self.queues[i + 1], gate)
+            for i, (name, func, workers) in enumerate(stages)
+        ]
+        self.writerThread = threading.Thread(target=self._write, name='writer', daemon=True)
+        self.next_seq = 0
+        self.error = None
+        self.abandoned = False
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        self.writerThread.start()
+
+    def submit(self, item):
+        # blocks while the first queue is full, which is what bounds memory
+        self.queues[0].put(item)
+
+    def depths(self):
+        # {stage: items waiting for it}, the writer included
+        depths = {stage.name: stage.inbox.qsize() for stage in self.stages}
+        depths['write'] = self.queues[-1].qsize()
+        return depths
+
+    def close(self):
+        self.queues[0].put(None)
+        for stage in self.stages:
+            stage.join()
+        self.writerThread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _write(self):
+        pending = {}
+        while True:
+            item = self.queues[-1].get()
+            if item is None:
+                break
+            pending[item.seq] = item
+            while self.next_seq in pending:
+                ready = pending.pop(self.next_seq)
+                try:
+                    if not ready.dropped:
+                        self.writer(ready)
+                    if self.done is not None:
+                        self.done(ready)
+                    # after a failed write, or an item abandoned or failed in
+                    # a stage, the checkpoint must not move past it so the
+                    # next run starts over from its page
+                    if ready.failed and not self.abandoned:
+                        LOGGER.warning(f'{ready.k_number} failed, the checkpoint stays before it for the next run')
+                    self.abandoned = self.abandoned or ready.abandoned or ready.failed
+                    if ready.last_in_page and self.error is None and not self.abandoned:
+                        self.checkpoint(ready)
+                except Exception as e:
+                    LOGGER.exception(f'writer failed for {ready.k_number}')
+                    self.error = e
+                finally:
+                    if ready.tempdir is not None:
+                        shutil.rmtree(ready.tempdir, ignore_errors=True)
+                self.next_seq += 1
+        if pending:
+            LOGGER.error(f'{len(pending)} items were never written, first missing sequence {self.next_seq}')
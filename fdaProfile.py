@@ -0,0 +1,278 @@
+import json
+import logging
+import marshal
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+
+LOGGER = logging.getLogger('fda')
+
+PROFILE_FOLDER = 'profile/'
+# seconds between stack samples, a hundred a second costs about a percent
+default_sample_interval = 0.01
+# K-numbers in the slow path report
+default_slowest = 20
+# seconds between rewrites of the reports during a crawl
+default_report_interval = 60
+# frames kept per sample, counted from the innermost
+max_depth = 64
+# documents tracked before the faster half is forgotten
+max_documents = 10000
+# hottest functions listed per slow document
+hot_functions = 3
+
+
+def functionName(function):
+    filename, line, name = function
+    return f'{os.path.basename(filename)}:{line}({name})'
+
+
+def toStats(samples, interval):
+    # samples is {stack, innermost frame first: count}, returns what a
+    # marshal'ed cProfile dump holds, {(file, line, function): (calls,
+    # calls, own seconds, cumulative seconds, {caller: (the same four)})}.
+    # A function is counted once per sample whatever its recursion
+    stats = {}
+    for stack, count in samples.items():
+        seconds = count * interval
+        seen = set()
+        for depth, function in enumerate(stack):
+            entry = stats.setdefault(function, [0, 0, 0.0, 0.0, {}])
+            own = seconds if depth == 0 else 0.0
+            entry[2] += own
+            if function not in seen:
+                seen.add(function)
+                entry[0] += count
+                entry[1] += count
+                entry[3] += seconds
+            if depth + 1 < len(stack):
+                calls = entry[4].setdefault(stack[depth + 1], [0, 0, 0.0, 0.0])
+                calls[0] += count
+                calls[1] += count
+                calls[2] += own
+                calls[3] += seconds
+    return {function: (cc, nc, tt, ct, {caller: tuple(calls) for caller, calls in callers.items()})
+            for function, (cc, nc, tt, ct, callers) in stats.items()}
+
+
+def writeAtomic(path, data):
+    # replaced in one rename so a report is never read half written
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as fh:
+        fh.write(data)
+    os.replace(temp, path)
+
+
+class Profiler:
+    # Profiling by stage, cheap enough to leave on during a crawl.  Attached
+    # to a Metrics as its profiler, every Metrics.timed stage tells it when
+    # it starts and ends.  A thread samples the stack of every thread inside
+    # a stage every interval seconds, so the cost is the same however much
+    # work is done.  The samples are written as one pstats file per stage,
+    # read by pstats or snakeviz like a cProfile dump, with call counts being
+    # sample counts and times the samples times the interval.  The exact own
+    # time of every stage, not counting the stages inside it, is added up
+    # per K-number for a report of the slowest documents with their stage
+    # breakdown and hottest functions.  Every process of a pool keeps its
+    # own, the parent merge()s what each one drain()s
+    def __init__(self, prefix='fda'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.interval = None
+        self.contexts = {}
+        self.samples = {}
+        self.documents = {}
+        self.sampler = None
+        self.stopping = threading.Event()
+        self.folder = None
+        self.slowest = default_slowest
+        self.writer = None
+
+    @property
+    def running(self):
+        return self.interval is not None
+
+    def start(self, interval=default_sample_interval):
+        # anything recorded so far is forgotten, a forked process starts
+        # with a copy of its parent's, and of its lock as the parent's
+        # sampler may have held it
+        self.lock = threading.Lock()
+        self.contexts = {}
+        self.samples = {}
+        self.documents = {}
+        self.interval = interval
+        if self.sampler is None or not self.sampler.is_alive():
+            self.stopping = threading.Event()
+            self.sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+            self.sampler.start()
+
+    def _context(self):
+        ident = threading.get_ident()
+        context = self.contexts.get(ident)
+        if context is None:
+            context = self.contexts[ident] = {'document': None, 'stages': []}
+        return context
+
+    def _record(self, document):
+        # called with the lock held
+        record = self.documents.get(document)
+        if record is None:
+            if len(self.documents) >= max_documents:
+                ranked = sorted(self.documents.items(), key=lambda item: sum(item[1]['stages'].values()), reverse=True)
+                self.documents = dict(ranked[:max_documents // 2])
+            record = self.documents[document] = {'stages': {}, 'frames': {}}
+        return record
+
+    def enter(self, stage):
+        if self.interval is None:
+            return
+        self._context()['stages'].append([stage, 0.0])
+
+    def exit(self, seconds):
+        if self.interval is None:
+            return
+        context = self.contexts.get(threading.get_ident())
+        if context is None or len(context['stages']) == 0:
+            return
+        stage, inner = context['stages'].pop()
+        if len(context['stages']) != 0:
+            context['stages'][-1][1] += seconds
+        document = context['document']
+        if document is not None:
+            with self.lock:
+                stages = self._record(document)['stages']
+                stages[stage] = stages.get(stage, 0.0) + seconds - inner
+
+    @contextmanager
+    def document(self, k_number):
+        # the stages run inside are added to k_number's breakdown
+        if self.interval is None:
+            yield
+            return
+        context = self._context()
+        previous = context['document']
+        context['document'] = k_number
+        try:
+            yield
+        finally:
+            context['document'] = previous
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, frame in frames.items():
+                    context = self.contexts.get(ident)
+                    if ident == me or context is None:
+                        continue
+                    try:
+                        stage = context['stages'][-1][0]
+                    except IndexError:
+                        continue  # not inside a stage
+                    stack = []
+                    while frame is not None and len(stack) < max_depth:
+                        code = frame.f_code
+                        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                        frame = frame.f_back
+                    key = (stage, tuple(stack))
+                    self.samples[key] = self.samples.get(key, 0) + 1
+                    document = context['document']
+                    if document is not None:
+                        hot = self._record(document)['frames']
+                        hot[stack[0]] = hot.get(stack[0], 0) + 1
+
+    def drain(self):
+        # everything recorded since the last drain, for merge()
+        with self.lock:
+            drained = (self.samples, self.documents)
+            self.samples = {}
+            self.documents = {}
+        return drained
+
+    def merge(self, drained):
+        samples, documents = drained
+        with self.lock:
+            for key, count in samples.items():
+                self.samples[key] = self.samples.get(key, 0) + count
+            for document, theirs in documents.items():
+                mine = self._record(document)
+                for part in ('stages', 'frames'):
+                    for key, value in theirs[part].items():
+                        mine[part][key] = mine[part].get(key, 0) + value
+
+    def report(self, count=default_slowest):
+        # the slowest documents, most time first, with their stage breakdown
+        # and the functions most often found running in them
+        with self.lock:
+            documents = [(document, dict(record['stages']), dict(record['frames']))
+                         for document, record in self.documents.items()]
+        documents.sort(key=lambda item: sum(item[1].values()), reverse=True)
+        report = []
+        for document, stages, frames in documents[:count]:
+            hot = sorted(frames.items(), key=lambda item: item[1], reverse=True)[:hot_functions]
+            report.append({
+                'k_number': document,
+                'seconds': round(sum(stages.values()), 4),
+                'stages': {stage: round(seconds, 4) for stage, seconds in sorted(stages.items())},
+                'hot': [[functionName(function), round(samples * self.interval, 4)] for function, samples in hot],
+            })
+        return report
+
+    def write(self, folder):
+        # <prefix>-<stage>.pstats for every stage sampled, <prefix>-all.pstats
+        # for all of them, and the slow path report as <prefix>-slowest.json
+        # and a table in <prefix>-slowest.txt
+        os.makedirs(folder, exist_ok=True)
+        with self.lock:
+            samples = dict(self.samples)
+        byStage = {}
+        everything = {}
+        for (stage, stack), count in samples.items():
+            byStage.setdefault(stage, {})[stack] = count
+            everything[stack] = everything.get(stack, 0) + count
+        for stage, stageSamples in list(byStage.items()) + [('all', everything)]:
+            writeAtomic(os.path.join(folder, f'{self.prefix}-{stage}.pstats'),
+                        marshal.dumps(toStats(stageSamples, self.interval)))
+        report = self.report(self.slowest)
+        writeAtomic(os.path.join(folder, f'{self.prefix}-slowest.json'), json.dumps(report, indent=1).encode())
+        stages = sorted(set(stage for entry in report for stage in entry['stages']))
+        lines = [f'{"K-number":<10} {"seconds":>9} ' + ' '.join(f'{stage:>14}' for stage in stages) + '  hottest']
+        for entry in report:
+            hot = entry['hot'][0][0] if entry['hot'] else '-'
+            lines.append(f'{entry["k_number"]:<10} {entry["seconds"]:9.3f} '
+                         + ' '.join(f'{entry["stages"].get(stage, 0.0):14.3f}' for stage in stages) + f'  {hot}')
+        writeAtomic(os.path.join(folder, f'{self.prefix}-slowest.txt'), ('\n'.join(lines) + '\n').encode())
+
+    def export(self, folder, slowest=default_slowest, interval=None):
+        # write the reports to folder on close(), and every interval seconds
+        # until then when given
+        self.folder = folder
+        self.slowest = slowest
+        if interval is not None:
+            self.writer = threading.Thread(target=self._write, args=(interval,), name='profile-writer', daemon=True)
+            self.writer.start()
+
+    def _write(self, interval):
+        while not self.stopping.wait(interval):
+            try:
+                self.write(self.folder)
+            except OSError as e:
+                LOGGER.error(f'Cannot write the profile to {self.folder}, {e}')
+
+    def close(self):
+        # the reports are written a last time with the final samples
+        if self.interval is None:
+            return
+        self.stopping.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        if self.writer is not None:
+            self.writer.join()
+        if self.folder is not None:
+            self.write(self.folder)
+            LOGGER.info(f'Profile written to {self.folder}, slowest documents in '
+                        f'{os.path.join(self.folder, self.prefix + "-slowest.txt")}')
+        self.interval = None
@@ -0,0 +1,373 @@
+import bisect
+import logging
+import re
+
+from rapidfuzz import fuzz, process
+
+from fdaMatch import normalize
+
+
+LOGGER = logging.getLogger('fda_search')
+
+# "quoted phrase", bare word, parentheses, NEAR/k and field: prefixes
+TOKEN = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|(NEAR/\d+)\b|([^\s()"]+))')
+FIELDS = ('text', 'name')
+WORD = re.compile(r'\w+')
+
+# what one clause costs on one document, relative to each other: the device
+# name is a short string, a text term a fuzzy scan of the whole OCR text
+# and a proximity clause a fuzzy match at every word of it
+NAME_COST = 1
+TEXT_COST = 100
+NEAR_COST = 400
+# share of documents a clause is assumed to pass when nothing better is known
+default_selectivity = 0.5
+
+
+class Term:
+    def __init__(self, text, field='text'):
+        self.text = text
+        self.field = field
+        self.query = normalize(text)
+        # a device name term is a regular expression, lowercasing it would
+        # turn \D, \S or \W into \d, \s or \w
+        self.pattern = None
+        if field == 'name':
+            try:
+                self.pattern = re.compile(text, re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f'name:{text} is not a regular expression, {e}')
+        self.words = len(WORD.findall(self.query)) or 1
+        self.cost = NAME_COST if field == 'name' else TEXT_COST
+        self.selectivity = default_selectivity
+        # K-numbers the trigram index says can match, None for any
+        self.candidates = None
+
+    def evaluate(self, doc, positive=True):
+        return doc.termMatch(self, positive)
+
+    def terms(self):
+        return [self]
+
+    def describe(self):
+        return f'{self.field}:"{self.text}"'
+
+
+class Near:
+    # both terms in the OCR text with at most distance words between them
+    def __init__(self, left, right, distance):
+        if left.field != 'text' or right.field != 'text':
+            raise ValueError('NEAR only works on the OCR text')
+        self.left = left
+        self.right = right
+        self.distance = distance
+        self.cost = NEAR_COST
+        self.selectivity = default_selectivity
+
+    def evaluate(self, doc, positive=True):
+        return doc.near(self, positive)
+
+    def terms(self):
+        return [self.left, self.right]
+
+    def describe(self):
+        return f'{self.left.describe()} NEAR/{self.distance} {self.right.describe()}'
+
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+    @property
+    def cost(self):
+        return self.child.cost
+
+    @property
+    def selectivity(self):
+        return 1 - self.child.selectivity
+
+    def evaluate(self, doc, positive=True):
+        return not self.child.evaluate(doc, not positive)
+
+    def terms(self):
+        return self.child.terms()
+
+    def describe(self):
+        return f'NOT {self.child.describe()}'
+
+
+class And:
+    def __init__(self, children):
+        self.children = children
+
+    @property
+    def cost(self):
+        return sum(child.cost for child in self.children)
+
+    @property
+    def selectivity(self):
+        share = 1.0
+        for child in self.children:
+            share *= child.selectivity
+        return share
+
+    def order(self):
+        # cheapest clause most likely to fail first
+        self.children.sort(key=lambda child: child.cost / max(1 - child.selectivity, 1e-6))
+
+    def evaluate(self, doc, positive=True):
+        return all(child.evaluate(doc, positive) for child in self.children)
+
+    def terms(self):
+        return [term for child in self.children for term in child.terms()]
+
+    def describe(self):
+        return '(' + ' AND '.join(child.describe() for child in self.children) + ')'
+
+
+class Or:
+    def __init__(self, children):
+        self.children = children
+
+    @property
+    def cost(self):
+        return sum(child.cost for child in self.children)
+
+    @property
+    def selectivity(self):
+        share = 1.0
+        for child in self.children:
+            share *= 1 - child.selectivity
+        return 1 - share
+
+    def order(self):
+        # cheapest clause most likely to pass first
+        self.children.sort(key=lambda child: child.cost / max(child.selectivity, 1e-6))
+
+    def evaluate(self, doc, positive=True):
+        return any(child.evaluate(doc, positive) for child in self.children)
+
+    def terms(self):
+        return [term for child in self.children for term in child.terms()]
+
+    def describe(self):
+        return '(' + ' OR '.join(child.describe() for child in self.children) + ')'
+
+
+def tokenize(query):
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = TOKEN.match(query, position)
+        if match is None or match.end() == position:
+            raise ValueError(f'Cannot read the query at "{query[position:]}"')
+        position = match.end()
+        opening, closing, phrase, near, word = match.groups()
+        if opening:
+            tokens.append(('(', None))
+        elif closing:
+            tokens.append((')', None))
+        elif phrase is not None:
+            tokens.append(('term', phrase))
+        elif near:
+            tokens.append(('near', int(near[len('NEAR/'):])))
+        elif word in ('AND', 'OR', 'NOT'):
+            tokens.append((word, None))
+        elif ':' in word and word.split(':', 1)[0] in FIELDS:
+            field, rest = word.split(':', 1)
+            tokens.append(('field', field))
+            if rest:
+                tokens.append(('term', rest))
+        else:
+            tokens.append(('term', word))
+    return tokens
+
+
+class Parser:
+    # query   := or
+    # or      := and (OR and)*
+    # and     := not ([AND] not)*
+    # not     := NOT not | near
+    # near    := atom (NEAR/k atom)*
+    # atom    := ( query ) | [field:] term
+    def __init__(self, query):
+        self.tokens = tokenize(query)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def take(self, kind):
+        if self.peek() != kind:
+            raise ValueError(f'Expected {kind} in the query, found {self.peek() or "the end"}')
+        value = self.tokens[self.position][1]
+        self.position += 1
+        return value
+
+    def parse(self):
+        node = self.parseOr()
+        if self.peek() is not None:
+            raise ValueError(f'Unexpected {self.peek()} in the query')
+        return node
+
+    def parseOr(self):
+        children = [self.parseAnd()]
+        while self.peek() == 'OR':
+            self.take('OR')
+            children.append(self.parseAnd())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parseAnd(self):
+        children = [self.parseNot()]
+        while self.peek() in ('AND', 'NOT', 'term', 'field', '('):
+            if self.peek() == 'AND':
+                self.take('AND')
+            children.append(self.parseNot())
+        return children[0] if len(children) == 1 else And(children)
+
+    def parseNot(self):
+        if self.peek() == 'NOT':
+            self.take('NOT')
+            return Not(self.parseNot())
+        return self.parseNear()
+
+    def parseNear(self):
+        node = self.parseAtom()
+        while self.peek() == 'near':
+            distance = self.take('near')
+            right = self.parseAtom()
+            if not isinstance(node, Term) or not isinstance(right, Term):
+                raise ValueError('NEAR needs a term on each side')
+            node = Near(node, right, distance)
+        return node
+
+    def parseAtom(self):
+        if self.peek() == '(':
+            self.take('(')
+            node = self.parseOr()
+            self.take(')')
+            return node
+        field = 'text'
+        if self.peek() == 'field':
+            field = self.take('field')
+        return Term(self.take('term'), field)
+
+
+def order(node):
+    # children first, their cost and selectivity feed the parent's order
+    for child in getattr(node, 'children', []):
+        order(child)
+    if isinstance(node, Not):
+        order(node.child)
+    if hasattr(node, 'order'):
+        node.order()
+
+
+class Query:
+    # A compiled query: the parse tree, reordered so every AND and OR
+    # evaluates its cheapest and most decisive clauses first and stops as
+    # soon as the result is known.  Text terms match like search terms do,
+    # partial_ratio above the cutoff, device name terms like the ! terms do
+    # against the device name, as a regular expression
+    def __init__(self, text):
+        self.text = text
+        self.root = Parser(text).parse()
+        order(self.root)
+
+    def terms(self):
+        return self.root.terms()
+
+    def useIndex(self, index, cutoff):
+        # take the selectivity of every text term from the trigram index and
+        # let it rule documents out without reading them, then reorder
+        total = max(len(index.docs), 1)
+        for term in self.terms():
+            if term.field != 'text':
+                continue
+            term.candidates = index.candidates(term.query, cutoff)
+            if term.candidates is not None:
+                term.selectivity = len(term.candidates) / total
+        order(self.root)
+
+    def evaluate(self, doc):
+        return self.root.evaluate(doc)
+
+    def describe(self):
+        return self.root.describe()
+
+
+class QueryDocument:
+    # what a query is evaluated against.  The OCR text is only loaded when a
+    # clause needs it, and every term is scored at most once
+    def __init__(self, k_number, device_name, loadText, cutoff):
+        self.k_number = k_number
+        self.device_name = device_name
+        self.loadText = loadText
+        self.cutoff = cutoff
+        self._text = None
+        self._tokens = None
+        self.scores = {}
+        self.positions = {}
+        self.matched = {}
+
+    def text(self):
+        if self._text is None:
+            self._text = normalize(self.loadText())
+        return self._text
+
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = WORD.findall(self.text())
+        return self._tokens
+
+    def termMatch(self, term, positive=True):
+        if term.field == 'name':
+            return term.pattern.search(self.device_name) is not None
+        if term.candidates is not None and self.k_number not in term.candidates:
+            return False
+        score = self.scores.get(term.query)
+        if score is None:
+            score = int(round(fuzz.partial_ratio(term.query, self.text(), processor=None)))
+            self.scores[term.query] = score
+        if score > self.cutoff:
+            if positive:
+                self.matched[term.text] = score
+            return True
+        return False
+
+    def wordPositions(self, term):
+        # sorted (word index, score) of every run of words matching term
+        found = self.positions.get(term.query)
+        if found is None:
+            tokens = self.tokens()
+            grams = [' '.join(tokens[i:i + term.words]) for i in range(len(tokens) - term.words + 1)]
+            matches = process.extract(term.query, grams, scorer=fuzz.ratio, processor=None,
+                                      score_cutoff=self.cutoff, limit=None)
+            found = sorted((index, int(round(score))) for _, score, index in matches
+                           if int(round(score)) > self.cutoff)
+            self.positions[term.query] = found
+        return found
+
+    def near(self, clause, positive=True):
+        left = self.wordPositions(clause.left)
+        right = self.wordPositions(clause.right)
+        starts = [index for index, _ in right]
+        best = None
+        for index, score in left:
+            # right term starting from distance words before the left one
+            # to distance words after it
+            low = bisect.bisect_left(starts, index - clause.right.words - clause.distance)
+            high = bisect.bisect_right(starts, index + clause.left.words + clause.distance)
+            for rightIndex, rightScore in right[low:high]:
+                pair = min(score, rightScore)
+                if best is None or pair > best:
+                    best = pair
+        if best is None:
+            return False
+        if positive:
+            self.matched[clause.describe()] = best
+        return True
+
+    def hits(self):
+        return [[text, score] for text, score in self.matched.items()]
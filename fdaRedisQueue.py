@@ -0,0 +1,350 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+
+import redis
+
+from fdaIngest import WorkQueue, WORK_DB
+
+
+LOGGER = logging.getLogger('fda')
+
+REDIS_URL = 'redis://localhost:6379/0'
+QUEUE_NAME = 'FDAQUEUE'
+# seconds a worker may hold a hit without renewing its lease, and the times
+# a hit is handed out before it goes to the dead letter list
+default_lease = 900
+default_max_attempts = 3
+
+insert_batch = 1000
+
+# every script gets the same keys, in this order
+KEY_NAMES = ('pending', 'leases', 'owners', 'attempts', 'status', 'counts', 'dead', 'hits', 'errors')
+
+PREAMBLE = '''
+local pending, leases, owners, attempts, status, counts, dead, hits, errors =
+    KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5], KEYS[6], KEYS[7], KEYS[8], KEYS[9]
+local function move(k, to)
+    local old = redis.call('HGET', status, k)
+    if old then redis.call('HINCRBY', counts, old, -1) end
+    redis.call('HSET', status, k, to)
+    redis.call('HINCRBY', counts, to, 1)
+end
+local function owned(k, worker)
+    return redis.call('HGET', owners, k) == worker
+end
+local function unlease(k)
+    redis.call('ZREM', leases, k)
+    redis.call('HDEL', owners, k)
+end
+'''
+
+SCRIPTS = {
+    # ARGV k_number, hit json, k_number, hit json ...
+    'add': '''
+local added = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('HSETNX', hits, ARGV[i], ARGV[i + 1]) == 1 then
+        redis.call('LPUSH', pending, ARGV[i])
+        move(ARGV[i], 'pending')
+        added = added + 1
+    end
+end
+return added
+''',
+    # ARGV now, max attempts
+    'reap': '''
+local requeued, buried = 0, 0
+for _, k in ipairs(redis.call('ZRANGEBYSCORE', leases, '-inf', ARGV[1])) do
+    unlease(k)
+    if tonumber(redis.call('HGET', attempts, k) or '0') >= tonumber(ARGV[2]) then
+        redis.call('HSET', errors, k, 'lease expired')
+        redis.call('LPUSH', dead, k)
+        move(k, 'dead')
+        buried = buried + 1
+    else
+        redis.call('LPUSH', pending, k)
+        move(k, 'pending')
+        requeued = requeued + 1
+    end
+end
+return {requeued, buried}
+''',
+    # ARGV lease expiry, worker, count
+    'claim': '''
+local claimed = {}
+for i = 1, tonumber(ARGV[3]) do
+    local k = redis.call('RPOP', pending)
+    if not k then break end
+    redis.call('ZADD', leases, ARGV[1], k)
+    redis.call('HSET', owners, k, ARGV[2])
+    redis.call('HINCRBY', attempts, k, 1)
+    move(k, 'leased')
+    claimed[#claimed + 1] = k
+end
+return claimed
+''',
+    # ARGV lease expiry, worker, k_number ...
+    'renew': '''
+local renewed = 0
+for i = 3, #ARGV do
+    if owned(ARGV[i], ARGV[2]) then
+        redis.call('ZADD', leases, 'XX', ARGV[1], ARGV[i])
+        renewed = renewed + 1
+    end
+end
+return renewed
+''',
+    # ARGV k_number, worker, status
+    'ack': '''
+if not owned(ARGV[1], ARGV[2]) then return 0 end
+unlease(ARGV[1])
+move(ARGV[1], ARGV[3])
+return 1
+''',
+    # ARGV k_number, worker, max attempts, error
+    'fail': '''
+if not owned(ARGV[1], ARGV[2]) then return 0 end
+unlease(ARGV[1])
+redis.call('HSET', errors, ARGV[1], ARGV[4])
+if tonumber(redis.call('HGET', attempts, ARGV[1]) or '0') >= tonumber(ARGV[3]) then
+    redis.call('LPUSH', dead, ARGV[1])
+    move(ARGV[1], 'dead')
+    return 2
+end
+redis.call('LPUSH', pending, ARGV[1])
+move(ARGV[1], 'pending')
+return 1
+''',
+    # ARGV worker, k_number ...
+    'release': '''
+local released = 0
+for i = 2, #ARGV do
+    if owned(ARGV[i], ARGV[1]) then
+        unlease(ARGV[i])
+        redis.call('HINCRBY', attempts, ARGV[i], -1)
+        redis.call('RPUSH', pending, ARGV[i])
+        move(ARGV[i], 'pending')
+        released = released + 1
+    end
+end
+return released
+''',
+    'retry_dead': '''
+local retried = 0
+for _, k in ipairs(redis.call('LRANGE', dead, 0, -1)) do
+    redis.call('HDEL', attempts, k)
+    redis.call('LPUSH', pending, k)
+    move(k, 'pending')
+    retried = retried + 1
+end
+redis.call('DEL', dead)
+return retried
+''',
+}
+
+
+def workerName():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class LeasedQueue:
+    # K-numbers shared through redis by any number of fdaMain workers on any
+    # number of hosts.  A worker claims a few hits at a time, each under a
+    # lease it keeps renewing while it works on the hit.  A hit whose lease
+    # runs out, because its worker died or hung, goes back to the queue for
+    # another worker.  After maxAttempts claims a hit goes to the dead letter
+    # list instead.  Every change is one lua script, so workers never see a
+    # hit half moved and never need a lock of their own.  Lease times come
+    # from the redis clock so hosts don't need synchronized clocks.  Works
+    # with fakeredis (with its lua extra) as well as a real server
+    def __init__(self, redisHandle, name=QUEUE_NAME, lease=default_lease, maxAttempts=default_max_attempts):
+        self.redis = redisHandle
+        self.name = name
+        self.lease = lease
+        self.maxAttempts = maxAttempts
+        self.keys = [f'{name}:{key}' for key in KEY_NAMES]
+        self.scripts = {script: redisHandle.register_script(PREAMBLE + body) for script, body in SCRIPTS.items()}
+
+    def _run(self, script, *args):
+        return self.scripts[script](keys=self.keys, args=list(args))
+
+    def now(self):
+        seconds, microseconds = self.redis.time()
+        return seconds + microseconds / 1e6
+
+    def add(self, hits):
+        # hits already queued, in whatever state, are left alone.  Returns
+        # how many were new
+        added = 0
+        hits = list(hits)
+        for start in range(0, len(hits), insert_batch):
+            args = []
+            for hit in hits[start:start + insert_batch]:
+                args += [hit['k_number'], json.dumps(hit)]
+            added += self._run('add', *args)
+        return added
+
+    def reap(self):
+        # put the hits with expired leases back, returns (requeued, dead)
+        requeued, buried = self._run('reap', self.now(), self.maxAttempts)
+        if requeued or buried:
+            LOGGER.warning(f'{requeued} expired leases requeued, {buried} hits moved to the dead letter list')
+        return requeued, buried
+
+    def claim(self, worker, count=1):
+        # up to count hits leased to worker, oldest first
+        self.reap()
+        claimed = self._run('claim', self.now() + self.lease, worker, count)
+        if len(claimed) == 0:
+            return []
+        return [json.loads(hit) for hit in self.redis.hmget(self.keys[KEY_NAMES.index('hits')], claimed)]
+
+    def renew(self, worker, k_numbers):
+        # extend the leases worker still holds, returns how many it did
+        if len(k_numbers) == 0:
+            return 0
+        return self._run('renew', self.now() + self.lease, worker, *k_numbers)
+
+    def ack(self, worker, k_number, status='done'):
+        # False if the lease was lost, the hit has been requeued meanwhile
+        return self._run('ack', k_number, worker, status) == 1
+
+    def fail(self, worker, k_number, error='failed'):
+        # requeue a hit worker could not finish, or move it to the dead
+        # letter list once it has used up its attempts.  Returns its new
+        # status, None if the lease was lost
+        result = self._run('fail', k_number, worker, self.maxAttempts, error)
+        return {1: 'pending', 2: 'dead'}.get(result)
+
+    def release(self, worker, k_numbers):
+        # give back hits worker claimed but never started, the claim doesn't
+        # count as an attempt
+        if len(k_numbers) == 0:
+            return 0
+        return self._run('release', worker, *k_numbers)
+
+    def retryDead(self):
+        return self._run('retry_dead')
+
+    def dead(self):
+        # [(k_number, last error)] of the dead letter list
+        k_numbers = [k.decode() for k in self.redis.lrange(self.keys[KEY_NAMES.index('dead')], 0, -1)]
+        if len(k_numbers) == 0:
+            return []
+        errors = self.redis.hmget(self.keys[KEY_NAMES.index('errors')], k_numbers)
+        return [(k, error.decode() if error else '') for k, error in zip(k_numbers, errors)]
+
+    def counts(self):
+        counts = self.redis.hgetall(self.keys[KEY_NAMES.index('counts')])
+        return {status.decode(): int(count) for status, count in counts.items() if int(count) != 0}
+
+    def outstanding(self):
+        # hits still pending or leased to a worker
+        return self.redis.llen(self.keys[KEY_NAMES.index('pending')]) + self.redis.zcard(self.keys[KEY_NAMES.index('leases')])
+
+
+class LeaseKeeper:
+    # renews the leases of the hits a worker holds a third of a lease apart,
+    # from a thread of its own so a long OCR never loses its hit.  Hits the
+    # worker has started on are told apart from ones it only claimed
+    def __init__(self, queue, worker):
+        self.queue = queue
+        self.worker = worker
+        self.held = set()
+        self.started = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='lease-keeper', daemon=True)
+        self.thread.start()
+
+    def hold(self, k_numbers):
+        with self.lock:
+            self.held.update(k_numbers)
+
+    def start(self, k_number):
+        with self.lock:
+            self.started.add(k_number)
+
+    def drop(self, k_number):
+        with self.lock:
+            self.held.discard(k_number)
+            self.started.discard(k_number)
+
+    def _run(self):
+        while not self.stopping.wait(self.queue.lease / 3):
+            with self.lock:
+                held = list(self.held)
+            try:
+                renewed = self.queue.renew(self.worker, held)
+            except redis.RedisError as e:
+                LOGGER.error(f'Cannot renew leases, {e}')
+                continue
+            if renewed < len(held):
+                LOGGER.warning(f'{len(held) - renewed} leases of {self.worker} were lost')
+
+    def stop(self):
+        # stops renewing and gives back whatever is still held.  Hits never
+        # started go back without using an attempt, a hit the worker was on
+        # when it stopped counts as failed so one that keeps crashing workers
+        # ends up in the dead letter list.  Returns (released, failed)
+        self.stopping.set()
+        self.thread.join()
+        with self.lock:
+            started = list(self.started & self.held)
+            unstarted = list(self.held - self.started)
+            self.held = set()
+            self.started = set()
+        for k_number in started:
+            if self.queue.fail(self.worker, k_number, 'worker stopped while on it') == 'dead':
+                LOGGER.error(f'{k_number} moved to the dead letter list')
+        return self.queue.release(self.worker, unstarted), len(started)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="fda-queue",
+        description='Queue the pending hits of the local work queue in redis for fdaMain --source redis workers'
+    )
+    parser.add_argument('--work-db', action='store', default=WORK_DB, help='work queue database loaded by fdaIngest')
+    parser.add_argument('--since', action='store', metavar='YYYY-MM-DD', help='only clearances decided on or after this date')
+    parser.add_argument('--redis-url', action='store', default=REDIS_URL, help='redis server the workers share')
+    parser.add_argument('--queue', action='store', default=QUEUE_NAME, help='prefix of the queue keys')
+    parser.add_argument('--max-attempts', action='store', type=int, default=default_max_attempts, help='claims before a hit goes to the dead letter list')
+    parser.add_argument('--status', action='store_true', help='only show the state of the queue')
+    parser.add_argument('--dead', action='store_true', help='list the dead letter hits and their last error')
+    parser.add_argument('--retry-dead', action='store_true', help='queue the dead letter hits again with fresh attempts')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    queue = LeasedQueue(redis.Redis.from_url(args.redis_url), args.queue, maxAttempts=args.max_attempts)
+    if args.dead:
+        for k_number, error in queue.dead():
+            print(f'{k_number} {error}')
+    elif args.retry_dead:
+        LOGGER.info(f'{queue.retryDead()} dead letter hits queued again')
+    elif not args.status:
+        if not os.path.exists(args.work_db):
+            LOGGER.error(f"Cant find the work queue {args.work_db}, load it with fdaIngest first")
+            sys.exit(1)
+        workQueue = WorkQueue(args.work_db)
+        added = 0
+        after = 0
+        while True:
+            rows = workQueue.pending(insert_batch, after, args.since)
+            if len(rows) == 0:
+                break
+            after = rows[-1][0]
+            added += queue.add([hit for rowid, hit in rows])
+        workQueue.close()
+        LOGGER.info(f'{added} hits queued')
+    queue.reap()
+    LOGGER.info(f'Queue {args.queue} {queue.counts()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+RESULT_CACHE_DB = 'data/result_cache.db'
+default_cache_rows = 5000000
+# stored, less the prefilter's QUALITY in thousandths, for a term the
+# prefilter found no spelling of.  A 0 to later prefilter runs at that
+# QUALITY or under, not scored at all to other runs
+UNFLAGGED = -1
+
+
+def unflagged(quality):
+    return UNFLAGGED - int(round(quality * 1000))
+
+
+def passedOver(score, quality):
+    # whether a prefilter at quality would pass over the term stored with
+    # score too.  The spellings are the same at any quality, and a document
+    # good enough for a higher one is good enough for this one
+    return score <= UNFLAGGED and UNFLAGGED - score >= int(round(quality * 1000))
+
+
+def documentVersion(path):
+    # changes whenever out_text.txt is written again
+    st = os.stat(path)
+    return f'{st.st_mtime_ns}-{st.st_size}'
+
+
+class ResultCache:
+    # The raw partial_ratio of every (term, document) fdaSearch has scored,
+    # under the version of the document's out_text.txt, and the K-numbers
+    # found in each document.  Scores are stored before any cutoff so runs
+    # with another cutoff, sort order or a term list sharing terms with an
+    # earlier one only score what is new.  A document OCRed again gets a new
+    # version and is scored again.  Once past maxRows scores the least
+    # recently used terms are dropped.  Scan processes only read it and
+    # buffer what they scored, the main process writes it
+    def __init__(self, path=RESULT_CACHE_DB, maxRows=default_cache_rows):
+        self.maxRows = maxRows
+        self.lock = threading.Lock()
+        self.pending = []
+        self.cnx = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.cnx.execute('''CREATE TABLE IF NOT EXISTS scores (
+            term TEXT NOT NULL,
+            k_number TEXT NOT NULL,
+            version TEXT NOT NULL,
+            score INTEGER NOT NULL,
+            PRIMARY KEY (term, k_number))''')
+        self.cnx.execute('CREATE INDEX IF NOT EXISTS scores_k_number ON scores(k_number)')
+        self.cnx.execute('''CREATE TABLE IF NOT EXISTS terms (
+            term TEXT PRIMARY KEY,
+            last_used REAL NOT NULL)''')
+        self.cnx.execute('''CREATE TABLE IF NOT EXISTS documents (
+            k_number TEXT PRIMARY KEY,
+            version TEXT NOT NULL,
+            k_numbers TEXT NOT NULL)''')
+        self.cnx.commit()
+
+    def lookup(self, k_number, version, terms):
+        # {term: score} for the terms scored against this version of k_number
+        terms = list(terms)
+        with self.lock:
+            rows = self.cnx.execute(f'''SELECT term, score FROM scores WHERE k_number = ? AND version = ?
+                AND term IN ({','.join('?' * len(terms))})''', [k_number, version] + terms).fetchall()
+        return dict(rows)
+
+    def references(self, k_number, version):
+        # the K-numbers found in this version of k_number, None if unknown
+        with self.lock:
+            row = self.cnx.execute('SELECT k_numbers FROM documents WHERE k_number = ? AND version = ?',
+                                   (k_number, version)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def remember(self, k_number, version, scores, references=None):
+        # kept until drain(), so scan processes never write
+        self.pending.append((k_number, version, scores, references))
+
+    def drain(self):
+        pending = self.pending
+        self.pending = []
+        return pending
+
+    def store(self, pending):
+        with self.lock:
+            for k_number, version, scores, references in pending:
+                self.cnx.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)',
+                                     [(term, k_number, version, score) for term, score in scores.items()])
+                if references is not None:
+                    self.cnx.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?)',
+                                     (k_number, version, json.dumps(references)))
+            self.cnx.commit()
+
+    def touch(self, terms):
+        now = time.time()
+        with self.lock:
+            self.cnx.executemany('INSERT OR REPLACE INTO terms VALUES (?, ?)', [(term, now) for term in terms])
+            self.cnx.commit()
+
+    def rows(self):
+        with self.lock:
+            return self.cnx.execute('SELECT count(*) FROM scores').fetchone()[0]
+
+    def evict(self, keep=()):
+        # drop the scores of the least recently used terms, never the ones
+        # in keep, until at most maxRows are left.  Returns the terms dropped
+        dropped = []
+        total = self.rows()
+        while total > self.maxRows:
+            with self.lock:
+                placeholders = ','.join('?' * len(keep))
+                row = self.cnx.execute(f'SELECT term FROM terms WHERE term NOT IN ({placeholders}) '
+                                       'ORDER BY last_used LIMIT 1', list(keep)).fetchone()
+                if row is None:
+                    break
+                count = self.cnx.execute('DELETE FROM scores WHERE term = ?', row).rowcount
+                self.cnx.execute('DELETE FROM terms WHERE term = ?', row)
+                self.cnx.commit()
+            dropped.append(row[0])
+            total -= count
+        return dropped
+
+    def close(self):
+        self.cnx.close()
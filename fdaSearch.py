@@ -8,11 +8,19 @@ from pathlib import Path
 import json
 import shutil
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 # from models import PanelModel, DeviceModel, session, base, engine
 import sqlite3
 
 
-from fuzzywuzzy import fuzz
+from fdaCorpus import Corpus, CORPUS_FOLDER
+from fdaIndex import TrigramIndex, INDEX_FILE
+from fdaMatch import Prefilter, StreamMatcher, TermMatcher, normalize, stripNegation, default_chunk_size, min_word_share
+from fdaMetadata import MetadataStore, METADATA_DB
+from fdaMetrics import Metrics
+from fdaProfile import Profiler, PROFILE_FOLDER, default_sample_interval, default_slowest
+from fdaQuery import Query, QueryDocument
+from fdaResultCache import ResultCache, RESULT_CACHE_DB, default_cache_rows, documentVersion, passedOver, unflagged
 from smart_open import smart_open
 
 searchTermGroups = {  # lead ! mean not, lead 
@@ -57,6 +65,10 @@ IGNORE_TAGS = {"registration_number","fei_number"}
 BASE_DIR = os.path.dirname(os.path.abspath(__name__))
 DB_URI = "sqlite:///" + os.path.join(BASE_DIR, 'fda.db')
 
+LOGGER = logging.getLogger('fda_search')
+METRICS = Metrics('fda_search')
+PROFILER = Profiler('fda_search')
+
     
 def getYear(k):
     match = re.search('K(\d\d)\d{4}',k)
@@ -64,7 +76,21 @@ def getYear(k):
     return ('19' if int(twoDigits) > 75 else '20') + twoDigits
 
 def loadSearchFile(filename):
-    return []
+    # one term per line, blank lines ignored
+    with open(filename) as sfd:
+        lines = sfd.readlines()
+    return [x.strip() for x in lines if x.strip()]
+
+def allTerms(groups):
+    # every term of the term list groups once, in group order
+    terms = []
+    for name, search_list in groups:
+        if isinstance(search_list, Query):
+            continue
+        for item in search_list:
+            if item not in terms:
+                terms.append(item)
+    return terms
     
 def convert2json(data):
     with open(data) as df:
@@ -85,6 +111,260 @@ def convert2json(data):
     # outString += '}'
     return outString
 
+def scanFolder(root, groups, matcher, term_candidates, cutoff, device_dict=None, corpus=None, location=None,
+               prefilter=None, streamer=None, cache=None):
+    # returns a (status, device_dict) for every (name, search_list) in
+    # groups, status is error, negated, miss or hit.  The folder is read
+    # once and the union of the terms scored once, negation stays per group.
+    # A group can be a Query instead of a term list, it reads the OCR text
+    # only if its plan gets to a clause that needs it, whole and unscored
+    # by the prefilter, streamer or cache.
+    # device_dict comes from the metadata database when there is one,
+    # otherwise it is parsed out of data.txt.  The OCR text is sliced out of
+    # the packed corpus when the K-number has a location in it.  With a
+    # prefilter only the terms it finds in the text are fuzzy scored.  A
+    # streamer reads out_text.txt a window at a time instead of all at once.
+    # With a cache, terms already scored against this version of the text
+    # are not scored again and the text is not read if none are left
+    k_number = os.path.basename(root)
+    ocrTextFilename = os.path.join(root,'out_text.txt') 
+    if device_dict is None:
+        dataFilename =  os.path.join(root,'data.txt')    
+        try:
+            with METRICS.timed('parse'):
+                json_string = convert2json(dataFilename)
+                device_dict = json.loads(json_string)
+        except json.JSONDecodeError as e:
+            LOGGER.error(f'Cannot parse {k_number} json string {e}')
+            LOGGER.error(f"{e.doc[e.colno-20:e.colno+20]}")
+            return [('error', None)] * len(groups)
+
+    #  text for skips in device type
+    try:
+        device_name = device_dict['openfda']['device_name'].lower()
+    except:
+        device_name = "missing"
+    negated = set()
+    for name, search_list in groups:
+        if isinstance(search_list, Query):
+            continue
+        for item in search_list:
+            if item.startswith('!'):
+                search_field = item[1:]
+                if re.search(search_field, device_name):
+                    LOGGER.info(f"{k_number} negated device name {device_name} by {search_field}")
+                    negated.add(name) # ignore this device
+                    break
+    live = [(name, search_list) for name, search_list in groups
+            if name not in negated and not isinstance(search_list, Query)]
+
+    # terms the index rules out for this document would score too low
+    score_list = [item for item in allTerms(live)
+                  if term_candidates.get(item) is None or k_number in term_candidates[item]]
+
+    text = []
+    references = []
+    def loadText():
+        # read at most once, whoever needs it first
+        if len(text) == 0:
+            with METRICS.timed('read'):
+                text.append(readText(k_number, ocrTextFilename, corpus, location))
+            METRICS.inc('bytes_total', len(text[0]), stage='read')
+            references.extend(re.findall(r'K\d{6}',text[0]))
+            setPredicates(k_number, device_dict, references)
+        return text[0]
+
+    # use fuzz package to search for terms in the list and deal with incorrect OCR.
+    # A streamed document is read as it is scored, all of it timed as scoring
+    if len(score_list) == 0:
+        scores = {}
+    elif streamer is not None:
+        with METRICS.timed('score'):
+            scores = streamFolder(k_number, ocrTextFilename, device_dict, score_list, streamer, corpus, location, prefilter,
+                                  [search_list for name, search_list in live])
+    elif cache is not None:
+        scores = cachedScores(k_number, ocrTextFilename, device_dict, score_list, matcher, prefilter, cache,
+                              location, loadText, references)
+    else:
+        lines = loadText()
+        with METRICS.timed('score'):
+            scores = readFolder(lines, score_list, matcher, prefilter)
+
+    results = []
+    for name, search_list in groups:
+        if isinstance(search_list, Query):
+            doc = QueryDocument(k_number, device_name, loadText, cutoff)
+            with METRICS.timed('query'):
+                matched = search_list.evaluate(doc)
+            if not matched:
+                results.append(('miss', None))
+                continue
+            # a hit carries predicates if the text was read, a query on the
+            # device name alone never reads it
+            hit_list = doc.hits()
+        elif name in negated:
+            results.append(('negated', None))
+            continue
+        else:
+            hit_list = termHits(k_number, search_list, scores, cutoff)
+            if hit_list is None:
+                results.append(('negated', None))
+                continue
+            if len(hit_list) == 0:
+                results.append(('miss', None))
+                continue
+        LOGGER.info(f'File {k_number}' + (f' {name}' if len(groups) > 1 else ''))        
+        LOGGER.info(f"    Product Code = {device_dict['product_code']}")
+        LOGGER.info(f"    Device name =  {device_name}")       
+        for item,ratio in hit_list:     
+            LOGGER.info(f"        Hit: {item},ratio: {ratio}")
+        group_dict = dict(device_dict)
+        group_dict['hits'] = hit_list
+        results.append(('hit', group_dict))
+    return results
+
+
+def termHits(k_number, search_list, scores, cutoff):
+    # [item, ratio] for every term above the cutoff, None when a ! term is
+    hit_list = [] 
+    for item in search_list:
+        ratio = scores.get(item, 0)
+        if ratio > cutoff:
+            if item.startswith('!'):   #not this
+                LOGGER.info(f"{k_number} content negated by {item[1:]}") 
+                return None
+            hit_list.append([item, ratio])
+    return hit_list
+
+
+def setPredicates(k_number, device_dict, results):
+    # look for predicate information, sorted so every run writes them the same way
+    if results and len(results) != 0:
+        all = set([x.strip() for x in results])
+        all.discard(k_number)
+        device_dict['predicates'] = sorted(all)
+
+
+def folderFiles(root):
+    # the names of the files in root, None when it is gone
+    try:
+        with os.scandir(root) as entries:
+            return [entry.name for entry in entries if entry.is_file()]
+    except FileNotFoundError:
+        return None
+
+
+def readText(k_number, ocrTextFilename, corpus, location):
+    if location is not None:
+        return corpus.text(k_number, location)
+    with open(ocrTextFilename) as ocrInput:
+        return ocrInput.read()
+
+
+def cacheKey(item):
+    return normalize(stripNegation(item))
+
+
+def cachedScores(k_number, ocrTextFilename, device_dict, score_list, matcher, prefilter, cache, location, loadText,
+                 references):
+    # packed text is versioned by where it sits in the corpus, it moves
+    # whenever it is packed again or compacted
+    if location is not None:
+        version = 'corpus:' + ':'.join(str(part) for part in location)
+    else:
+        version = documentVersion(ocrTextFilename)
+    cached = cache.lookup(k_number, version, set(cacheKey(item) for item in score_list))
+    scores = {}
+    for item in score_list:
+        score = cached.get(cacheKey(item))
+        if score is None:
+            continue
+        if score >= 0:
+            scores[item] = score
+        elif prefilter is not None and passedOver(score, prefilter.minQuality):
+            scores[item] = 0
+    todo = [item for item in score_list if item not in scores]
+    if len(todo) == 0:
+        found = cache.references(k_number, version)
+        if found is not None:
+            setPredicates(k_number, device_dict, found)
+            return scores
+    # the matcher has no cutoff here, so these are raw scores
+    lines = loadText()
+    with METRICS.timed('score'):
+        fresh = readFolder(lines, todo, matcher, prefilter)
+    scores.update(fresh)
+    # terms the prefilter passed over are remembered too, or the document
+    # would be read again on every run for them
+    remembered = {}
+    if prefilter is not None:
+        remembered = {cacheKey(item): unflagged(prefilter.minQuality) for item in todo}
+    remembered.update({cacheKey(item): ratio for item, ratio in fresh.items()})
+    cache.remember(k_number, version, remembered, sorted(set(references)))
+    return scores
+
+
+def readFolder(lines, score_list, matcher, prefilter):
+    lowered = normalize(lines)
+    if prefilter is not None:
+        flagged = set(prefilter.flagged(lowered, normalized=True))
+        score_list = [item for item in score_list if item in flagged]
+    return matcher.scores(lowered, score_list, normalized=True)
+
+
+def streamFolder(k_number, ocrTextFilename, device_dict, score_list, streamer, corpus, location, prefilter, groups):
+    results = []
+    if location is not None:
+        stream = corpus.stream(k_number, location)
+    else:
+        stream = open(ocrTextFilename)
+    with stream:
+        best = streamer.scan(stream, score_list, prefilter, lambda window: results.extend(re.findall(r'K\d{6}', window)),
+                             groups)
+    setPredicates(k_number, device_dict, results)
+    for item, (ratio, position) in best.items():
+        if position >= 0:
+            LOGGER.debug(f"{k_number} {item} scored {ratio} at character {position}")
+    return {item: ratio for item, (ratio, position) in best.items()}
+
+
+# per process scan settings, set once by initScanWorker so the chunks sent
+# to the pool are only folder names
+_scan = {}
+
+
+def initScanWorker(groups, cutoff, term_candidates, match_threads, corpus_folder=None, prefilter_quality=None,
+                   stream_chunk=None, cache_path=None, profile_interval=None):
+    _scan['groups'] = groups
+    search_list = allTerms(groups)
+    _scan['cutoff'] = cutoff
+    _scan['term_candidates'] = term_candidates
+    # cached scores are raw so they hold for any cutoff
+    _scan['matcher'] = TermMatcher(search_list, cutoff=cutoff if cache_path is None else None, workers=match_threads)
+    # every process maps the segments itself
+    _scan['corpus'] = Corpus(corpus_folder) if corpus_folder is not None else None
+    _scan['prefilter'] = Prefilter(search_list, prefilter_quality) if prefilter_quality is not None else None
+    _scan['streamer'] = StreamMatcher(search_list, cutoff, stream_chunk) if stream_chunk is not None else None
+    _scan['cache'] = ResultCache(cache_path) if cache_path is not None else None
+    if profile_interval is not None:
+        METRICS.profiler = PROFILER
+        PROFILER.start(profile_interval)
+
+
+def scanChunk(folders):
+    # folders is a list of (root, device_dict or None, corpus location or None),
+    # returns their results, the scores to add to the cache, and the metrics
+    # and profile of this process since its last chunk
+    results = []
+    for root, device_dict, location in folders:
+        with PROFILER.document(os.path.basename(root)):
+            results.append(scanFolder(root, _scan['groups'], _scan['matcher'], _scan['term_candidates'], _scan['cutoff'],
+                                      device_dict, _scan['corpus'], location, _scan['prefilter'], _scan['streamer'],
+                                      _scan['cache']))
+    return (results, _scan['cache'].drain() if _scan['cache'] is not None else [], METRICS.drain(),
+            PROFILER.drain() if PROFILER.running else None)
+
+
 def main(): 
 
     cnx = sqlite3.connect( 'fda.db')
@@ -96,17 +376,37 @@ def main():
         description='This program deep earches the FDA 510(k) database'
     )
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='extra output')
-    parser.add_argument('-o', '--output', action='store', default='-', help='file to output to')
-    parser.add_argument('-f', '--file', action='store', default='none', help='file to get words from')
-    parser.add_argument('-s', '--search', action='store', default='none', help='key for search term groups' )
+    parser.add_argument('-o', '--output', action='store', default='-', help='file to output to, with several groups each gets its own files ending in _<group>')
+    parser.add_argument('-f', '--file', action='append', help='file to get words from, one per line, may be repeated')
+    parser.add_argument('-s', '--search', action='store', default='none', help='comma separated keys of search term groups' )
+    parser.add_argument('-q', '--query', action='append', metavar='[NAME=]QUERY', help='a group given as a query: terms, "phrases", AND, OR, NOT, parentheses, "a" NEAR/5 "b" and name: or text: fields, may be repeated')
+    parser.add_argument('--explain', action='store_true', default=False, help='log the evaluation order of every query')
     parser.add_argument('-p', '--purge', action='store_true', default=False, help='purge empry folders')
     parser.add_argument('-c', '--cutoff', action='store', default=80, help='cutoff value')
     parser.add_argument('--sortby', action='store', default='k_number', help='how to sort the final output')
+    parser.add_argument('-i', '--index', action='store_true', default=False, help='only fuzzy score the documents the trigram index says can match')
+    parser.add_argument('--index-file', action='store', default=INDEX_FILE, help='trigram index, updated with new folders before searching')
+    parser.add_argument('-m', '--metadata', action='store', nargs='?', const=METADATA_DB, help='read the device records from the metadata database instead of every data.txt')
+    parser.add_argument('--product-code', action='store', help='only search these comma separated product codes, needs --metadata')
+    parser.add_argument('--applicant', action='store', help='only search applicants containing this, needs --metadata')
+    parser.add_argument('--committee', action='store', help='only search this advisory committee, needs --metadata')
+    parser.add_argument('--decided-since', action='store', metavar='YYYY-MM-DD', help='only search clearances decided on or after this date, needs --metadata')
+    parser.add_argument('--decided-until', action='store', metavar='YYYY-MM-DD', help='only search clearances decided on or before this date, needs --metadata')
+    parser.add_argument('--corpus', action='store', nargs='?', const=CORPUS_FOLDER, help='read the OCR text from the packed corpus, packing new and changed folders first')
+    parser.add_argument('--prefilter', action='store', type=float, nargs='?', const=min_word_share, metavar='QUALITY', help='only fuzzy score terms an exact match of their OCR spellings finds first, unless the share of word like tokens in a document is under QUALITY')
+    parser.add_argument('--stream', action='store', type=int, nargs='?', const=default_chunk_size, metavar='CHARS', help='score each document in overlapping windows of this many characters instead of reading it whole')
+    parser.add_argument('--cache', action='store', nargs='?', const=RESULT_CACHE_DB, help='keep raw scores per document and term, later runs only score new terms and new or changed documents')
+    parser.add_argument('--cache-rows', action='store', type=int, default=default_cache_rows, help='scores the result cache keeps before evicting the least recently used terms')
+    parser.add_argument('--metrics-port', action='store', type=int, help='serve per stage timings in the Prometheus text format on this port while searching')
+    parser.add_argument('--metrics-file', action='store', help='write the Prometheus metrics to this file, for the node_exporter textfile collector')
+    parser.add_argument('--profile', action='store', nargs='?', const=PROFILE_FOLDER, metavar='FOLDER', help='sample the stack of every stage, writing pstats files and the slowest documents with their stage breakdown to this folder')
+    parser.add_argument('--profile-interval', action='store', type=float, default=default_sample_interval, help='seconds between stack samples with --profile')
+    parser.add_argument('--profile-top', action='store', type=int, default=default_slowest, help='documents in the --profile slowest documents report')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1, help='processes to scan folders with')
+    parser.add_argument('--chunk-size', action='store', type=int, default=64, help='folders handed to a process at a time')
+    parser.add_argument('--match-threads', action='store', type=int, default=1, help='threads rapidfuzz scores the terms of a document with, -1 for all cores')
     args = parser.parse_args()
-    
-   
-    
-    LOGGER = logging.getLogger('fda_search')
+
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
@@ -115,124 +415,189 @@ def main():
     if not os.path.exists(PDF_FOLDER):
         LOGGER.error(f"Cant find the folder {PDF_FOLDER}")
         sys.exit(1)
+    METRICS.export(args.metrics_port, args.metrics_file)
+    profile_interval = None
+    if args.profile is not None:
+        profile_interval = args.profile_interval
+        PROFILER.export(args.profile, args.profile_top)
         
-    if args.search != 'none' and args.file != 'none':
-        LOGGER.error(" Cannot have both file and search parameters")
-        sys.exit(1)
-        
+    # every group is searched in the same pass over the folders
+    groups = []
     if args.search != 'none':
-        search_list = searchTermGroups.get(args.search, [])
-        if len(search_list) == 0:
-            LOGGER.error(f"Search type {args.search} not valid key")
-            sys.exit(1)
-    else:
+        for key in args.search.split(','):
+            search_list = searchTermGroups.get(key, [])
+            if len(search_list) == 0:
+                LOGGER.error(f"Search type {key} not valid key")
+                sys.exit(1)
+            groups.append((key, search_list))
+    for filename in args.file or []:
         # read them form the file
-        if not os.path.exists(args.fiile):
-            LOGGER.error(f"Search terms file  {args.file} not found")
+        if not os.path.exists(filename):
+            LOGGER.error(f"Search terms file  {filename} not found")
+            sys.exit(1)
+        search_list = loadSearchFile(filename)
+        if len(search_list) == 0:
+            LOGGER.error(f"Search terms file  {filename} is empty")
             sys.exit(1)
-        with open(args.file) as sfd:
-            lines = sfd.readlines(sfd)
-        if len(lines) == 0:
-            LOGGER.error(f"Search terms file  {args.file} is empty")
+        groups.append((os.path.splitext(os.path.basename(filename))[0], search_list))
+    for number, value in enumerate(args.query or []):
+        if re.match(r'\w+=', value):
+            name, value = value.split('=', 1)
+        else:
+            name = 'query' if len(args.query) == 1 else f'query{number + 1}'
+        try:
+            groups.append((name, Query(value)))
+        except ValueError as e:
+            LOGGER.error(f"Cannot read query {value}: {e}")
             sys.exit(1)
-        search_list = [x.trim() for x in lines]
+    if len(groups) == 0:
+        LOGGER.error("Need search groups, a search terms file or a query")
+        sys.exit(1)
+    if args.cache is not None and args.stream is not None:
+        LOGGER.error("--cache needs whole document scores, it cannot be used with --stream")
+        sys.exit(1)
+    if args.query and (args.stream is not None or args.prefilter is not None or args.cache is not None):
+        LOGGER.warning("--stream, --prefilter and --cache only apply to -s and -f groups, queries read and score the whole text")
+    if len(set(name for name, search_list in groups)) != len(groups):
+        LOGGER.error("Search groups and terms files need different names")
+        sys.exit(1)
+    search_list = allTerms(groups)
         
             
     output_file,_ = os.path.splitext(args.output)
 
+    filtering = any(x is not None for x in (args.product_code, args.applicant, args.committee,
+                                            args.decided_since, args.decided_until))
+    device_records = {}
+    if args.metadata is not None:
+        if not os.path.exists(args.metadata):
+            LOGGER.error(f"Cant find the metadata database {args.metadata}, run fdaMetadata.py to build it")
+            sys.exit(1)
+        store = MetadataStore(args.metadata)
+        device_records = store.select(product_codes=args.product_code.split(',') if args.product_code else None,
+                                      applicant=args.applicant, committee=args.committee,
+                                      since=args.decided_since, until=args.decided_until)
+        store.close()
+        LOGGER.info(f'{len(device_records)} K-numbers from {args.metadata}')
+    elif filtering:
+        LOGGER.error("Filtering on the device record needs --metadata")
+        sys.exit(1)
+
     number_empty = 0
     total_k = 0
-    negative_hits = 0
-    found_510Ks = [] # an array of device objects that are positive hits
-    count_by_product_code = defaultdict(int)
+    # per group
+    negative_hits = defaultdict(int)
+    found_510Ks = defaultdict(list) # an array of device objects that are positive hits
+    count_by_product_code = defaultdict(lambda: defaultdict(int))
+
+    # K-numbers each term can score above the cutoff in, None for all of them
+    term_candidates = {}
+    if args.index:
+        index = TrigramIndex.load(args.index_file)
+        updated = index.update(PDF_FOLDER)
+        if updated != 0:
+            index.save(args.index_file)
+        LOGGER.info(f'Trigram index has {len(index.docs)} documents, {updated} new or changed')
+        for item in search_list:
+            term_candidates[item] = index.candidates(stripNegation(item), int(args.cutoff))
+        for name, query in groups:
+            if isinstance(query, Query):
+                query.useIndex(index, int(args.cutoff))
+    if args.explain:
+        for name, query in groups:
+            if isinstance(query, Query):
+                LOGGER.info(f'{name} is evaluated as {query.describe()}')
     
-    for root, dirs, files in os.walk(PDF_FOLDER):
-        if root.startswith(PDF_FOLDER) and re.match("K\d{6}",os.path.split(root)[1]):
-            if len(files) != 2:
-                if args.purge:
-                    shutil.rmtree(root)
-                number_empty += 1
-                continue
-            else:
-                total_k += 1
-                k_number = os.path.basename(root)
-                ocrTextFilename = os.path.join(root,'out_text.txt') 
-                dataFilename =  os.path.join(root,'data.txt')    
-                json_string = convert2json(dataFilename)
-                try:
-                    device_dict = json.loads(json_string)
-                except json.JSONDecodeError as e:
-                    x = 1
-                    LOGGER.error(f'Cannot parse {k_number} json string {e}')
-                    LOGGER.error(f"{e.doc[e.colno-20:e.colno+20]}")
-                    continue
-
-
-                #  text for skips in device type
-                
-                try:
-                    device_name = device_dict['openfda']['device_name'].lower()
-                except:
-                    device_name = "missing"
-                wasMatched = False
-                for item in search_list:
-                    if item.startswith('!'):
-                        search_field = item[1:]
-                        if re.search(search_field, device_name):
-                            wasMatched = True
-                            LOGGER.info(f"{k_number} negated device name {device_name} by {search_field}")
-                            break
-                if wasMatched:
-                    negative_hits +=  1
-                    continue # ignore this device
-                
-                            
-
-
-
-                # use fuzz package to search for terms in the list and deal with incorrect OCR
-                isFileHeaderOutput = False
-                with open(ocrTextFilename) as ocrInput:
-                    lines = ocrInput.read()
-                    # look for predicate information'
-                    results = re.findall(r'K\d{6}',lines)
-                    predicates = None
-                    if results and len(results) != 0:
-                        all = set([x.strip() for x in results])
-                        all.discard(k_number)
-                        predicates = list(all)
-                        device_dict['predicates'] = predicates
-
-                    hit_list = [] 
-                    clearList = False
-                    for item in search_list:
-                        search_term = item[1:] if item.startswith('!') else item
-                        ratio = fuzz.partial_ratio(search_term.lower(), lines.lower())              
-                        if ratio > int(args.cutoff):
-                            if item.startswith('!'):   #not this
-                                LOGGER.info(f"{k_number} content negated by {search_field}") 
-                                negative_hits += 1
-                                clearList = True
-                                break
-                            else:
-                                hit_list.append([item, ratio])
-
-                    if  clearList:
-                        hit_list = []
-                    if len(hit_list) > 0:
-                        LOGGER.info(f'File {k_number}')        
-                        LOGGER.info(f"    Product Code = {device_dict['product_code']}")
-                        LOGGER.info(f"    Device name =  {device_name}")       
-                        for item,ratio in hit_list:     
-                            LOGGER.info(f"        Hit: {item},ratio: {ratio}")
-                        device_dict['hits'] = hit_list
-                        found_510Ks.append(device_dict)  
-                        product_code = device_dict['product_code']
-                        count_by_product_code[product_code] += 1
-    
-    if args.sortby in found_510Ks[0].keys():
-        sortby = args.sortby
+    corpus_locations = {}
+    if args.corpus is not None:
+        corpus = Corpus(args.corpus)
+        packed = corpus.pack(PDF_FOLDER)
+        corpus_locations = corpus.entries()
+        corpus.close()
+        LOGGER.info(f'Corpus has {len(corpus_locations)} documents, {packed} new or changed')
+
+    folders = []
+    walk_start = time.perf_counter()
+    if args.metadata is not None:
+        # the database knows every folder, in K-number order, so only those
+        # are listed instead of walking the whole tree
+        candidates = ((os.path.normpath(folder), folderFiles(folder)) for folder, hit in device_records.values()
+                      if folder is not None)
+    else:
+        candidates = ((root, files) for root, dirs, files in os.walk(PDF_FOLDER)
+                      if root.startswith(PDF_FOLDER) and re.match("K\d{6}",os.path.split(root)[1]))
+    for root, files in candidates:
+        k_number = os.path.basename(root)
+        if filtering and k_number not in device_records:
+            continue
+        if files is None or len(files) != 2:
+            if args.purge and files is not None:
+                shutil.rmtree(root)
+            number_empty += 1
+            continue
+        else:
+            total_k += 1
+            record = device_records.get(k_number)
+            folders.append((root, record[1] if record is not None else None, corpus_locations.get(k_number)))
+    walk_seconds = time.perf_counter() - walk_start
+
+    initScanWorker(groups, int(args.cutoff), term_candidates, args.match_threads, args.corpus, args.prefilter,
+                   args.stream, args.cache, profile_interval)
+    if args.jobs > 1:
+        # chunks come back in walk order, so the merge below sees the same
+        # sequence of results as a serial run
+        chunks = [folders[i:i + args.chunk_size] for i in range(0, len(folders), args.chunk_size)]
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=initScanWorker,
+                                 initargs=(groups, int(args.cutoff), term_candidates, args.match_threads,
+                                           args.corpus, args.prefilter, args.stream, args.cache,
+                                           profile_interval)) as executor:
+            chunk_results = list(executor.map(scanChunk, chunks))
     else:
+        chunk_results = [scanChunk(folders)]
+    results = [result for chunk, scored, metrics, profile in chunk_results for result in chunk]
+    # every process reports its own metrics, a forked one clears the copy
+    # of the parent's it starts with
+    for chunk, scored, metrics, profile in chunk_results:
+        METRICS.merge(metrics)
+        if profile is not None:
+            PROFILER.merge(profile)
+    METRICS.observe('stage_seconds', walk_seconds, stage='walk')
+
+    if args.cache is not None:
+        cache = ResultCache(args.cache, args.cache_rows)
+        scored = [entry for chunk, pending, metrics, profile in chunk_results for entry in pending]
+        cache.store(scored)
+        keys = set(cacheKey(item) for item in search_list)
+        cache.touch(keys)
+        dropped = cache.evict(keys)
+        LOGGER.info(f'{len(scored)} of {len(folders)} folders needed scoring past the result cache'
+                    + (f', {len(dropped)} terms evicted' if dropped else ''))
+        cache.close()
+
+    for folder_results in results:
+        for (name, _), (status, device_dict) in zip(groups, folder_results):
+            METRICS.inc('documents_total', status=status, group=name)
+            if status == 'negated':
+                negative_hits[name] += 1
+            elif status == 'hit':
+                found_510Ks[name].append(device_dict)
+                product_code = device_dict['product_code']
+                count_by_product_code[name][product_code] += 1
+
+    for name, _ in groups:
+        group_file = output_file if len(groups) == 1 or output_file == '-' else f'{output_file}_{name}'
+        if group_file == '-' and len(groups) > 1:
+            # the groups follow each other on stdout
+            sys.stdout.write(f'== {name} ==\n')
+        writeGroup(group_file, found_510Ks[name], negative_hits[name], count_by_product_code[name],
+                   total_k, number_empty, cursor, args.sortby)
+    cnx.close()
+    METRICS.close()
+    PROFILER.close()
+
+
+def writeGroup(output_file, found_510Ks, negative_hits, count_by_product_code, total_k, number_empty, cursor, sortby):
+    if len(found_510Ks) == 0 or sortby not in found_510Ks[0].keys():
         sortby = 'k_number'
     
     found_510Ks.sort(key=lambda x: x[sortby])
@@ -243,13 +608,13 @@ def main():
 
     
     json_out = "-" if output_file == "-" else output_file + '.json'
-    with smart_open(json_out, "w") as fh:
+    with smart_open(json_out) as fh:
         fh.write(json_found)
 
     
 
-    dat_out = "-" if output_file == '_' else output_file + '.dat'        
-    with smart_open(dat_out, "w") as fh:
+    dat_out = "-" if output_file == '-' else output_file + '.dat'        
+    with smart_open(dat_out) as fh:
 
         fh.write(f"Total folders scanned: {total_k}\n")
         fh.write(f"Number of hits is {len(found_510Ks)}\n")
@@ -265,8 +630,6 @@ def main():
             cursor.execute(f"SELECT devicename FROM device WHERE productcode='{key}'")
             devicename = cursor.fetchall()
             fh.write(f"        Product code={key}: {value:04}  {devicename[0][0]}\n")
-
-        cnx.close()
         
 
 if __name__ == '__main__':
@@ -1,243 +1,240 @@
 import argparse
+import json
 import logging
-import os
-import re
-import sys
+import threading
 import time
-from pathlib import Path
-from tempfile import TemporaryDirectory
-import json
 
-import fitz
-import pytesseract
-import requests
-from bs4 import BeautifulSoup, NavigableString
-from fuzzywuzzy import fuzz, process
-from PIL import Image
 import redis
 
-from smart_open import smart_open
-
-
-
-AM_words = [
-'additive',
-'additively',
-'additive manufactured',
-'additive manufacturing',
-'3d printing',
-'3d printed',
-'stereolithography',
-'stereolithographic',
-'powder fusion',
-'powder bed fusion',
-'FDM',
-'FFF',
-'SLS',
-"DLP",
-"SLA",
-"laser sintering"
-]
-
-BE_Words = [
-    'bioabsorbable',
-    'resorbable',
-    'biodegradable',
-    'absorbable'
-]
-
-
-OFDA_DEVICE = 'https://api.fda.gov/device'
-OFDA_510K = '/510k.json?'
-OFDA_CLASSIFICATION = '/classification.json?'
-OFDA_REGISTRATION = '/registrationlisting.json?'
-OFDA_PMA = '/pma.json?'
-SEARCH = 'search='
-COUNT = 'count='
-HAS_SUMMARY = 'statement_or_summary=Summary'
-PDF_FOLDER = 'pdf/'
-
-BASE_510K_URL = 'https://www.accessdata.fda.gov/scripts/cdrh/cfdocs/cfPMN/pmn.cfm?ID='
+from fdaRedisQueue import REDIS_URL
 
-stop_state_key = "STOPSTATE"
-skip_count_key = "SKIPCOUNT"
 
-default_limit=500
+LOGGER = logging.getLogger('fda')
+
+stop_state_key = "STOPSTATE"
+progress_key = "PROGRESS"
+
+# run, pause holds every worker until resumed, drain finishes the items in
+# flight and starts no new ones, stop drops the items in flight at their
+# next stage.  Later states win over earlier ones
+RUN = 'run'
+PAUSE = 'pause'
+DRAIN = 'drain'
+STOP = 'stop'
+STATES = (RUN, PAUSE, DRAIN, STOP)
+
+# seconds between looks at the state while paused
+default_poll = 1
+# seconds between progress updates, a worker's progress expires after
+# missing a few of them
+default_publish_interval = 5
+progress_ttl = 3 * default_publish_interval
+# weight of the newest interval in the smoothed rates
+rate_smoothing = 0.3
+
+# set by SIGINT for this process only, the first one drains, the second stops
+local_state = RUN
 
-killed = False
 
 def catchSIGINT(signum,frame):
-    global killed
-    print('SIGINT received.   Will Stop after this cycle')
-    killed = True
-    
-    
-def getYear(k):
-    result = re.match('K(\d\d)\d{4}',k)
-    firstTwo = int(result.groups()[0])
-    out =  ('20' if firstTwo < 79 else '19') + str(firstTwo)
-    return out
-    
-
-def main(): 
-
-    # check to see if this is a restart
+    global local_state
+    if local_state == RUN:
+        print('SIGINT received.   Will stop after the items in flight, again to stop now')
+        local_state = DRAIN
+    elif local_state == DRAIN:
+        print('SIGINT received again.   Stopping at the next stage, again to interrupt')
+        local_state = STOP
+    else:
+        raise KeyboardInterrupt
+
+
+class Controller:
+    # what the workers should be doing: the most severe of STOPSTATE in
+    # redis, shared by every worker, and this process's own SIGINT state.
+    # Checked before every item and every pipeline stage, so a change takes
+    # effect within one stage of one item.  Any other value in STOPSTATE
+    # stops, the way anything but run always has
+    def __init__(self, redisHandle, poll=default_poll):
+        self.redis = redisHandle
+        self.poll = poll
+
+    def state(self):
+        shared = self.redis.get(stop_state_key)
+        shared = shared.decode() if shared is not None else RUN
+        if shared not in STATES:
+            shared = STOP
+        return max(shared, local_state, key=STATES.index)
+
+    def wait(self):
+        # blocks while paused, returns the state after
+        state = self.state()
+        if state == PAUSE:
+            LOGGER.info('Paused')
+            while state == PAUSE:
+                time.sleep(self.poll)
+                state = self.state()
+            LOGGER.info(f'Resumed to {state}')
+        return state
+
+    def startItem(self):
+        # may a new item be started
+        return self.wait() == RUN
+
+    def continueItem(self):
+        # may an item in flight go on to its next stage
+        return self.wait() != STOP
+
+
+class Progress:
+    # the counters of one worker, published every interval seconds to the
+    # redis key PROGRESS:<worker>: items finished by status, openFDA pages
+    # read, smoothed items/s and pages/s, pipeline queue depths and an ETA
+    # from what the source says is left, as json.  The key expires when the
+    # worker stops publishing, so the status command only shows live workers
+    def __init__(self, redisHandle, worker, controller=None, interval=default_publish_interval):
+        self.redis = redisHandle
+        self.worker = worker
+        self.key = f'{progress_key}:{worker}'
+        self.controller = controller
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.items = 0
+        self.pages = 0
+        self.statuses = {}
+        self.rates = None
+        self.last = (self.started, 0, 0)
+        self.remaining = None
+        self.depths = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self, remaining=None):
+        # remaining() is the number of hits the source has left, None if
+        # it doesn't know
+        self.remaining = remaining
+        self.thread = threading.Thread(target=self._run, name='progress', daemon=True)
+        self.thread.start()
+
+    def item(self, status):
+        with self.lock:
+            self.items += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def page(self):
+        with self.lock:
+            self.pages += 1
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            items, pages, statuses = self.items, self.pages, dict(self.statuses)
+        then, lastItems, lastPages = self.last
+        elapsed = max(now - then, 1e-6)
+        rates = ((items - lastItems) / elapsed, (pages - lastPages) / elapsed)
+        if self.rates is not None:
+            rates = tuple(rate_smoothing * new + (1 - rate_smoothing) * old for new, old in zip(rates, self.rates))
+        self.rates = rates
+        self.last = (now, items, pages)
+        remaining = self.remaining() if self.remaining is not None else None
+        eta = remaining / rates[0] if remaining is not None and rates[0] > 0 else None
+        return {
+            'worker': self.worker,
+            'state': self.controller.state() if self.controller is not None else RUN,
+            'started': self.started,
+            'updated': now,
+            'items': items,
+            'pages': pages,
+            'statuses': statuses,
+            'items_per_s': rates[0],
+            'pages_per_s': rates[1],
+            'remaining': remaining,
+            'eta': eta,
+            'depths': self.depths() if self.depths is not None else {},
+        }
+
+    def publish(self, state=None):
+        snapshot = self.snapshot()
+        if state is not None:
+            snapshot['state'] = state
+        self.redis.set(self.key, json.dumps(snapshot), ex=progress_ttl)
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.publish()
+            except redis.RedisError as e:
+                LOGGER.error(f'Cannot publish progress, {e}')
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.publish('stopped')
+
+
+def readProgress(redisHandle):
+    # the latest snapshot of every live worker
+    snapshots = []
+    for key in redisHandle.scan_iter(f'{progress_key}:*'):
+        value = redisHandle.get(key)
+        if value is not None:
+            snapshots.append(json.loads(value))
+    return sorted(snapshots, key=lambda snapshot: snapshot['worker'])
+
+
+def formatDuration(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+def showStatus(redisHandle):
+    state = redisHandle.get(stop_state_key)
+    print(f'{stop_state_key} {state.decode() if state is not None else "unset"}')
+    snapshots = readProgress(redisHandle)
+    if len(snapshots) == 0:
+        print('No workers running')
+        return
+    for snapshot in snapshots:
+        statuses = ' '.join(f'{status}={count}' for status, count in sorted(snapshot['statuses'].items()))
+        depths = ' '.join(f'{stage}={depth}' for stage, depth in snapshot['depths'].items())
+        print(f"{snapshot['worker']} {snapshot['state']} up {formatDuration(time.time() - snapshot['started'])}"
+              f" items {snapshot['items']} ({statuses}) {snapshot['items_per_s']:.2f}/s"
+              f" pages {snapshot['pages']} {snapshot['pages_per_s'] * 60:.2f}/min"
+              f" left {snapshot['remaining'] if snapshot['remaining'] is not None else '-'}"
+              f" ETA {formatDuration(snapshot['eta'])}" + (f" queues {depths}" if depths else ''))
+    # workers sharing a source all see the same hits left, so they finish
+    # together at their combined rate
+    rate = sum(snapshot['items_per_s'] for snapshot in snapshots)
+    left = [snapshot['remaining'] for snapshot in snapshots if snapshot['remaining'] is not None]
+    eta = max(left) / rate if left and rate > 0 else None
+    print(f'{len(snapshots)} workers {rate:.2f} items/s ETA {formatDuration(eta)}')
+
+
+def main():
     parser = argparse.ArgumentParser(
-        prog="fda-miner",
-        description='This program deep earches the FDA 510(k) database'
+        prog="fda-control",
+        description='Pause, resume, drain or stop every running fdaMain, or show their progress'
     )
-    parser.add_argument('-v', '--verbose', action='store_true', help='extra output')
-    parser.add_argument('-r', '--restart', action='store_true', help='start over if the restart_url file is present')
-    parser.add_argument('-l', '--limit',   action='store', default=default_limit, help='set number of hits maximum')
-    parser.add_argument('-o', '--output', action='store', default='stdout', help='file to output to')
-    parser.add_argument('-a', '--append', action='store_true', help='if output file not stdout, append to the file rather tan a new one')
+    parser.add_argument('command', nargs='?', choices=('status', 'pause', 'resume', 'drain', 'stop'), default='status',
+                        help='drain finishes the items in flight, stop drops them at their next stage')
+    parser.add_argument('--redis-url', action='store', default=REDIS_URL, help='redis server the workers use')
+    parser.add_argument('-w', '--watch', action='store', type=float, nargs='?', const=default_publish_interval, metavar='SECONDS',
+                        help='show the status again every so many seconds')
     args = parser.parse_args()
-    
-   
-    
-    LOGGER = logging.getLogger('fda')
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG)
-    else:
-        logging.basicConfig(level=logging.INFO)
-    
-            
-    if not os.path.exists(PDF_FOLDER):
-        LOGGER.debug('Creating main folder')
-        os.mkdir(PDF_FOLDER)
-        
-    link = None    
-    redisHandle = redis.Redis()
-    redisHandle.set(stop_state_key ,'run')
-    if redisHandle.get(skip_count_key) is None:
-        redisHandle.set(skip_count_key, 0)
-    limit = int(args.limit)
-        
-    # initial search 
-    while True:
-        status = redisHandle.get(stop_state_key).decode()
-        if status != 'run':
-            print("Exiting. Use restart and append to continue")
-            sys.exit(0)
-        skip_count = int(redisHandle.get(skip_count_key))   
-        response = requests.get(f'{OFDA_DEVICE + OFDA_510K + SEARCH  + HAS_SUMMARY}&limit={limit}&skip={skip_count}')
-        
-    
-        hits = response.json()['results']
-            
-        out_file = (args.output if args.output != 'stdout' else '-').strip()
-        
-        for hit in hits:   
-            with smart_open(out_file, append=args.append, buffering=1) as hitTextOutput:
-                k_number = hit['k_number']
-                yearString = 'Submit_Year_' + getYear(k_number)
-                pdf_type = hit.get('statement_or_summary', 'missing')
-                if pdf_type !='missing':
-                    r_510K = requests.get(f'{BASE_510K_URL}{k_number}')
-                    soup = BeautifulSoup(r_510K.text, 'lxml')
-                    summary_button = soup("a", text=re.compile(r'Summary'))
-                    if len(summary_button) == 0:
-                        continue
-                    elem = summary_button[0]
-                    pdf_url = elem.get('href', "")
-                    if pdf_url == "":
-                        continue
-                    else:    
-                        pdf_year_folder = os.path.join(PDF_FOLDER,yearString)
-                        if not os.path.exists(pdf_year_folder):
-                            os.mkdir(pdf_year_folder)
-                        dataPath = os.path.join(pdf_year_folder,k_number)
-                        if not os.path.exists(dataPath):        
-                            os.mkdir(dataPath)
-                        # metadata file
-                        product_code = hit.get('product_code','???')
-                        device_name = hit.get('device_name','no name')
-                        advisory_committee = hit.get('advisory_committee', 'XX')
-                        advisory_committee_desc = hit.get('advisory_committee_description', 'no description')
-                        applicant = hit.get('applicant', 'no applicant')
-                        all510Kfilaname = os.path.join(dataPath, 'data.txt')
-                   
-                        #get the summary pdf and save it
-                        response = requests.get(pdf_url)
-                        pdfPath = os.path.join(dataPath,f"{k_number}.pdf")
-                        pdf = open(pdfPath, 'wb') 
-                        pdf.write(response.content)
-                        pdf.close()
-                        
-            # Store all the pages of the PDF in a variable
-                    image_file_list = []
-
-                    ocrTextFilename = os.path.join(dataPath,'out_text.txt')
-
-                
-                    with TemporaryDirectory() as tempdir:
-                # Create a temporary directory to hold our temporary images.
-
-                        """
-                        Part #1 : Converting PDF to images
-                        """
-
-                        pdf_pages = fitz.open(pdfPath)
-                    # Read in the PDF file at 500 DPI
-
-                    # Iterate through all the pages stored above
-                        start = time.time()
-                        for page_enumeration, page in enumerate(pdf_pages, start=1):
-                            filename = os.path.join(tempdir,f'page_{page_enumeration:03}.jpg')
-                            pix = page.get_pixmap(dpi=300)
-                            pix.save(filename)
-                            image_file_list.append(filename)
-                        os.remove(pdfPath)  # erase the pdf file for space saving
-            
-                        
-                        with open(ocrTextFilename, "a") as ocrOutput:
-                            for image_file in image_file_list:
-                                    text = str(((pytesseract.image_to_string(Image.open(image_file)))))
-                                    text = text.replace("-\n", "")
-                                    ocrOutput.write(text)
-                                    
-                        end = time.time()
-                        print(f'File {k_number} {len(pdf_pages)} pages, processing time is {(end - start):.0f} seconds')
-                        
-                        # use fuzz package to search for terms in the list and deal with incorrect OCR
-                        isFileHeaderOutput = False
-                        with open(ocrTextFilename) as ocrInput:
-                            lines = ocrInput.read()
-                            # look for predicate information'
-                            results = re.findall(r'K\d{6}',lines)
-                            predicates = None
-                            if results and len(results) != 0:
-                                all = set([x.strip() for x in results])
-                                all.discard(k_number)
-                                predicates = list(all)
-                                if predicates and len(predicates) != 0:
-                                   hit['predicates'] = predicates
-                            
-                            for item in BE_Words:
-                                ratio = fuzz.partial_ratio(item.lower(), lines.lower())              
-                                if ratio > 80:  
-                                    if not isFileHeaderOutput:
-                                        hitTextOutput.write(f'File {k_number} {len(pdf_pages)} pages\n')        
-                                        hitTextOutput.write(f"    Product Code = {hit['product_code']}\n")
-                                        hitTextOutput.write(f"    Device name = {hit['device_name']}\n")       
-                                        isFileHeaderOutput = True
-                                    hitTextOutput.write(    f"        Has {item} with ratio {ratio}\n") 
-                                    hitTextOutput.flush()
-                                    
-                            hit['openfda']['fei_number'] = 'see openFDA'
-                            hit['openfda']['registration_number'] = 'see openFDA'   
-                            with open(all510Kfilaname,'w') as all510KsFH:
-                                all510KsFH.write(f'Product Code: {product_code}\n')
-                                all510KsFH.write(f'Applicant:    {applicant}\n')
-                                all510KsFH.write(f'Device Name:  {device_name}\n')
-                                all510KsFH.write(f'Advisory Committee ({advisory_committee}): {advisory_committee_desc}')
-                                all510KsFH.write(json.dumps(hit,indent=4))
-        redisHandle.incrby(skip_count_key, limit)
-                    
-
-if __name__ == '__main__':
-    main()
-
+    logging.basicConfig(level=logging.INFO)
 
+    redisHandle = redis.Redis.from_url(args.redis_url)
+    if args.command != 'status':
+        redisHandle.set(stop_state_key, RUN if args.command == 'resume' else args.command)
+    showStatus(redisHandle)
+    while args.watch:
+        time.sleep(args.watch)
+        print()
+        showStatus(redisHandle)
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import pytest
+
+pytest.importorskip('rapidfuzz')
+
+from fdaQuery import And, Near, Not, Or, Parser, Query, QueryDocument, Term
+
+
+def parse(text):
+    return Parser(text).parse()
+
+
+def document(text, device_name='powder bed fusion printer', cutoff=80):
+    loads = []
+    def loadText():
+        loads.append(1)
+        return text
+    doc = QueryDocument('K000001', device_name, loadText, cutoff)
+    doc.loads = loads
+    return doc
+
+
+def test_and_binds_tighter_than_or():
+    node = parse('a OR b AND c')
+    assert isinstance(node, Or)
+    assert node.children[0].text == 'a'
+    assert isinstance(node.children[1], And)
+    assert [child.text for child in node.children[1].children] == ['b', 'c']
+
+
+def test_implicit_and():
+    node = parse('a "b c" (d OR e)')
+    assert isinstance(node, And)
+    assert [type(child) for child in node.children] == [Term, Term, Or]
+    assert node.children[1].text == 'b c'
+
+
+def test_not_and_parentheses():
+    node = parse('NOT (a OR b) c')
+    assert isinstance(node, And)
+    assert isinstance(node.children[0], Not)
+    assert isinstance(node.children[0].child, Or)
+
+
+def test_fields():
+    node = parse('name:suture text:"bone screw" name: "\\Dstent"')
+    assert [(child.field, child.text) for child in node.children] == [
+        ('name', 'suture'), ('text', 'bone screw'), ('name', '\\Dstent')]
+
+
+def test_near_binds_tightest():
+    node = parse('a NEAR/3 b OR c')
+    assert isinstance(node, Or)
+    near = node.children[0]
+    assert isinstance(near, Near)
+    assert (near.left.text, near.right.text, near.distance) == ('a', 'b', 3)
+
+
+@pytest.mark.parametrize('text', ['(a OR b', 'a OR', 'NEAR/2 a', '(a b) NEAR/2 c', 'name:a NEAR/2 b', 'name:"(a"'])
+def test_bad_queries(text):
+    with pytest.raises(ValueError):
+        parse(text)
+
+
+def test_name_terms_keep_their_case_as_regular_expressions():
+    # \D is any non digit, lowercased it would be \d
+    assert Query('name:"\\Dowder"').evaluate(document('', 'powder bed'))
+    assert not Query('name:"\\dowder"').evaluate(document('', 'powder bed'))
+    assert Query('name:POWDER').evaluate(document('', 'powder bed'))
+
+
+def test_name_only_query_does_not_read_the_text():
+    doc = document('anything')
+    assert Query('name:powder OR name:suture').evaluate(doc)
+    assert doc.loads == []
+
+
+def test_text_terms_and_negation():
+    text = 'The device uses selective laser melting of titanium powder.'
+    assert Query('laser powder').evaluate(document(text))
+    assert not Query('laser NOT titanium').evaluate(document(text))
+    assert Query('(catheter OR titanium) name:printer').evaluate(document(text))
+
+
+@pytest.mark.parametrize('distance, expected', [(0, False), (2, False), (3, True), (10, True)])
+def test_near_distance(distance, expected):
+    # three words between them
+    text = 'laser beam melts titanium powder layer by layer'
+    assert Query(f'laser NEAR/{distance} powder').evaluate(document(text)) == expected
+    assert Query(f'powder NEAR/{distance} laser').evaluate(document(text)) == expected
+
+
+def test_near_adjacent_phrases():
+    text = 'a bone screw with locking plate holes'
+    assert Query('"bone screw" NEAR/0 with').evaluate(document(text))
+    assert not Query('"bone screw" NEAR/0 locking').evaluate(document(text))
@@ -0,0 +1,125 @@
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')  # fakeredis runs the lua scripts with it
+
+from fdaRedisQueue import LeasedQueue, LeaseKeeper
+
+
+def hits(*k_numbers):
+    return [{'k_number': k_number, 'device_name': 'device'} for k_number in k_numbers]
+
+
+@pytest.fixture
+def queue():
+    queue = LeasedQueue(fakeredis.FakeRedis(), 'TEST', lease=60, maxAttempts=2)
+    # lease times come from this clock instead of the server's
+    queue.clock = 1000.0
+    queue.now = lambda: queue.clock
+    return queue
+
+
+def test_add_ignores_hits_already_queued(queue):
+    assert queue.add(hits('K000001', 'K000002')) == 2
+    assert queue.add(hits('K000002', 'K000003')) == 1
+    assert queue.counts() == {'pending': 3}
+
+
+def test_claim_oldest_first_and_exclusive(queue):
+    queue.add(hits('K000001', 'K000002', 'K000003'))
+    first = queue.claim('a', 2)
+    second = queue.claim('b', 2)
+    assert [hit['k_number'] for hit in first] == ['K000001', 'K000002']
+    assert [hit['k_number'] for hit in second] == ['K000003']
+    assert queue.claim('c', 2) == []
+    assert queue.counts() == {'leased': 3}
+    assert queue.outstanding() == 3
+
+
+def test_ack_only_by_owner(queue):
+    queue.add(hits('K000001'))
+    queue.claim('a')
+    assert not queue.ack('b', 'K000001')
+    assert queue.ack('a', 'K000001')
+    assert queue.counts() == {'done': 1}
+    assert queue.outstanding() == 0
+
+
+def test_expired_lease_is_requeued(queue):
+    queue.add(hits('K000001'))
+    queue.claim('a')
+    queue.clock += 59
+    assert queue.claim('b') == []
+    queue.clock += 2
+    assert [hit['k_number'] for hit in queue.claim('b')] == ['K000001']
+    # the first worker lost it
+    assert not queue.ack('a', 'K000001')
+    assert queue.ack('b', 'K000001')
+
+
+def test_renew_keeps_the_lease(queue):
+    queue.add(hits('K000001'))
+    queue.claim('a')
+    queue.clock += 50
+    assert queue.renew('a', ['K000001']) == 1
+    assert queue.renew('b', ['K000001']) == 0
+    queue.clock += 50
+    assert queue.claim('b') == []
+    assert queue.ack('a', 'K000001')
+
+
+def test_expiry_past_max_attempts_goes_dead(queue):
+    queue.add(hits('K000001'))
+    for attempt in range(2):
+        assert len(queue.claim('a')) == 1
+        queue.clock += 61
+    assert queue.reap() == (0, 1)
+    assert queue.dead() == [('K000001', 'lease expired')]
+    assert queue.counts() == {'dead': 1}
+
+
+def test_fail_requeues_then_buries(queue):
+    queue.add(hits('K000001'))
+    queue.claim('a')
+    assert queue.fail('a', 'K000001', 'timeout') == 'pending'
+    queue.claim('a')
+    assert queue.fail('b', 'K000001') is None
+    assert queue.fail('a', 'K000001', 'bad pdf') == 'dead'
+    assert queue.dead() == [('K000001', 'bad pdf')]
+    assert queue.claim('a') == []
+
+
+def test_release_does_not_use_an_attempt(queue):
+    queue.add(hits('K000001'))
+    for attempt in range(5):
+        queue.claim('a')
+        assert queue.release('a', ['K000001']) == 1
+    assert queue.counts() == {'pending': 1}
+    queue.claim('a')
+    assert queue.fail('a', 'K000001') == 'pending'
+
+
+def test_retry_dead(queue):
+    queue.add(hits('K000001'))
+    queue.claim('a')
+    queue.fail('a', 'K000001')
+    queue.claim('a')
+    queue.fail('a', 'K000001')
+    assert queue.retryDead() == 1
+    assert queue.dead() == []
+    assert queue.counts() == {'pending': 1}
+    # attempts start over
+    queue.claim('a')
+    assert queue.fail('a', 'K000001') == 'pending'
+
+
+def test_keeper_fails_started_and_releases_the_rest(queue):
+    queue.add(hits('K000001', 'K000002'))
+    for attempt in range(2):
+        keeper = LeaseKeeper(queue, 'a')
+        claimed = [hit['k_number'] for hit in queue.claim('a', 2)]
+        keeper.hold(claimed)
+        keeper.start('K000001')
+        assert keeper.stop() == (1, 1)
+    assert queue.dead() == [('K000001', 'worker stopped while on it')]
+    assert queue.counts() == {'pending': 1, 'dead': 1}